@@ -1,13 +1,60 @@
 import argparse
 import json
+import os
 from pathlib import Path
+from typing import Iterator, Optional, Set, Tuple
 
 import yaml
 from loguru import logger
 
+from models.sharding import iter_jsonl, shard_assignments, shard_file
 from models.user_config import Models
 
 
+def read_inputs(input_file, skip: Set[Tuple[str, str]],
+                rows: Optional[Set[int]] = None) -> Iterator[dict]:
+    """Lazily read the input rows, leaving out the (SubjectEntityID, Relation) pairs in `skip`.
+
+    If `rows` is given, only the rows with these indices are read.
+    """
+    for i, row in enumerate(iter_jsonl(input_file)):
+        if rows is not None and i not in rows:
+            continue
+        if (row["SubjectEntityID"], row["Relation"]) not in skip:
+            yield row
+
+
+def read_done_pairs(output_file) -> Set[Tuple[str, str]]:
+    """Read the (SubjectEntityID, Relation) pairs already in the output file.
+
+    A trailing line that was only partially written (e.g. by a crashed run),
+    or is missing its newline, is removed from the file.
+    """
+    done = set()
+    if not Path(output_file).exists():
+        return done
+
+    valid_size = 0
+    with open(output_file, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                result = json.loads(line)
+            except ValueError:
+                break
+            done.add((result["SubjectEntityID"], result["Relation"]))
+            valid_size += len(line)
+
+    if valid_size < os.path.getsize(output_file):
+        logger.warning(f"Removing a partially written line from "
+                       f"`{output_file}`.")
+        with open(output_file, "r+b") as f:
+            f.truncate(valid_size)
+
+    return done
+
+
 def main():
     parser = argparse.ArgumentParser(description="Run Baseline Models")
 
@@ -29,13 +76,49 @@ def main():
         required=False,
         help="Path to the output file"
     )
+    parser.add_argument(
+        "--no-gen-cache",
+        action="store_true",
+        help="Regenerate all completions instead of reusing cached generations"
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=128,
+        help="Number of input rows generated at a time; the results of a "
+             "chunk are written once it is done. 0 generates all rows at "
+             "once (default: 128). Rows are batched per relation and their "
+             "answer strings deduplicated within a chunk; resolved Wikidata "
+             "IDs are kept across chunks (up to max_resolved_ids)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the rows already in the output file and append the rest"
+    )
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=1,
+        help="Number of shards the input rows are split into (default: 1)"
+    )
+    parser.add_argument(
+        "--shard-id",
+        type=int,
+        default=0,
+        help="Shard of the input rows to run, from 0 to num-shards - 1"
+    )
 
     args = parser.parse_args()
+    if not 0 <= args.shard_id < args.num_shards:
+        parser.error("--shard-id must be between 0 and --num-shards - 1")
 
     # Load the configuration file
     logger.info(f"Loading the YAML configuration file `{args.config_file}`...")
     with open(args.config_file) as f:
         config = yaml.safe_load(f)
+    if args.no_gen_cache:
+        config["generation_cache"] = False
 
     # File paths
     input_file = args.input_file
@@ -45,25 +128,55 @@ def main():
         output_dir.mkdir(parents=True, exist_ok=True)
         file_name = Path(args.config_file).stem
         output_file = output_dir / f"{file_name}.jsonl"
+        if args.num_shards > 1:
+            output_file = shard_file(output_file, args.shard_id,
+                                     args.num_shards)
+
+    # Rows of this shard
+    shard_rows = None
+    if args.num_shards > 1:
+        assignments = shard_assignments(
+            [row["Relation"] for row in iter_jsonl(args.input_file)],
+            args.num_shards,
+            relation_costs=config.get("shard_relation_costs"))
+        shard_rows = {i for i, shard in enumerate(assignments)
+                      if shard == args.shard_id}
+        logger.info(f"Running shard {args.shard_id} of {args.num_shards} "
+                    f"({len(shard_rows):,} of {len(assignments):,} rows).")
+
+    # Rows already predicted by an earlier run
+    done = set()
+    if args.resume:
+        done = read_done_pairs(output_file)
+        logger.info(f"Resuming `{output_file}`: skipping {len(done):,} "
+                    f"rows that were already predicted.")
 
     # Load the input file
-    logger.info(f"Loading the input file `{input_file}`...")
-    with open(input_file) as f:
-        input_rows = [json.loads(line) for line in f]
-    logger.info(f"Loaded {len(input_rows):,} rows.")
+    logger.info(f"Reading the input file `{input_file}`...")
+    input_rows = read_inputs(input_file, skip=done, rows=shard_rows)
+    if args.chunk_size <= 0:
+        input_rows = list(input_rows)
+        logger.info(f"Loaded {len(input_rows):,} rows.")
 
     # Load the model
     m = Models.get_model(config["model"])
     model = m(config)
 
-    # Generate predictions
-    results = model.generate_predictions(input_rows)
+    # Generate predictions and save every result as soon as it is ready
+    if args.chunk_size > 0:
+        results = model.generate_predictions_stream(
+            input_rows, chunk_size=args.chunk_size)
+    else:
+        results = model.generate_predictions(input_rows)
 
-    # Save the results
     logger.info(f"Saving the results to `{output_file}`...")
-    with open(output_file, "w+") as f:
+    num_results = 0
+    with open(output_file, "a" if args.resume else "w") as f:
         for result in results:
             f.write(json.dumps(result) + "\n")
+            f.flush()
+            num_results += 1
+    logger.info(f"Saved {num_results:,} results.")
 
     logger.info("Done!")
 
@@ -0,0 +1,702 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from functools import wraps
+from pathlib import Path
+
+import numpy as np
+import yaml
+from loguru import logger
+
+from models.sharding import iter_jsonl
+from models.user_config import Models
+from wikidata_stub import make_server, read_labels
+
+REPO_DIR = Path(__file__).resolve().parent
+
+# Prompting strategies of the dual model; the other models prompt once per input
+STRATEGIES = ["use_dual_prompting", "use_looping_prompts", "direct_strategy"]
+SINGLE_PROMPT = "single_prompt"
+
+# Input fields with the external information used by the dual model
+INFO_FIELDS = ["additionalData", "wikipediaExtract"]
+
+# Chat template and special tokens of the Llama 3 instruct models
+LLAMA_3_CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{% set content = '<|start_header_id|>' + message['role'] + "
+    "'<|end_header_id|>\n\n' + message['content'] | trim + '<|eot_id|>' %}"
+    "{% if loop.index0 == 0 %}{% set content = bos_token + content %}{% endif %}"
+    "{{ content }}{% endfor %}"
+    "{% if add_generation_prompt %}"
+    "{{ '<|start_header_id|>assistant<|end_header_id|>\n\n' }}{% endif %}"
+)
+LLAMA_3_SPECIAL_TOKENS = ["<|begin_of_text|>", "<|end_of_text|>",
+                          "<|start_header_id|>", "<|end_header_id|>",
+                          "<|eot_id|>"]
+BERT_SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+
+def tokenizer_corpus():
+    """Texts the tiny tokenizers are trained on: the train data and all prompt templates."""
+    yield from open(REPO_DIR / "data" / "train.jsonl")
+    for file_path in sorted((REPO_DIR / "prompt_templates").glob("*.csv")):
+        yield from open(file_path, encoding="utf-8-sig")
+
+
+def build_tiny_causal_lm(output_dir: Path, vocab_size: int = 2000):
+    """Save a randomly initialized two-layer Llama with a Llama 3 chat template."""
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, \
+        trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, \
+        PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(tokenizer_corpus(), trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=LLAMA_3_SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer,
+                                        bos_token="<|begin_of_text|>",
+                                        eos_token="<|end_of_text|>")
+    tokenizer.chat_template = LLAMA_3_CHAT_TEMPLATE
+
+    torch.manual_seed(0)
+    llm = LlamaForCausalLM(LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    ))
+    llm.generation_config.do_sample = False
+    llm.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+
+
+def build_tiny_draft_lm(output_dir: Path):
+    """Save a one-layer draft model for the tiny causal LM: its first layer, embeddings and head."""
+    from transformers import AutoTokenizer, LlamaForCausalLM
+
+    target_dir = output_dir.parent / "tiny-causal-lm"
+    target = LlamaForCausalLM.from_pretrained(target_dir)
+    config = target.config
+    config.num_hidden_layers = 1
+    llm = LlamaForCausalLM(config)
+    llm.load_state_dict(target.state_dict(), strict=False)
+    llm.generation_config.do_sample = False
+    llm.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(target_dir).save_pretrained(output_dir)
+
+
+def build_tiny_masked_lm(output_dir: Path, vocab_size: int = 2000):
+    """Save a randomly initialized two-layer BERT with a WordPiece tokenizer."""
+    import torch
+    from tokenizers import Tokenizer, decoders, models, normalizers, \
+        pre_tokenizers, processors, trainers
+    from transformers import BertConfig, BertForMaskedLM, \
+        PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.WordPiece(unk_token="[UNK]"))
+    tokenizer.normalizer = normalizers.BertNormalizer(lowercase=False)
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer.decoder = decoders.WordPiece()
+    tokenizer.train_from_iterator(tokenizer_corpus(), trainers.WordPieceTrainer(
+        vocab_size=vocab_size, special_tokens=BERT_SPECIAL_TOKENS))
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]",
+        pair="[CLS] $A [SEP] $B [SEP]",
+        special_tokens=[(token, tokenizer.token_to_id(token))
+                        for token in ["[CLS]", "[SEP]"]])
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="[PAD]", unk_token="[UNK]",
+        cls_token="[CLS]", sep_token="[SEP]", mask_token="[MASK]")
+
+    torch.manual_seed(0)
+    llm = BertForMaskedLM(BertConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=512,
+        pad_token_id=tokenizer.pad_token_id,
+    ))
+    llm.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+
+
+def benchmark_config(model_name: str, work_dir: Path, api_url: str,
+                     max_new_tokens: int, draft: bool = False) -> dict:
+    """Configuration of a model, run on the tiny local models and the Wikidata stub."""
+    prompt_templates = REPO_DIR / "prompt_templates"
+    config = {
+        "model": model_name,
+        "wikidata_api_url": api_url,
+        "disambiguation_rate_limit": 0,
+        "disambiguation_cache": False,
+        "generation_cache": False,
+    }
+    if model_name == Models.BASELINE_FILL_MASK.value:
+        config.update({
+            "llm_path": str(work_dir / "tiny-masked-lm"),
+            "prompt_templates_file": str(prompt_templates / "masked_prompts.csv"),
+            # The scores of a random model are tiny: keep all top-k candidates
+            "top_k": 5,
+            "threshold": 0.0,
+            "batch_size": 32,
+        })
+        return config
+
+    config.update({
+        "llm_path": str(work_dir / "tiny-causal-lm"),
+        "prompt_templates_file": str(prompt_templates / "question_prompts.csv"),
+        "train_data_file": str(REPO_DIR / "data" / "train.jsonl"),
+        "use_quantization": False,
+        "few_shot": 5,
+        "batch_size": 8,
+        "max_new_tokens": max_new_tokens,
+    })
+    if draft:
+        config["draft_model_path"] = str(work_dir / "tiny-draft-lm")
+    if model_name in (Models.BASELINE_LLAMA_3_CHAT.value,
+                      Models.DUAL_LLAMA_3.value):
+        config["llama_3_compatible"] = True
+    if model_name == Models.DUAL_LLAMA_3.value:
+        config.update({
+            "prompt_templates_file": str(
+                prompt_templates / "question_prompts_personas_per_entity.csv"),
+            "add_info_file": str(
+                prompt_templates / "add_info_prompts_personas_per_entity.csv"),
+            # Bounds the yearly sub-queries of awardWonBy
+            "award_max_years": 5,
+        })
+    return config
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+class BenchmarkRecorder:
+    """Counts the LLM calls and times the Wikidata lookups of a model, per relation and strategy.
+
+    The strategy of a call is the outermost strategy method it runs in; calls
+    outside of a strategy (e.g. the disambiguation of the answers) count for
+    the last strategy of the relation.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.relation = None
+        self.strategy = SINGLE_PROMPT
+        self.depth = 0
+        self.stats = {}
+
+    def current(self) -> dict:
+        return self.stats.setdefault((self.relation, self.strategy), {
+            "inputs": 0,
+            "seconds": 0.0,
+            "prompt_seconds": 0.0,
+            "llm_seconds": 0.0,
+            "disambiguation_seconds": 0.0,
+            "llm_calls": 0,
+            "prompt_tokens": 0,
+            "generated_tokens": 0,
+            "lookup_latencies": [],
+            "peak_rss_mb": 0.0,
+        })
+
+    def count_tokens(self, texts) -> int:
+        texts = list(texts)
+        if not texts:
+            return 0
+        return sum(len(ids) for ids in self.tokenizer(
+            texts, add_special_tokens=False)["input_ids"])
+
+    def wrap_strategy(self, name, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            if self.depth == 0:
+                self.strategy = name
+            self.depth += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.depth -= 1
+        return wrapper
+
+    def wrap_timer(self, field, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.current()[field] += time.perf_counter() - start
+        return wrapper
+
+    def wrap_generation(self, method):
+        """Count the prompts and tokens of the text generations."""
+        @wraps(method)
+        def wrapper(prompts, *args, **kwargs):
+            start = time.perf_counter()
+            outputs = method(prompts, *args, **kwargs)
+            stats = self.current()
+            stats["llm_seconds"] += time.perf_counter() - start
+            stats["llm_calls"] += len(prompts)
+            stats["prompt_tokens"] += sum(output[0]["prompt_tokens"]
+                                          for output in outputs)
+            stats["generated_tokens"] += sum(output[0]["completion_tokens"]
+                                             for output in outputs)
+            return outputs
+        return wrapper
+
+    def wrap_fill_mask(self, method):
+        """Count the prompts of the fill-mask pipeline, which predicts one token per prompt."""
+        @wraps(method)
+        def wrapper(prompts, *args, **kwargs):
+            start = time.perf_counter()
+            outputs = method(prompts, *args, **kwargs)
+            stats = self.current()
+            stats["llm_seconds"] += time.perf_counter() - start
+            stats["llm_calls"] += len(prompts)
+            stats["prompt_tokens"] += self.count_tokens(prompts)
+            stats["generated_tokens"] += len(prompts)
+            return outputs
+        return wrapper
+
+    def wrap_scoring(self, method):
+        """Count the prompts of the yes/no scoring, which generates no tokens."""
+        @wraps(method)
+        def wrapper(prompts, *args, **kwargs):
+            start = time.perf_counter()
+            outputs = method(prompts, *args, **kwargs)
+            stats = self.current()
+            stats["llm_seconds"] += time.perf_counter() - start
+            stats["llm_calls"] += len(prompts)
+            stats["prompt_tokens"] += self.count_tokens(prompts)
+            return outputs
+        return wrapper
+
+    def wrap_lookup(self, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.current()["lookup_latencies"].append(
+                    time.perf_counter() - start)
+        return wrapper
+
+    def instrument(self, model):
+        """Wrap the methods of a model instance that prompt, generate and disambiguate."""
+        if hasattr(model, "generate_uncached"):
+            model.generate_uncached = self.wrap_generation(
+                model.generate_uncached)
+        else:
+            model.pipe = self.wrap_fill_mask(model.pipe)
+        if hasattr(model, "score_yes_no"):
+            model.score_yes_no = self.wrap_scoring(model.score_yes_no)
+        model.create_prompt = self.wrap_timer("prompt_seconds",
+                                              model.create_prompt)
+        model.resolve_wikidata_ids = self.wrap_timer(
+            "disambiguation_seconds", model.resolve_wikidata_ids)
+        if model.wikidata_resolver is not None:
+            model.wikidata_resolver.search = self.wrap_lookup(
+                model.wikidata_resolver.search)
+        for strategy in STRATEGIES:
+            if hasattr(model, strategy + "_batch"):
+                setattr(model, strategy + "_batch", self.wrap_strategy(
+                    strategy, getattr(model, strategy + "_batch")))
+
+    def run(self, model, relation, inputs):
+        """Generate the predictions of the inputs of one relation."""
+        self.relation = relation
+        self.strategy = SINGLE_PROMPT
+        start = time.perf_counter()
+        model.generate_predictions(inputs)
+        stats = self.current()
+        stats["inputs"] += len(inputs)
+        stats["seconds"] += time.perf_counter() - start
+        stats["peak_rss_mb"] = peak_rss_mb()
+
+
+def summarize(groups) -> dict:
+    """Throughput, LLM calls and lookup latencies of some (relation, strategy) groups."""
+    total = {}
+    latencies = []
+    for stats in groups:
+        for field, value in stats.items():
+            if field == "lookup_latencies":
+                latencies.extend(value)
+            elif field == "peak_rss_mb":
+                total[field] = max(total.get(field, 0.0), value)
+            else:
+                total[field] = total.get(field, 0) + value
+
+    def rate(numerator, denominator):
+        return numerator / denominator if denominator else None
+
+    latencies = 1000 * np.array(latencies)
+    return {
+        "inputs": total["inputs"],
+        "seconds": total["seconds"],
+        "inputs_per_second": rate(total["inputs"], total["seconds"]),
+        "llm_calls": total["llm_calls"],
+        "llm_calls_per_input": rate(total["llm_calls"], total["inputs"]),
+        "prompts_per_second": rate(total["llm_calls"], total["llm_seconds"]),
+        "prompt_tokens": total["prompt_tokens"],
+        "generated_tokens": total["generated_tokens"],
+        "generated_tokens_per_second": rate(total["generated_tokens"],
+                                            total["llm_seconds"]),
+        "prompt_seconds": total["prompt_seconds"],
+        "llm_seconds": total["llm_seconds"],
+        "disambiguation_seconds": total["disambiguation_seconds"],
+        "lookups": len(latencies),
+        "lookup_latency_ms": {
+            name: float(np.percentile(latencies, q)) if len(latencies) else None
+            for name, q in [("p50", 50), ("p90", 90), ("p99", 99),
+                            ("max", 100)]
+        },
+        "peak_rss_mb": total["peak_rss_mb"],
+    }
+
+
+def run_worker(config_file: str, input_file: str, seed: int):
+    """Run one model on the inputs, relation by relation, and print its results."""
+    import torch
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    start = time.perf_counter()
+    model = Models.get_model(config["model"])(config)
+    load_seconds = time.perf_counter() - start
+    load_rss_mb = peak_rss_mb()
+
+    inputs_per_relation = {}
+    for row in iter_jsonl(input_file):
+        inputs_per_relation.setdefault(row["Relation"], []).append(row)
+
+    recorder = BenchmarkRecorder(model.tokenizer)
+    recorder.instrument(model)
+    for relation, inputs in inputs_per_relation.items():
+        logger.info(f"Benchmarking `{relation}` ({len(inputs):,} inputs)...")
+        recorder.run(model, relation, inputs)
+
+    strategies = sorted({strategy for _, strategy in recorder.stats})
+    speculative = getattr(model, "speculative", None)
+    print(json.dumps({
+        "load_seconds": load_seconds,
+        "speculative": speculative.summary() if speculative else None,
+        "load_peak_rss_mb": load_rss_mb,
+        "total": summarize(recorder.stats.values()),
+        "relations": {
+            relation: summarize(stats for (r, _), stats in recorder.stats.items()
+                                if r == relation)
+            for relation in inputs_per_relation
+        },
+        "strategies": {
+            strategy: summarize(stats for (_, s), stats in recorder.stats.items()
+                                if s == strategy)
+            for strategy in strategies
+        },
+    }))
+
+
+def select_inputs(input_file, num_inputs: int):
+    """The first `num_inputs` rows of every relation, with empty external information if it is missing."""
+    counts = {}
+    for row in iter_jsonl(input_file):
+        counts[row["Relation"]] = counts.get(row["Relation"], 0) + 1
+        if counts[row["Relation"]] <= num_inputs:
+            for field in INFO_FIELDS:
+                row.setdefault(field, None)
+            yield row
+
+
+def benchmark_title_stripping(input_files) -> dict:
+    """Time the title stripping of the dual model on the object strings of the files.
+
+    The strings go through spaCy one at a time with the full pipeline, as
+    before the NER was batched, and then through `remove_titles_batch`, with
+    an empty memo and again memoized. Returns the seconds per 1k entities.
+    """
+    import spacy
+    from models import dual_llama_3_model
+
+    texts = [str(entity).strip() for file in input_files
+             for row in iter_jsonl(file)
+             for entity in row.get("ObjectEntities") or []]
+    logger.info(f"Stripping the titles of {len(texts):,} entities "
+                f"({len(set(texts)):,} unique)...")
+
+    nlp = spacy.load("en_core_web_sm")
+    start = time.perf_counter()
+    one_by_one = []
+    for text in texts:
+        names = " ".join(ent.text for ent in nlp(text).ents
+                         if ent.label_ == "PERSON")
+        one_by_one.append(names or text)
+    per_entity = time.perf_counter() - start
+
+    dual_llama_3_model.cleaned_names.clear()
+    dual_llama_3_model.get_nlp()
+    start = time.perf_counter()
+    batched = dual_llama_3_model.remove_titles_batch(texts)
+    batch = time.perf_counter() - start
+    start = time.perf_counter()
+    dual_llama_3_model.remove_titles_batch(texts)
+    memoized = time.perf_counter() - start
+
+    differences = sum(a != b for a, b in zip(batched, one_by_one))
+    if differences:
+        # e.g. the sentence boundaries of the parser, which the batched NER does not run, split a name
+        logger.warning(f"The batched title stripping differs from the "
+                       f"per-entity one for {differences:,} entities.")
+    per_1k = 1000 / len(texts) if texts else 0.0
+    return {
+        "entities": len(texts),
+        "unique_entities": len(set(texts)),
+        "per_entity_seconds_per_1k": per_entity * per_1k,
+        "batched_seconds_per_1k": batch * per_1k,
+        "memoized_seconds_per_1k": memoized * per_1k,
+        "differences": differences,
+    }
+
+
+def format_rate(value, digits=1):
+    return f"{value:.{digits}f}" if value is not None else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the throughput of every model offline, with "
+                    "tiny random models and a local Wikidata stub")
+
+    parser.add_argument(
+        "-m", "--models",
+        type=str,
+        nargs="+",
+        default=[m.value for m in Models],
+        help="Models to benchmark (default: all)"
+    )
+    parser.add_argument(
+        "-i", "--input_file",
+        type=str,
+        default="data/val.jsonl",
+        help="Input file the benchmark rows are taken from"
+    )
+    parser.add_argument(
+        "-n", "--num_inputs",
+        type=int,
+        default=8,
+        help="Number of input rows per relation (default: 8)"
+    )
+    parser.add_argument(
+        "-o", "--output_file",
+        type=str,
+        default="output/benchmark.json",
+        help="JSON file the results are written to"
+    )
+    parser.add_argument(
+        "--extra_config",
+        type=str,
+        default=None,
+        help="YAML file with options added to the configuration of every "
+             "model (e.g. prefix_caching: true)"
+    )
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=32,
+        help="Maximum number of generated tokens per prompt (default: 32)"
+    )
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="Generate with speculative decoding, drafted by a one-layer "
+             "copy of the tiny causal LM"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Artificial latency of the Wikidata stub per request in seconds"
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default="cache/benchmark",
+        help="Directory of the tiny models, configurations and inputs"
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Rebuild the tiny models even if they exist"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the few-shot sampling and generation (default: 0)"
+    )
+    parser.add_argument(
+        "--titles",
+        action="store_true",
+        help="Benchmark the title stripping of the dual model per entity "
+             "and batched, on the object strings of the train and input "
+             "files, instead of the models"
+    )
+    parser.add_argument(
+        "--worker",
+        type=str,
+        help=argparse.SUPPRESS
+    )
+
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.input_file, args.seed)
+        return
+
+    if args.titles:
+        titles = benchmark_title_stripping(
+            [REPO_DIR / "data" / "train.jsonl", args.input_file])
+        output_file = Path(args.output_file)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_file, "w") as f:
+            json.dump({"title_stripping": titles}, f, indent=2)
+        logger.info(
+            f"Title stripping of {titles['entities']:,} entities: "
+            f"{titles['per_entity_seconds_per_1k']:.2f} s per 1k entities "
+            f"one at a time, {titles['batched_seconds_per_1k']:.2f} s "
+            f"batched, {titles['memoized_seconds_per_1k']:.3f} s memoized.")
+        return
+
+    work_dir = Path(args.work_dir).resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    # Tiny randomly initialized models, built once
+    for name, build in [("tiny-causal-lm", build_tiny_causal_lm),
+                        ("tiny-draft-lm", build_tiny_draft_lm),
+                        ("tiny-masked-lm", build_tiny_masked_lm)]:
+        if args.rebuild or not (work_dir / name / "config.json").exists():
+            logger.info(f"Building the model `{work_dir / name}`...")
+            build(work_dir / name)
+
+    input_file = work_dir / "inputs.jsonl"
+    with open(input_file, "w") as f:
+        for row in select_inputs(args.input_file, args.num_inputs):
+            f.write(json.dumps(row) + "\n")
+
+    extra_config = {}
+    if args.extra_config:
+        with open(args.extra_config) as f:
+            extra_config = yaml.safe_load(f) or {}
+
+    # Local stand-in for the Wikidata search API, knowing the train and input labels
+    labels = read_labels(REPO_DIR / "data" / "train.jsonl")
+    labels.update(read_labels(args.input_file))
+    server = make_server(labels, latency=args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    api_url = f"http://{host}:{port}/w/api.php"
+
+    results = {}
+    for model_name in args.models:
+        config = {**benchmark_config(model_name, work_dir, api_url,
+                                     args.max_new_tokens, args.draft),
+                  **extra_config}
+        config_file = work_dir / f"{model_name}.yaml"
+        with open(config_file, "w") as f:
+            yaml.safe_dump(config, f)
+
+        logger.info(f"Benchmarking `{model_name}`...")
+        command = [sys.executable, __file__, "--worker", str(config_file),
+                   "-i", str(input_file), "--seed", str(args.seed)]
+        process = subprocess.run(command, capture_output=True, text=True,
+                                 cwd=REPO_DIR)
+        if process.returncode != 0:
+            error = process.stderr.strip().splitlines()
+            error = error[-1] if error else f"exit code {process.returncode}"
+            logger.error(f"`{model_name}` failed: {error}")
+            results[model_name] = {"config": config, "error": error}
+            continue
+        results[model_name] = {
+            "config": config,
+            **json.loads(process.stdout.strip().splitlines()[-1])
+        }
+
+    server.shutdown()
+    server.server_close()
+
+    output_file = Path(args.output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, "w") as f:
+        json.dump({
+            "settings": {
+                "input_file": args.input_file,
+                "num_inputs": args.num_inputs,
+                "max_new_tokens": args.max_new_tokens,
+                "draft": args.draft,
+                "latency": args.latency,
+                "seed": args.seed,
+                "extra_config": extra_config,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "models": results,
+        }, f, indent=2)
+    logger.info(f"Saved the results to `{output_file}`.")
+
+    # Summary per model and strategy
+    logger.info(f"{'Model':<20}  {'Strategy':<19}  {'Inputs':>6}  "
+                f"{'Prompts/s':>9}  {'Tokens/s':>9}  {'Calls/input':>11}  "
+                f"{'Lookup p50/p99 ms':>17}  {'Peak RSS MB':>11}")
+    for model_name, result in results.items():
+        if "error" in result:
+            logger.info(f"{model_name:<20}  failed")
+            continue
+        for strategy, stats in result["strategies"].items():
+            latency = stats["lookup_latency_ms"]
+            lookups = (f"{format_rate(latency['p50'])}/"
+                       f"{format_rate(latency['p99'])}")
+            logger.info(
+                f"{model_name:<20}  {strategy:<19}  {stats['inputs']:>6}  "
+                f"{format_rate(stats['prompts_per_second']):>9}  "
+                f"{format_rate(stats['generated_tokens_per_second']):>9}  "
+                f"{format_rate(stats['llm_calls_per_input'], 2):>11}  "
+                f"{lookups:>17}  {stats['peak_rss_mb']:>11.0f}")
+        speculative = result.get("speculative")
+        if speculative and speculative["prompts"]:
+            logger.info(
+                f"{model_name:<20}  draft acceptance rate "
+                f"{format_rate(100 * (speculative['acceptance_rate'] or 0))}%, "
+                f"{format_rate(speculative['tokens_per_target_forward'], 2)} "
+                f"tokens per forward pass")
+
+
+if __name__ == "__main__":
+    main()
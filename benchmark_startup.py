@@ -0,0 +1,128 @@
+import argparse
+import inspect
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import yaml
+from loguru import logger
+
+START_TIME_VARIABLE = "BENCHMARK_START_TIME"
+
+
+def run_worker(config_file: str, input_file: str, import_only: bool):
+    """Go through the startup of baseline.py and print the time of every phase."""
+    start = float(os.environ[START_TIME_VARIABLE])
+    timings = {"interpreter": time.time() - start}
+
+    from models.user_config import Models
+    timings["registry"] = time.time() - start
+
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    model_class = Models.get_model(config["model"])
+    timings["model_import"] = time.time() - start
+
+    if not import_only:
+        model = model_class(config)
+        timings["model_init"] = time.time() - start
+
+        with open(input_file) as f:
+            row = json.loads(f.readline())
+        arguments = {
+            "subject_entity": row["SubjectEntity"],
+            "relation": row["Relation"],
+            "entity_entry": row,
+            "info_strategy": [],
+            "stage": 0,
+        }
+        parameters = inspect.signature(model.create_prompt).parameters
+        model.create_prompt(**{k: v for k, v in arguments.items()
+                               if k in parameters})
+        timings["first_prompt"] = time.time() - start
+
+    print(json.dumps(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the startup latency of every model configuration")
+
+    parser.add_argument(
+        "-c", "--config_files",
+        type=str,
+        nargs="+",
+        default=sorted(str(p) for p in
+                       (Path(__file__).resolve().parent / "configs").glob("*.yaml")),
+        help="Configuration files to benchmark (default: configs/*.yaml)"
+    )
+    parser.add_argument(
+        "-i", "--input_file",
+        type=str,
+        default="data/val.jsonl",
+        help="Input file whose first row is used for the first prompt"
+    )
+    parser.add_argument(
+        "-r", "--repeat",
+        type=int,
+        default=3,
+        help="Number of runs per configuration; the fastest is reported"
+    )
+    parser.add_argument(
+        "--import_only",
+        action="store_true",
+        help="Only measure the imports, without loading the models"
+    )
+    parser.add_argument(
+        "--worker",
+        type=str,
+        help=argparse.SUPPRESS
+    )
+
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.input_file, args.import_only)
+        return
+
+    phases = ["interpreter", "registry", "model_import"]
+    if not args.import_only:
+        phases += ["model_init", "first_prompt"]
+
+    results = {}
+    for config_file in args.config_files:
+        logger.info(f"Benchmarking `{config_file}`...")
+        best = None
+        for _ in range(args.repeat):
+            command = [sys.executable, __file__, "--worker", config_file,
+                       "-i", args.input_file]
+            if args.import_only:
+                command.append("--import_only")
+            env = {**os.environ, START_TIME_VARIABLE: repr(time.time())}
+            process = subprocess.run(command, env=env, capture_output=True,
+                                     text=True)
+            if process.returncode != 0:
+                error = process.stderr.strip().splitlines()
+                logger.error(f"`{config_file}` failed: "
+                             f"{error[-1] if error else process.returncode}")
+                break
+            timings = json.loads(process.stdout.strip().splitlines()[-1])
+            if best is None or timings[phases[-1]] < best[phases[-1]]:
+                best = timings
+        results[config_file] = best
+
+    # Cumulative seconds from the CLI start to the end of every phase
+    name_width = max(len(Path(c).stem) for c in results)
+    logger.info(f"{'Config':<{name_width}}  " +
+                "  ".join(f"{phase:>12}" for phase in phases))
+    for config_file, timings in results.items():
+        logger.info(f"{Path(config_file).stem:<{name_width}}  " + "  ".join(
+            f"{timings[phase]:>12.2f}" if timings else f"{'failed':>12}"
+            for phase in phases))
+
+
+if __name__ == "__main__":
+    main()
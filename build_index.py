@@ -0,0 +1,41 @@
+import argparse
+
+from loguru import logger
+
+from models.local_index import build_index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build an offline Wikidata label-to-QID index")
+
+    parser.add_argument(
+        "-i", "--input_files",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Wikidata JSON dump subsets (optionally .gz/.bz2) "
+             "or TSV files with `label<TAB>QID[<TAB>score]` lines"
+    )
+    parser.add_argument(
+        "-o", "--output_dir",
+        type=str,
+        required=True,
+        help="Directory to write the index to"
+    )
+    parser.add_argument(
+        "-l", "--language",
+        type=str,
+        default="en",
+        help="Language of the labels and aliases to index (default: en)"
+    )
+
+    args = parser.parse_args()
+
+    build_index(args.input_files, args.output_dir, language=args.language)
+
+    logger.info("Done!")
+
+
+if __name__ == "__main__":
+    main()
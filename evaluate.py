@@ -1,10 +1,18 @@
 import argparse
+import glob
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from operator import itemgetter
 from pathlib import Path
-from typing import List, Dict, Union
+from typing import Dict, Iterator, List, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
+ALL_RELATIONS = "*** All Relations ***"
+
 
 def read_jsonl_file(file_path: Union[str, Path]) -> List[Dict]:
     with open(file_path, "r") as f:
@@ -208,6 +216,395 @@ def prediction_statistics(scores_per_sr: List[Dict[str, float]]) -> dict:
     return final_stats
 
 
+def flatten_ids(id_lists: List[List]) -> Tuple[np.ndarray, list]:
+    """The number of IDs of every list and all IDs in one flat list."""
+    lengths = np.fromiter(map(len, id_lists), dtype=np.int64,
+                          count=len(id_lists))
+    return lengths, list(chain.from_iterable(id_lists))
+
+
+def sorted_unique(values: np.ndarray) -> np.ndarray:
+    values = np.sort(values)
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+
+def count_scores(pred_pairs: np.ndarray, pred_codes: np.ndarray,
+                 gt_pairs: np.ndarray, gt_codes: np.ndarray,
+                 num_codes: int, num_pairs: int) -> Dict[str, np.ndarray]:
+    """Compute the scores of every pair from the (pair, ID code) combinations of the predictions and ground truth.
+
+    Every (pair, ID) combination is encoded to one integer key, so that the
+    true positives of all pairs are counted with a single sorted
+    intersection. Returns arrays of p, r, f1, tp, total_pred and total_gt,
+    with the same values as `precision`, `recall` and `f1_score`.
+    """
+    num_codes = max(num_codes, 1)
+    # Unique keys, as the IDs of a row are deduplicated
+    pred_keys = sorted_unique(pred_pairs * num_codes + pred_codes)
+    gt_keys = sorted_unique(gt_pairs * num_codes + gt_codes)
+
+    total_pred = np.bincount(pred_keys // num_codes, minlength=num_pairs)
+    total_gt = np.bincount(gt_keys // num_codes, minlength=num_pairs)
+    tp = np.bincount(
+        np.intersect1d(pred_keys, gt_keys, assume_unique=True) // num_codes,
+        minlength=num_pairs)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = np.where(total_pred == 0, 1.0,
+                     np.minimum(tp / total_pred, 1.0))
+        r = np.where(total_gt == 0, 1.0, np.minimum(tp / total_gt, 1.0))
+        f1 = np.where(p + r == 0, 0.0, (2 * p * r) / (p + r))
+
+    return {"p": p, "r": r, "f1": f1, "tp": tp,
+            "total_pred": total_pred, "total_gt": total_gt}
+
+
+def score_id_lists(pred_ids: List[List], gt_ids: List[List]) \
+        -> Dict[str, np.ndarray]:
+    """Compute the scores of aligned lists of predicted and ground truth IDs."""
+    num_pairs = len(gt_ids)
+    pred_lengths, pred_flat = flatten_ids(pred_ids)
+    gt_lengths, gt_flat = flatten_ids(gt_ids)
+
+    codes, uniques = pd.factorize(pd.Series(pred_flat + gt_flat,
+                                            dtype=object))
+    codes = codes.astype(np.int64)
+
+    pairs = np.arange(num_pairs, dtype=np.int64)
+    return count_scores(np.repeat(pairs, pred_lengths), codes[:len(pred_flat)],
+                        np.repeat(pairs, gt_lengths), codes[len(pred_flat):],
+                        len(uniques), num_pairs)
+
+
+def rows_to_ids(rows: List[Dict]) -> Dict:
+    """Index the IDs of the rows by subject entity and relation (the last row of a pair wins)."""
+    return {(r["SubjectEntity"], r["Relation"]): r["ObjectEntitiesID"]
+            for r in rows}
+
+
+class GroundTruthIndex:
+    """The ground truth pairs with their IDs encoded to integers.
+
+    Built once, it scores any number of prediction files against the same
+    ground truth.
+    """
+
+    def __init__(self, gt_rows: List[Dict]):
+        gt_dict = rows_to_ids(gt_rows)
+        self.keys = sorted(gt_dict, key=itemgetter(1, 0))
+        lengths, flat = flatten_ids(list(map(gt_dict.__getitem__, self.keys)))
+
+        codes, uniques = pd.factorize(pd.Series(flat, dtype=object))
+        self.ids = pd.Index(uniques)
+        self.gt_codes = codes.astype(np.int64)
+        self.gt_pairs = np.repeat(np.arange(len(self.keys), dtype=np.int64),
+                                  lengths)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def score(self, pred_rows: List[Dict]) -> pd.DataFrame:
+        """Vectorized `evaluate_per_sr_pair`: one row of scores per Subject-Relation pair."""
+        pred_dict = rows_to_ids(pred_rows)
+        lengths, flat = flatten_ids(list(map(pred_dict.__getitem__,
+                                             self.keys)))
+
+        # IDs that are not in the ground truth get new codes
+        flat = pd.Series(flat, dtype=object)
+        codes = self.ids.get_indexer(flat)
+        unknown = codes < 0
+        unknown_codes, unknown_ids = pd.factorize(flat[unknown])
+        codes[unknown] = len(self.ids) + unknown_codes
+
+        scores = count_scores(
+            np.repeat(np.arange(len(self.keys), dtype=np.int64), lengths),
+            codes.astype(np.int64), self.gt_pairs, self.gt_codes,
+            len(self.ids) + len(unknown_ids), len(self.keys))
+
+        return pd.DataFrame({
+            "SubjectEntity": [key[0] for key in self.keys],
+            "Relation": [key[1] for key in self.keys],
+            **scores,
+        })
+
+
+def score_sr_pairs(pred_rows: List[Dict], gt_rows: List[Dict]) -> pd.DataFrame:
+    """Vectorized `evaluate_per_sr_pair`: one row of scores per Subject-Relation pair."""
+    return GroundTruthIndex(gt_rows).score(pred_rows)
+
+
+def relation_sums(scores: pd.DataFrame) -> pd.DataFrame:
+    """Sum the scores of the Subject-Relation pairs per relation."""
+    codes, relations = pd.factorize(scores["Relation"])
+    num_relations = len(relations)
+
+    def grouped_sum(values):
+        return np.bincount(codes, weights=np.asarray(values, dtype=np.float64),
+                           minlength=num_relations)
+
+    return pd.DataFrame({
+        "p": grouped_sum(scores["p"]),
+        "r": grouped_sum(scores["r"]),
+        "f1": grouped_sum(scores["f1"]),
+        "tp": grouped_sum(scores["tp"]),
+        "total_pred": grouped_sum(scores["total_pred"]),
+        "total_gt": grouped_sum(scores["total_gt"]),
+        "num_sr_pairs": np.bincount(codes, minlength=num_relations),
+        "empty_pred": grouped_sum(scores["total_pred"] == 0),
+    }, index=pd.Index(relations, name="Relation"))
+
+
+def summary_table(sums: pd.DataFrame) -> pd.DataFrame:
+    """Macro and micro averages and prediction statistics per relation and for all relations."""
+    sums = sums.sort_index()
+    sums.loc[ALL_RELATIONS] = sums.sum()
+
+    pairs = sums["num_sr_pairs"]
+    tp, total_pred, total_gt = (sums[column].to_numpy() for column in
+                                ("tp", "total_pred", "total_gt"))
+    micro_p = np.divide(tp, total_pred, out=np.ones(len(sums)),
+                        where=total_pred > 0)
+    micro_r = np.divide(tp, total_gt, out=np.ones(len(sums)),
+                        where=total_gt > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        micro_f1 = np.where(micro_p + micro_r == 0, 0.0,
+                            (2 * micro_p * micro_r) / (micro_p + micro_r))
+
+    return pd.DataFrame({
+        "macro-p": sums["p"] / pairs,
+        "macro-r": sums["r"] / pairs,
+        "macro-f1": sums["f1"] / pairs,
+        "micro-p": micro_p,
+        "micro-r": micro_r,
+        "micro-f1": micro_f1,
+        "avg. #preds": sums["total_pred"] / pairs,
+        "#empty preds": sums["empty_pred"].astype(int),
+    }, index=pd.Index(list(sums.index)))
+
+
+METRICS = ["macro-p", "macro-r", "macro-f1", "micro-p", "micro-r", "micro-f1"]
+SCORE_COLUMNS = ["p", "r", "f1", "tp", "total_pred", "total_gt"]
+
+
+def metrics_from_sums(sums: np.ndarray, num_pairs: int) -> Dict[str, np.ndarray]:
+    """Macro and micro P/R/F1 from sums of the SCORE_COLUMNS (in the last axis) over `num_pairs` pairs."""
+    p, r, f1, tp, total_pred, total_gt = np.moveaxis(sums, -1, 0)
+    micro_p = np.divide(tp, total_pred, out=np.ones_like(tp),
+                        where=total_pred > 0)
+    micro_r = np.divide(tp, total_gt, out=np.ones_like(tp),
+                        where=total_gt > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        micro_f1 = np.where(micro_p + micro_r == 0, 0.0,
+                            (2 * micro_p * micro_r) / (micro_p + micro_r))
+    return {
+        "macro-p": p / num_pairs,
+        "macro-r": r / num_pairs,
+        "macro-f1": f1 / num_pairs,
+        "micro-p": micro_p,
+        "micro-r": micro_r,
+        "micro-f1": micro_f1,
+    }
+
+
+def bootstrap_sums(values: np.ndarray, num_resamples: int,
+                   rng: np.random.Generator,
+                   max_block_size: int = 4_000_000) -> np.ndarray:
+    """Sum the rows of `values` over `num_resamples` resamples with replacement.
+
+    The resampled row indices are turned into counts per row, so the sums of
+    a block of resamples are a single matrix product. Returns an array of
+    shape (num_resamples, number of columns).
+    """
+    num_rows = len(values)
+    sums = np.empty((num_resamples, values.shape[1]))
+    block = max(1, max_block_size // max(num_rows, 1))
+    for start in range(0, num_resamples, block):
+        size = min(block, num_resamples - start)
+        indices = rng.integers(0, num_rows, (size, num_rows))
+        indices += np.arange(size)[:, None] * num_rows
+        counts = np.bincount(indices.ravel(), minlength=size * num_rows)
+        sums[start:start + size] = counts.reshape(size, num_rows) @ values
+    return sums
+
+
+def bootstrap_metrics(scores: List[pd.DataFrame], num_resamples: int,
+                      seed: int = 0) -> Dict[str, List[Dict[str, np.ndarray]]]:
+    """Bootstrap the metrics of one or more systems scored on the same pairs.
+
+    The pairs are resampled within every relation, and the resamples of the
+    relations are combined for all relations. All systems share the same
+    resamples, so their differences can be tested in pairs. Returns, per
+    relation, the resampled metrics of every system.
+    """
+    rng = np.random.default_rng(seed)
+    relations = scores[0]["Relation"].to_numpy()
+    values = np.concatenate([s[SCORE_COLUMNS].to_numpy(dtype=np.float64)
+                             for s in scores], axis=1)
+    num_columns = len(SCORE_COLUMNS)
+
+    resampled = {}
+    total = np.zeros((num_resamples, values.shape[1]))
+    for relation in sorted(set(relations)):
+        rows = values[relations == relation]
+        sums = bootstrap_sums(rows, num_resamples, rng)
+        total += sums
+        resampled[relation] = (sums, len(rows))
+    resampled[ALL_RELATIONS] = (total, len(values))
+
+    return {
+        relation: [metrics_from_sums(
+            sums[:, i * num_columns:(i + 1) * num_columns], num_pairs)
+            for i in range(len(scores))]
+        for relation, (sums, num_pairs) in resampled.items()
+    }
+
+
+def bootstrap_table(scores: pd.DataFrame, num_resamples: int,
+                    confidence: float = 0.95, seed: int = 0) -> pd.DataFrame:
+    """Point estimates with bootstrap confidence intervals per relation."""
+    point = summary_table(relation_sums(scores))
+    resampled = bootstrap_metrics([scores], num_resamples, seed=seed)
+    alpha = (1 - confidence) / 2
+
+    table = {}
+    for relation, [metrics] in resampled.items():
+        table[relation] = {
+            metric: f"{point.loc[relation, metric]:.3f} "
+                    f"[{np.quantile(metrics[metric], alpha):.3f}, "
+                    f"{np.quantile(metrics[metric], 1 - alpha):.3f}]"
+            for metric in METRICS
+        }
+    return pd.DataFrame.from_dict(table, orient="index")
+
+
+def paired_test_table(scores_a: pd.DataFrame, scores_b: pd.DataFrame,
+                      metric: str = "macro-f1", num_resamples: int = 10_000,
+                      confidence: float = 0.95, seed: int = 0) -> pd.DataFrame:
+    """Paired bootstrap test of the difference B - A of a metric per relation.
+
+    The p-value is two-sided: twice the share of resamples in which the
+    difference has the other sign than the observed one (at most 1).
+    """
+    point_a = summary_table(relation_sums(scores_a))
+    point_b = summary_table(relation_sums(scores_b))
+    resampled = bootstrap_metrics([scores_a, scores_b], num_resamples,
+                                  seed=seed)
+    alpha = (1 - confidence) / 2
+
+    table = {}
+    for relation, (metrics_a, metrics_b) in resampled.items():
+        diffs = metrics_b[metric] - metrics_a[metric]
+        p_value = min(1.0, 2 * min(np.mean(diffs <= 0), np.mean(diffs >= 0)))
+        table[relation] = {
+            "A": point_a.loc[relation, metric],
+            "B": point_b.loc[relation, metric],
+            "B - A": point_b.loc[relation, metric] -
+                     point_a.loc[relation, metric],
+            f"{confidence:.0%} CI": f"[{np.quantile(diffs, alpha):.3f}, "
+                                    f"{np.quantile(diffs, 1 - alpha):.3f}]",
+            "p-value": p_value,
+        }
+    return pd.DataFrame.from_dict(table, orient="index")
+
+
+# Ground truth index of the worker processes of `evaluate_runs`
+worker_index = None
+
+
+def init_worker(gt_index: GroundTruthIndex):
+    global worker_index
+    worker_index = gt_index
+
+
+def evaluate_run(pred_file: Union[str, Path]) -> pd.DataFrame:
+    return summary_table(relation_sums(
+        worker_index.score(read_jsonl_file(pred_file))))
+
+
+def run_names(pred_files: List[str]) -> List[str]:
+    """Name every run by the stem of its file, or its path if stems are shared."""
+    stems = [Path(f).stem for f in pred_files]
+    return [stem if stems.count(stem) == 1 else str(f)
+            for stem, f in zip(stems, pred_files)]
+
+
+def evaluate_runs(pred_files: List[str], gt_rows: List[Dict],
+                  workers: int = None) -> Dict[str, pd.DataFrame]:
+    """Evaluate several prediction files against one ground truth index, in parallel processes."""
+    gt_index = GroundTruthIndex(gt_rows)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(gt_index,)) as executor:
+        summaries = list(executor.map(evaluate_run, pred_files))
+    return dict(zip(run_names(pred_files), summaries))
+
+
+def leaderboard_table(summaries: Dict[str, pd.DataFrame],
+                      reference: str) -> pd.DataFrame:
+    """One row per run and relation with the metrics and their deltas against the reference run."""
+    runs = pd.concat(summaries, names=["Run", "Relation"])[METRICS]
+    deltas = runs - summaries[reference][METRICS].reindex(
+        runs.index.get_level_values("Relation")).to_numpy()
+    return pd.concat([runs, deltas.add_prefix("delta ")], axis=1)
+
+
+def read_sorted_pairs(file_path: Union[str, Path]) -> Iterator[Tuple[Tuple[str, str], List]]:
+    """Lazily read ((Relation, SubjectEntity), IDs) pairs from a JSONL file sorted by relation and subject.
+
+    Of consecutive rows with the same pair, the last one wins.
+    """
+    previous = None
+    with open(file_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            key = (row["Relation"], row["SubjectEntity"])
+            if previous is not None and key != previous[0]:
+                if key < previous[0]:
+                    raise ValueError(
+                        f"`{file_path}` is not sorted by relation and subject "
+                        f"entity: {key} follows {previous[0]}.")
+                yield previous
+            previous = (key, row["ObjectEntitiesID"])
+    if previous is not None:
+        yield previous
+
+
+def merge_join(pred_file: Union[str, Path], gt_file: Union[str, Path]) \
+        -> Iterator[Tuple[Tuple[str, str], List, List]]:
+    """Join sorted prediction and ground truth files in one pass, yielding (pair, predicted IDs, ground truth IDs)."""
+    preds = read_sorted_pairs(pred_file)
+    pred = next(preds, None)
+    for key, gt_ids in read_sorted_pairs(gt_file):
+        while pred is not None and pred[0] < key:
+            pred = next(preds, None)
+        if pred is None or pred[0] != key:
+            raise KeyError((key[1], key[0]))
+        yield key, pred[1], gt_ids
+
+
+def evaluate_sorted_files(pred_file: Union[str, Path],
+                          gt_file: Union[str, Path],
+                          chunk_size: int = 100_000) -> pd.DataFrame:
+    """Evaluate sorted files with a streaming merge-join, holding at most `chunk_size` pairs in memory."""
+    sums = None
+    joined = merge_join(pred_file, gt_file)
+    while True:
+        chunk = list(islice(joined, chunk_size))
+        if not chunk:
+            break
+        scores = pd.DataFrame({
+            "Relation": [key[0] for key, _, _ in chunk],
+            **score_id_lists([preds for _, preds, _ in chunk],
+                             [gts for _, _, gts in chunk]),
+        })
+        chunk_sums = relation_sums(scores)
+        sums = chunk_sums if sums is None else sums.add(chunk_sums,
+                                                        fill_value=0)
+
+    return summary_table(sums)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Evaluate Precision, Recall and F1-score of predictions")
@@ -215,8 +612,7 @@ def main():
     parser.add_argument(
         "-p", "--predictions",
         type=str,
-        required=True,
-        help="Path to the predictions file (required)"
+        help="Path to the predictions file (required unless --runs is given)"
     )
     parser.add_argument(
         "-g", "--ground_truth",
@@ -225,32 +621,148 @@ def main():
         help="Path to the ground truth file (required)"
     )
 
-    args = parser.parse_args()
-
-    # Read the predictions and ground truth
-    pred_rows = read_jsonl_file(args.predictions)
-    gt_rows = read_jsonl_file(args.ground_truth)
-
-    # Evaluate the predictions
-    scores_per_sr_pair = evaluate_per_sr_pair(pred_rows, gt_rows)
-
-    # Macro average
-    macro_per_relation = macro_average_per_relation(scores_per_sr_pair)
-    macro_df = pd.DataFrame(macro_per_relation).transpose().round(3)
+    parser.add_argument(
+        "--sorted",
+        action="store_true",
+        help="Stream both files with a merge-join; they must be sorted by "
+             "Relation and SubjectEntity"
+    )
 
-    # Micro average
-    micro_per_relation = micro_average_per_relation(scores_per_sr_pair)
-    micro_df = pd.DataFrame(micro_per_relation).transpose().round(3)
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Number of bootstrap resamples of the Subject-Relation pairs for "
+             "confidence intervals (default: 0, no intervals)"
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        help="Path to a second predictions file to compare with the first one "
+             "in a paired bootstrap test"
+    )
+    parser.add_argument(
+        "--metric",
+        type=str,
+        default="macro-f1",
+        choices=METRICS,
+        help="Metric of the paired test and the leaderboard ranking "
+             "(default: macro-f1)"
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the intervals (default: 0.95)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed of the bootstrap resamples"
+    )
 
-    # Statistics
-    stats = prediction_statistics(scores_per_sr_pair)
-    stats_df = pd.DataFrame(stats).transpose().round(3)
-    stats_df["#empty preds"] = stats_df["#empty preds"].astype(int)
+    parser.add_argument(
+        "--runs",
+        type=str,
+        nargs="+",
+        help="Glob patterns of prediction files to rank in one leaderboard, "
+             "e.g. 'output/*.jsonl'"
+    )
+    parser.add_argument(
+        "--reference",
+        type=str,
+        help="Run (file name stem or path) the leaderboard deltas are computed "
+             "against (default: the first run)"
+    )
+    parser.add_argument(
+        "--leaderboard",
+        type=str,
+        help="Path to save the leaderboard to (.csv or .json)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=min(8, os.cpu_count() or 1),
+        help="Number of processes scoring the runs in parallel"
+    )
 
-    # Combine the results
-    results = pd.concat([macro_df, micro_df, stats_df], axis=1)
+    args = parser.parse_args()
+    if not args.predictions and not args.runs:
+        parser.error("either -p/--predictions or --runs is required")
+    if args.sorted and (args.bootstrap or args.compare):
+        parser.error("--bootstrap and --compare need the scores of every "
+                     "pair and cannot be used with --sorted")
+
+    if args.runs:
+        pred_files = sorted({f for pattern in args.runs
+                             for f in glob.glob(pattern)})
+        if not pred_files:
+            parser.error(f"no prediction files match {args.runs}")
+        summaries = evaluate_runs(pred_files,
+                                  read_jsonl_file(args.ground_truth),
+                                  workers=args.workers)
+
+        names = list(summaries)
+        reference = args.reference or names[0]
+        if reference not in summaries:
+            reference = dict(zip(pred_files, names)).get(
+                reference, run_names([reference])[0])
+        if reference not in summaries:
+            parser.error(f"reference run `{args.reference}` not found")
+
+        leaderboard = leaderboard_table(summaries, reference)
+        if args.leaderboard:
+            if args.leaderboard.endswith(".json"):
+                leaderboard.reset_index().to_json(args.leaderboard,
+                                                  orient="records", indent=2)
+            else:
+                leaderboard.to_csv(args.leaderboard)
+
+        # Runs ranked by the chosen metric over all relations
+        ranking = leaderboard[args.metric].unstack("Relation")
+        deltas = leaderboard[f"delta {args.metric}"].unstack("Relation")
+        order = ranking[ALL_RELATIONS].sort_values(ascending=False).index
+        print(f"{args.metric} per run and relation:")
+        print(ranking.loc[order].round(3).to_string())
+        print(f"\nDelta of {args.metric} against `{reference}`:")
+        print(deltas.loc[order].round(3).to_string())
+        return
+
+    if args.compare:
+        gt_rows = read_jsonl_file(args.ground_truth)
+        scores_a = score_sr_pairs(read_jsonl_file(args.predictions), gt_rows)
+        scores_b = score_sr_pairs(read_jsonl_file(args.compare), gt_rows)
+        results = paired_test_table(
+            scores_a, scores_b, metric=args.metric,
+            num_resamples=args.bootstrap or 10_000,
+            confidence=args.confidence, seed=args.seed)
+        print(f"A: {args.predictions}\nB: {args.compare}\n"
+              f"Paired bootstrap test of {args.metric}:")
+        print(results.round(3).to_string())
+        return
+
+    if args.sorted:
+        results = evaluate_sorted_files(args.predictions, args.ground_truth)
+    else:
+        # Read the predictions and ground truth
+        pred_rows = read_jsonl_file(args.predictions)
+        gt_rows = read_jsonl_file(args.ground_truth)
+
+        # Evaluate the predictions per pair and aggregate them per relation
+        scores_per_sr_pair = score_sr_pairs(pred_rows, gt_rows)
+        results = summary_table(relation_sums(scores_per_sr_pair))
+
+    results = results.round(3)
     print(results)
 
+    if args.bootstrap:
+        print(f"\n{args.confidence:.0%} bootstrap confidence intervals "
+              f"({args.bootstrap:,} resamples):")
+        print(bootstrap_table(scores_per_sr_pair, args.bootstrap,
+                              confidence=args.confidence,
+                              seed=args.seed).to_string())
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,204 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import yaml
+from loguru import logger
+
+from models.sharding import iter_jsonl, merge_shards, shard_assignments, \
+    shard_file
+
+
+def count_lines(file_path) -> int:
+    if not Path(file_path).exists():
+        return 0
+    with open(file_path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def visible_devices():
+    """The GPU IDs available to the workers, or an empty list for CPU-only runs."""
+    if "CUDA_VISIBLE_DEVICES" in os.environ:
+        return [d for d in os.environ["CUDA_VISIBLE_DEVICES"].split(",") if d]
+    try:
+        import torch
+        return [str(i) for i in range(torch.cuda.device_count())]
+    except ImportError:
+        return []
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run baseline.py on several shards of the input in parallel")
+
+    parser.add_argument(
+        "-c", "--config_file",
+        type=str,
+        required=True,
+        help="Path to the configuration file"
+    )
+    parser.add_argument(
+        "-i", "--input_file",
+        type=str,
+        required=True,
+        help="Path to the input file"
+    )
+    parser.add_argument(
+        "-o", "--output_file",
+        type=str,
+        required=False,
+        help="Path to the merged output file"
+    )
+    parser.add_argument(
+        "-n", "--num-shards",
+        type=int,
+        required=True,
+        help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default=None,
+        help="Comma-separated GPU IDs assigned to the workers in turn "
+             "(default: all visible GPUs; none runs on CPU)"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=30.0,
+        help="Seconds between progress reports (default: 30)"
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=128,
+        help="Number of input rows a worker generates and writes at a time "
+             "(default: 128; see `baseline.py --chunk_size`)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the shard outputs of an interrupted run"
+    )
+    parser.add_argument(
+        "--no-gen-cache",
+        action="store_true",
+        help="Regenerate all completions instead of reusing cached generations"
+    )
+
+    args = parser.parse_args()
+
+    with open(args.config_file) as f:
+        config = yaml.safe_load(f)
+
+    output_file = args.output_file
+    if not output_file:
+        output_dir = Path(__file__).resolve().parent / "output"
+        output_dir.mkdir(parents=True, exist_ok=True)
+        output_file = output_dir / f"{Path(args.config_file).stem}.jsonl"
+
+    # Same partition as the one computed by every worker
+    assignments = shard_assignments(
+        [row["Relation"] for row in iter_jsonl(args.input_file)],
+        args.num_shards,
+        relation_costs=config.get("shard_relation_costs"))
+    shard_sizes = [assignments.count(shard)
+                   for shard in range(args.num_shards)]
+
+    devices = (args.devices.split(",") if args.devices is not None
+               else visible_devices())
+    devices = [d for d in devices if d]
+    threads = max(1, (os.cpu_count() or 1) // args.num_shards)
+
+    workers = []
+    for shard in range(args.num_shards):
+        shard_output = shard_file(output_file, shard, args.num_shards)
+        command = [
+            sys.executable, str(Path(__file__).resolve().parent / "baseline.py"),
+            "-c", args.config_file,
+            "-i", args.input_file,
+            "-o", str(shard_output),
+            "--num-shards", str(args.num_shards),
+            "--shard-id", str(shard),
+            "--chunk_size", str(args.chunk_size),
+        ]
+        if args.resume:
+            command.append("--resume")
+        if args.no_gen_cache:
+            command.append("--no-gen-cache")
+
+        env = dict(os.environ)
+        if devices:
+            env["CUDA_VISIBLE_DEVICES"] = devices[shard % len(devices)]
+        else:
+            env["CUDA_VISIBLE_DEVICES"] = ""
+            env["OMP_NUM_THREADS"] = str(threads)
+
+        log_file = shard_output.with_suffix(".log")
+        logger.info(f"Starting shard {shard} ({shard_sizes[shard]:,} rows, "
+                    f"{'GPU ' + devices[shard % len(devices)] if devices else 'CPU'}"
+                    f"), logging to `{log_file}`...")
+        workers.append({
+            "shard": shard,
+            "output": shard_output,
+            "initial": count_lines(shard_output) if args.resume else 0,
+            "log": open(log_file, "a" if args.resume else "w"),
+            "start": time.time(),
+            "end": None,
+        })
+        workers[-1]["process"] = subprocess.Popen(
+            command, env=env, stdout=workers[-1]["log"],
+            stderr=subprocess.STDOUT)
+
+    # Report the progress of every shard until all have finished
+    last_report = time.time()
+    while any(worker["end"] is None for worker in workers):
+        time.sleep(1)
+        for worker in workers:
+            if worker["end"] is None and worker["process"].poll() is not None:
+                worker["end"] = time.time()
+
+        if time.time() - last_report < args.interval:
+            continue
+        last_report = time.time()
+        for worker in workers:
+            done = count_lines(worker["output"])
+            elapsed = (worker["end"] or time.time()) - worker["start"]
+            logger.info(
+                f"Shard {worker['shard']}: {done:,}/"
+                f"{shard_sizes[worker['shard']]:,} rows "
+                f"({(done - worker['initial']) / elapsed:.2f} rows/s)")
+
+    # Summary
+    failed = []
+    logger.info("Shard  Rows  Seconds  Rows/s  Exit code")
+    for worker in workers:
+        worker["log"].close()
+        done = count_lines(worker["output"])
+        elapsed = worker["end"] - worker["start"]
+        returncode = worker["process"].returncode
+        logger.info(f"{worker['shard']:>5}  {done:>4}  {elapsed:>7.1f}  "
+                    f"{(done - worker['initial']) / elapsed:>6.2f}  "
+                    f"{returncode:>9}")
+        if returncode != 0:
+            failed.append(worker["shard"])
+
+    if failed:
+        logger.error(f"Shards {failed} failed; see their logs. Rerun with "
+                     f"--resume to continue them.")
+        sys.exit(1)
+
+    logger.info(f"Merging the shard outputs into `{output_file}`...")
+    num_results = merge_shards(args.input_file,
+                               [worker["output"] for worker in workers],
+                               output_file)
+    logger.info(f"Merged {num_results:,} results.")
+
+    logger.info("Done!")
+
+
+if __name__ == "__main__":
+    main()
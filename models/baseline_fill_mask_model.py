@@ -8,7 +8,7 @@ from models.baseline_model import BaselineModel
 
 class FillMaskModel(BaselineModel):
     def __init__(self, config):
-        super().__init__()
+        super().__init__(config)
 
         # Getting model parameters from the configuration file
         llm_path = config["llm_path"]
@@ -55,18 +55,22 @@ class FillMaskModel(BaselineModel):
         ]
         outputs = self.pipe(prompts, batch_size=self.batch_size)
 
+        candidates = [
+            [seq["token_str"] for seq in output if seq["score"] > self.threshold]
+            for output in outputs
+        ]
+
+        # Resolve all entities of the run at once
+        self.resolution_stage(candidates)
+
         logger.info("Disambiguating entities...")
         results = []
-        for inp, output, prompt in tqdm(
-                zip(inputs, outputs, prompts),
+        for inp, entities in tqdm(
+                zip(inputs, candidates),
                 total=len(inputs),
                 desc="Disambiguating entities"):
-            wikidata_ids = []
-            for seq in output:
-                if seq["score"] > self.threshold:
-                    wikidata_id = self.disambiguation_baseline(seq["token_str"])
-                    if wikidata_id:
-                        wikidata_ids.append(wikidata_id)
+            wikidata_ids = [wikidata_id for wikidata_id in
+                            self.disambiguation_batch(entities) if wikidata_id]
 
             result_row = {
                 "SubjectEntityID": inp["SubjectEntityID"],
@@ -75,5 +79,6 @@ class FillMaskModel(BaselineModel):
                 "ObjectEntitiesID": wikidata_ids,
             }
             results.append(result_row)
+        self.log_disambiguation_stats()
 
         return results
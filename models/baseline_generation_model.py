@@ -1,5 +1,7 @@
 import json
 import random
+from collections import Counter
+from typing import List
 
 import torch
 from loguru import logger
@@ -8,11 +10,16 @@ from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer, \
     BitsAndBytesConfig
 
 from models.baseline_model import BaselineModel
+from models.batch_tuner import AdaptiveBatcher
+from models.completion import generate_completions
+from models.generation_cache import GenerationCache, generation_key
+from models.prefix_cache import PrefixCache
+from models.speculative import SpeculativeDecoding
 
 
 class GenerationModel(BaselineModel):
     def __init__(self, config):
-        super().__init__()
+        super().__init__(config)
 
         # Getting parameters from the configuration file
         llm_path = config["llm_path"]
@@ -59,6 +66,37 @@ class GenerationModel(BaselineModel):
             tokenizer=self.tokenizer,
         )
 
+        # Optional speculative decoding with a small draft model
+        self.speculative = SpeculativeDecoding.from_config(
+            config, self.llm, self.tokenizer)
+        if self.speculative is not None and config.get("prefix_caching", False):
+            logger.warning("The draft model is not used with prefix caching.")
+
+        # KV cache reuse of shared prompt prefixes
+        self.prefix_cache = None
+        if config.get("prefix_caching", False):
+            self.prefix_cache = PrefixCache(
+                self.llm, self.tokenizer,
+                max_entries=config.get("prefix_cache_size", 16))
+
+        # Persistent cache of the generations, keyed by the model and prompt
+        self.generation_cache = GenerationCache.from_config(config)
+        generation_config = self.llm.generation_config.to_diff_dict()
+        generation_config.pop("transformers_version", None)
+        self.model_key = json.dumps({
+            "llm_path": llm_path,
+            "output": "completion",
+            "use_quantization": use_quantization,
+            "generation_config": generation_config,
+        }, sort_keys=True)
+        # Number of requests of every prompt in this chunk of the run
+        self.generation_counts = Counter()
+
+        # Adaptive batch sizes per prompt length
+        self.batcher = None
+        if config.get("adaptive_batching", False):
+            self.batcher = AdaptiveBatcher.from_config(config, self.tokenizer)
+
         # Prompt templates
         self.prompt_templates = self.read_prompt_templates_from_csv(
             prompt_templates_file)
@@ -100,6 +138,108 @@ class GenerationModel(BaselineModel):
                   f"\n{template.format(subject_entity=subject_entity)}")
         return prompt
 
+    def generation_kwargs(self) -> dict:
+        """Keyword arguments passed to the pipeline for every generation."""
+        return {"max_new_tokens": self.max_new_tokens}
+
+    def trim_run_state(self):
+        """Also forget the request counts of the prompts, which only repeat within a chunk (e.g. when re-asking)."""
+        super().trim_run_state()
+        self.generation_counts.clear()
+
+    def generate_batch(self, prompts: List[str],
+                       desc: str = "Generating") -> List:
+        """Generate the outputs of the prompts, reusing cached generations.
+
+        Only the prompts missing from the generation cache are run through
+        the model. A prompt requested several times in a run (e.g. when
+        re-asking) is cached once per request. Returns one pipeline output per prompt, in the order of
+        the prompts.
+        """
+        if self.generation_cache is None:
+            return self.generate_uncached(prompts, desc=desc)
+
+        kwargs = self.generation_kwargs()
+        keys = []
+        for prompt in prompts:
+            base_key = generation_key(self.model_key, prompt, kwargs)
+            keys.append(generation_key(self.model_key, prompt, kwargs,
+                                       self.generation_counts[base_key]))
+            self.generation_counts[base_key] += 1
+        cached = self.generation_cache.get_many(keys)
+
+        missing = {key: prompt for key, prompt in zip(keys, prompts)
+                   if key not in cached}
+        if missing:
+            outputs = self.generate_uncached(list(missing.values()), desc=desc)
+            generated = dict(zip(missing, outputs))
+            self.generation_cache.put_many(generated)
+            cached.update(generated)
+
+        return [cached[key] for key in keys]
+
+    def generate_uncached(self, prompts: List[str],
+                          desc: str = "Generating") -> List:
+        """Run the pipeline on the prompts in batches.
+
+        Batches have `batch_size` prompts, or an adaptive size per prompt
+        length with `adaptive_batching`. With `prefix_caching`, prompts are
+        generated one at a time, reusing the KV cache of their prefixes.
+        Returns one pipeline output per prompt, in the order of the prompts.
+        """
+        if self.prefix_cache is not None:
+            return [self.prefix_cache.generate(prompt, **self.generation_kwargs())
+                    for prompt in tqdm(prompts, desc=desc)]
+
+        if self.batcher is not None:
+            outputs = self.batcher.run(prompts, self.pipe_batch, desc=desc)
+            logger.debug(f"Batch sizes per prompt length: "
+                         f"{self.batcher.summary()}")
+            return outputs
+
+        outputs = []
+        for i in tqdm(range(0, len(prompts), self.batch_size),
+                      total=(len(prompts) + self.batch_size - 1) // self.batch_size,
+                      desc=desc):
+            outputs.extend(self.pipe_batch(prompts[i:i + self.batch_size]))
+
+        return outputs
+
+    def log_generation_cache_stats(self):
+        if self.generation_cache is None:
+            return
+        stats = self.generation_cache.stats()
+        logger.info(
+            f"Generation cache: {stats['hits']:,} hits, "
+            f"{stats['misses']:,} misses "
+            f"(hit rate {stats['hit_rate']:.1%}), "
+            f"{stats['size']:,} entries."
+        )
+
+    def log_speculative_stats(self):
+        if self.speculative is not None:
+            self.speculative.log_stats()
+
+    def pipe_batch(self, prompt_batch: List[str]) -> List:
+        """Generate a batch of prompts with the settings of the pipeline, returning only the completions.
+
+        With a draft model, the prompts are generated one at a time with
+        speculative decoding.
+        """
+        if self.speculative is not None:
+            return self.speculative.generate(
+                prompt_batch,
+                generation_config=self.pipe.generation_config,
+                **self.generation_kwargs(),
+            )
+        return generate_completions(
+            self.llm,
+            self.tokenizer,
+            prompt_batch,
+            generation_config=self.pipe.generation_config,
+            **self.generation_kwargs(),
+        )
+
     def generate_predictions(self, inputs):
         logger.info("Generating predictions...")
         prompts = [
@@ -109,26 +249,21 @@ class GenerationModel(BaselineModel):
             ) for inp in inputs
         ]
 
-        outputs = []
-        for i in tqdm(range(0, len(prompts), self.batch_size),
-                      total=(len(prompts) // self.batch_size + 1),
-                      desc="Generating predictions"):
-            prompt_batch = prompts[i:i + self.batch_size]
-            output = self.pipe(
-                prompt_batch,
-                batch_size=self.batch_size,
-                max_new_tokens=self.max_new_tokens,
-            )
-            outputs.extend(output)
+        outputs = self.generate_batch(prompts, desc="Generating predictions")
+
+        # Keep the first line of the completion
+        qa_answers = [output[0]["generated_text"].split("\n")[0].strip()
+                      for output in outputs]
+
+        # Resolve all entities of the run at once
+        self.resolution_stage(
+            [self.candidate_entities(qa_answer) for qa_answer in qa_answers])
 
         logger.info("Disambiguating entities...")
         results = []
-        for inp, output, prompt in tqdm(zip(inputs, outputs, prompts),
-                                        total=len(inputs),
-                                        desc="Disambiguating entities"):
-            # Remove the original prompt from the generated text
-            qa_answer = output[0]["generated_text"].split(prompt)[
-                -1].split("\n")[0].strip()
+        for inp, qa_answer in tqdm(zip(inputs, qa_answers),
+                                   total=len(inputs),
+                                   desc="Disambiguating entities"):
             wikidata_ids = self.disambiguate_entities(qa_answer)
             results.append({
                 "SubjectEntityID": inp["SubjectEntityID"],
@@ -136,18 +271,27 @@ class GenerationModel(BaselineModel):
                 "Relation": inp["Relation"],
                 "ObjectEntitiesID": wikidata_ids,
             })
+        self.log_generation_cache_stats()
+        self.log_speculative_stats()
+        self.log_disambiguation_stats()
 
         return results
 
-    def disambiguate_entities(self, qa_answer: str):
-        wikidata_ids = []
+    def candidate_entities(self, qa_answer: str) -> List[str]:
+        """Split an answer into the entity strings to disambiguate."""
+        entities = []
         qa_entities = qa_answer.split(", ")
         for entity in qa_entities:
             entity = entity.strip()
             if entity.startswith("and "):
                 entity = entity[4:].strip()
-            wikidata_id = self.disambiguation_baseline(entity)
-            if wikidata_id:
-                wikidata_ids.append(wikidata_id)
+            entities.append(entity)
+
+        return entities
+
+    def disambiguate_entities(self, qa_answer: str):
+        entities = self.candidate_entities(qa_answer)
+        wikidata_ids = [wikidata_id for wikidata_id in
+                        self.disambiguation_batch(entities) if wikidata_id]
 
         return wikidata_ids
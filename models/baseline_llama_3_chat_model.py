@@ -6,16 +6,22 @@ from tqdm import tqdm
 
 from models.baseline_generation_model import GenerationModel
 
+# Stands for the question when the chat template is rendered around it
+PLACEHOLDER = "\x00"
+
 
 class Llama3ChatModel(GenerationModel):
     def __init__(self, config):
-        assert config["llm_path"] in [
+        # Other checkpoints with the Llama 3 chat template and special tokens
+        # (e.g. fine-tunes or local test models) can opt in explicitly
+        assert config.get("llama_3_compatible", False) or config["llm_path"] in [
             "meta-llama/Meta-Llama-3-8B-Instruct",
             "meta-llama/Meta-Llama-3-70B-Instruct"
         ], (
             "The Llama3ChatModel class only supports the "
             "Meta-Llama-3-8B-Instruct "
-            "and Meta-Llama-3-70B-Instruct models."
+            "and Meta-Llama-3-70B-Instruct models "
+            "(set `llama_3_compatible: true` for compatible checkpoints)."
         )
 
         super().__init__(config=config)
@@ -30,6 +36,21 @@ class Llama3ChatModel(GenerationModel):
             self.pipe.tokenizer.convert_tokens_to_ids("<|eot_id|>")
         ]
 
+        # Few-shot examples per relation, and the pieces of the chat template
+        # rendered on first use
+        self.examples_per_relation = {}
+        for example in self.in_context_examples:
+            self.examples_per_relation.setdefault(
+                example["relation"], []).append(example["messages"])
+        self.prompt_frame = None
+        self.rendered_examples = {}
+
+    def generation_kwargs(self) -> dict:
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "eos_token_id": self.terminators,
+        }
+
     def instantiate_in_context_examples(self, train_data_file):
         logger.info(f"Reading train data from `{train_data_file}`...")
         with open(train_data_file) as f:
@@ -62,40 +83,100 @@ class Llama3ChatModel(GenerationModel):
 
         return in_context_examples
 
+    def render_chat(self, messages, add_generation_prompt=False) -> str:
+        return self.pipe.tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=add_generation_prompt
+        )
+
+    def render_prompt_frame(self):
+        """Render the system message and the template around the question once.
+
+        Returns the rendered system message, the text before and after the
+        question and whether the question is trimmed, or False if the chat
+        template does not render every turn on its own (the prompts are then
+        rendered in full).
+        """
+        system = [{"role": "system", "content": self.system_message}]
+        system_block = self.render_chat(system)
+        frame = self.render_chat(
+            system + [{"role": "user", "content": f" {PLACEHOLDER} "}],
+            add_generation_prompt=True)
+        if not frame.startswith(system_block) or \
+                frame.count(PLACEHOLDER) != 1:
+            return False
+
+        before, after = frame[len(system_block):].split(PLACEHOLDER)
+        trim = not (before.endswith(" ") and after.startswith(" "))
+        if not trim:
+            before, after = before[:-1], after[1:]
+        self.prompt_frame = (system_block, before, after, trim)
+
+        # Check the pieces against a fully rendered prompt
+        for relation, pool in self.examples_per_relation.items():
+            question = pool[0][0]["content"]
+            expected = self.render_chat(
+                system + pool[0] + [{"role": "user", "content": question}],
+                add_generation_prompt=True)
+            if self.assemble_prompt(relation, [0], question) != expected:
+                logger.warning("The chat template does not render every turn "
+                               "on its own; prompts are rendered in full.")
+                self.rendered_examples = {}
+                return False
+            break
+
+        return self.prompt_frame
+
+    def example_blocks(self, relation: str) -> list:
+        """The rendered few-shot turns of a relation, in the order of the training data."""
+        if relation not in self.rendered_examples:
+            system_block = self.prompt_frame[0]
+            system = [{"role": "system", "content": self.system_message}]
+            self.rendered_examples[relation] = [
+                self.render_chat(system + messages)[len(system_block):]
+                for messages in self.examples_per_relation.get(relation, [])
+            ]
+        return self.rendered_examples[relation]
+
+    def assemble_prompt(self, relation: str, example_indices, question: str) -> str:
+        system_block, before, after, trim = self.prompt_frame
+        example_blocks = self.example_blocks(relation)
+        return (system_block
+                + "".join(example_blocks[i] for i in example_indices)
+                + before + (question.strip() if trim else question) + after)
+
     def create_prompt(self, subject_entity: str, relation: str) -> str:
         template = self.prompt_templates[relation]
-        random_examples = []
+        question = template.format(subject_entity=subject_entity)
+        pool = self.examples_per_relation.get(relation, [])
+        example_indices = []
         if self.few_shot > 0:
-            pool = [example["messages"] for example in self.in_context_examples
-                    if example["relation"] == relation]
-            # pool = [example["messages"] for example in self.in_context_examples]
-            random_examples = random.sample(
-                pool,
+            # Same draws as sampling the examples themselves
+            example_indices = random.sample(
+                range(len(pool)),
                 min(self.few_shot, len(pool))
             )
 
+        if self.prompt_frame is None:
+            self.prompt_frame = self.render_prompt_frame()
+        if self.prompt_frame:
+            return self.assemble_prompt(relation, example_indices, question)
+
         messages = [
             {
                 "role": "system",
                 "content": self.system_message
             }
         ]
-
-        for example in random_examples:
-            messages.extend(example)
-
+        for i in example_indices:
+            messages.extend(pool[i])
         messages.append({
             "role": "user",
-            "content": template.format(subject_entity=subject_entity)
+            "content": question
         })
 
-        prompt = self.pipe.tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-
-        return prompt
+        return self.render_chat(messages, add_generation_prompt=True)
 
     def generate_predictions(self, inputs):
         logger.info("Generating predictions...")
@@ -106,22 +187,19 @@ class Llama3ChatModel(GenerationModel):
             ) for inp in inputs
         ]
 
-        outputs = []
-        for prompt in tqdm(prompts, desc="Generating predictions"):
-            output = self.pipe(
-                prompt,
-                max_new_tokens=self.max_new_tokens,
-                eos_token_id=self.terminators,
-            )
-            outputs.append(output)
+        outputs = self.generate_batch(prompts, desc="Generating predictions")
+
+        qa_answers = [output[0]["generated_text"].strip() for output in outputs]
+
+        # Resolve all entities of the run at once
+        self.resolution_stage(
+            [self.candidate_entities(qa_answer) for qa_answer in qa_answers])
 
         logger.info("Disambiguating entities...")
         results = []
-        for inp, output, prompt in tqdm(zip(inputs, outputs, prompts),
-                                        total=len(inputs),
-                                        desc="Disambiguating entities"):
-            # Remove the original prompt from the generated text
-            qa_answer = output[0]["generated_text"][len(prompt):].strip()
+        for inp, qa_answer in tqdm(zip(inputs, qa_answers),
+                                   total=len(inputs),
+                                   desc="Disambiguating entities"):
             wikidata_ids = self.disambiguate_entities(qa_answer)
             results.append({
                 "SubjectEntityID": inp["SubjectEntityID"],
@@ -129,5 +207,8 @@ class Llama3ChatModel(GenerationModel):
                 "Relation": inp["Relation"],
                 "ObjectEntitiesID": wikidata_ids,
             })
+        self.log_generation_cache_stats()
+        self.log_speculative_stats()
+        self.log_disambiguation_stats()
 
         return results
@@ -1,18 +1,66 @@
 import csv
+from collections import OrderedDict
+from typing import Iterable, Iterator, List
 
-import requests
 from loguru import logger
 
 from models.abstract_model import AbstractModel
+from models.local_index import LocalIndex
+from models.wikidata_cache import WikidataCache, normalize_label
+from models.wikidata_resolver import WikidataResolver
 
 
 class BaselineModel(AbstractModel):
-    def __init__(self):
+    def __init__(self, config=None):
         super().__init__()
+        config = config or {}
+
+        # Disambiguation backend: the Wikidata search API or a local index
+        backend = config.get("disambiguation_backend", "wikidata_api")
+        self.local_index = None
+        self.disambiguation_cache = None
+        self.wikidata_resolver = None
+        if backend == "local_index":
+            self.local_index = LocalIndex(config["local_index_path"])
+        elif backend == "wikidata_api":
+            # Pooled, rate-limited client of the Wikidata search API
+            self.wikidata_resolver = WikidataResolver.from_config(config)
+            # Persistent cache of the Wikidata label lookups
+            self.disambiguation_cache = WikidataCache.from_config(config)
+        else:
+            raise ValueError(f"Disambiguation backend `{backend}` not found.")
+
+        # Normalized label -> Wikidata ID ("" if not found), least recently used first
+        self.resolved_ids = OrderedDict()
+        self.max_resolved_ids = config.get("max_resolved_ids", 100_000)
 
     def generate_predictions(self, inputs):
         raise NotImplementedError
 
+    def generate_predictions_stream(self, inputs: Iterable[dict],
+                                    chunk_size: int = 128) -> Iterator[dict]:
+        """Yield the predictions of the inputs, generated chunk by chunk.
+
+        Only `chunk_size` inputs are held in memory at a time; the inputs of a
+        chunk are batched as in `generate_predictions`. Between chunks, the
+        state kept for the run is bounded with `trim_run_state`.
+        """
+        chunk = []
+        for inp in inputs:
+            chunk.append(inp)
+            if len(chunk) == chunk_size:
+                yield from self.generate_predictions(chunk)
+                self.trim_run_state()
+                chunk = []
+        if chunk:
+            yield from self.generate_predictions(chunk)
+            self.trim_run_state()
+
+    def trim_run_state(self):
+        """Keep the `max_resolved_ids` most recently used resolved Wikidata IDs."""
+        while len(self.resolved_ids) > self.max_resolved_ids:
+            self.resolved_ids.popitem(last=False)
+
     @staticmethod
     def read_prompt_templates_from_csv(file_path) -> dict:
         """Read prompt templates from a CSV file."""
@@ -20,18 +68,37 @@ class BaselineModel(AbstractModel):
             f"Reading prompt templates from `{file_path}`..."
         )
 
-        with open(file_path) as csvfile:
+        # Some of the template files start with a UTF-8 byte order mark
+        with open(file_path, encoding="utf-8-sig") as csvfile:
             reader = csv.DictReader(csvfile)
             prompt_templates = {
                 row["Relation"]: row["PromptTemplate"] for row in reader
             }
         return prompt_templates
 
-    @staticmethod
-    def disambiguation_baseline(item) -> str:
+    def disambiguation_baseline(self, item) -> str:
         """A simple disambiguation function that returns the Wikidata ID of an item."""
-        item = str(item).strip()
+        return self.disambiguation_batch([item])[0]
+
+    def disambiguation_batch(self, items: List) -> List[str]:
+        """Return the Wikidata IDs of several items, searching the unresolved ones concurrently."""
+        items = [str(item).strip() for item in items]
+        self.resolve_wikidata_ids(items)
+        return [self.lookup_resolved_id(item) for item in items]
 
+    @staticmethod
+    def is_searchable(item: str) -> bool:
+        """Whether an item needs a Wikidata lookup, i.e. it is neither empty nor an integer."""
+        if not item or item == "None":
+            return False
+        try:
+            int(item)
+            return False
+        except ValueError:
+            return True
+
+    def lookup_resolved_id(self, item: str) -> str:
+        """Return the Wikidata ID of an item that went through `resolve_wikidata_ids`."""
         if not item or item == "None":
             return ""
 
@@ -39,16 +106,80 @@ class BaselineModel(AbstractModel):
             # If item can be converted to an integer, return it directly
             return str(int(item))
         except ValueError:
-            # If not, proceed with the Wikidata search
-            try:
-                url = (f"https://www.wikidata.org/w/api.php"
-                       f"?action=wbsearchentities"
-                       f"&search={item}"
-                       f"&language=en"
-                       f"&format=json")
-                data = requests.get(url).json()
-                # Return the first id (Could upgrade this in the future)
-                return str(data["search"][0]["id"])
-            except Exception as e:
+            pass
+
+        # Fall back to the item itself if no ID was found
+        return self.resolved_ids.get(normalize_label(item)) or item
+
+    def resolve_wikidata_ids(self, items: List[str]) -> int:
+        """Resolve every unique (normalized) search string among the items once.
+
+        Lookups go to the local index, or to the cache and then the Wikidata
+        search API, in batches. Results are kept in `self.resolved_ids` for the
+        rest of the run. Returns the number of unique search strings.
+        """
+        pending = {}
+        for item in items:
+            if self.is_searchable(item):
+                pending.setdefault(normalize_label(item), item)
+        num_unique = len(pending)
+
+        for key in pending.keys() & self.resolved_ids.keys():
+            self.resolved_ids.move_to_end(key)
+        pending = {key: item for key, item in pending.items()
+                   if key not in self.resolved_ids}
+        if not pending:
+            return num_unique
+
+        if self.local_index is not None:
+            found = self.local_index.lookup_many(list(pending.values()))
+            for key, item in pending.items():
+                self.resolved_ids[key] = found.get(item, "")
+            return num_unique
+
+        if self.disambiguation_cache is not None:
+            cached = self.disambiguation_cache.get_many(
+                list(pending.values()), language=self.wikidata_resolver.language)
+            for item, wikidata_id in cached.items():
+                self.resolved_ids[normalize_label(item)] = wikidata_id
+                del pending[normalize_label(item)]
+
+        if pending:
+            found, errors = self.wikidata_resolver.search_many(
+                list(pending.values()))
+            for item, e in errors.items():
                 logger.error(f"Error getting Wikidata ID for `{item}`: {e}")
-                return item
+
+            if self.disambiguation_cache is not None:
+                self.disambiguation_cache.put_many(
+                    found, language=self.wikidata_resolver.language)
+
+            for item, wikidata_id in found.items():
+                if not wikidata_id:
+                    logger.warning(f"No Wikidata ID found for `{item}`")
+                self.resolved_ids[normalize_label(item)] = wikidata_id
+
+        return num_unique
+
+    def resolution_stage(self, candidates: List[List[str]]):
+        """Resolve the candidate strings of all rows at once, before they are disambiguated row by row."""
+        items = [str(item).strip() for row in candidates for item in row]
+        logger.info("Resolving entities...")
+        num_unique = self.resolve_wikidata_ids(items)
+        num_searchable = sum(1 for item in items if self.is_searchable(item))
+        logger.info(
+            f"Resolved {num_unique:,} unique strings out of "
+            f"{num_searchable:,} candidates (dedup ratio "
+            f"{num_searchable / num_unique if num_unique else 1.0:.2f}x)."
+        )
+
+    def log_disambiguation_stats(self):
+        if self.disambiguation_cache is None:
+            return
+        stats = self.disambiguation_cache.stats()
+        logger.info(
+            f"Disambiguation cache: {stats['hits']:,} hits, "
+            f"{stats['misses']:,} misses "
+            f"(hit rate {stats['hit_rate']:.1%}), "
+            f"{stats['size']:,} entries."
+        )
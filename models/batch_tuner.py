@@ -0,0 +1,256 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Union
+
+import torch
+from loguru import logger
+from tqdm import tqdm
+
+DEFAULT_STATE_FILE = (Path(__file__).resolve().parent.parent / "cache" /
+                      "batch_sizes.json")
+
+
+def is_out_of_memory(e: Exception) -> bool:
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+def current_rss() -> int:
+    """Resident set size of the current process in bytes (0 if unknown)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size of the current process to its current size; False if not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the current process in bytes since the last reset (0 if unknown)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+class AdaptiveBatcher:
+    """Runs prompts in batches whose size adapts to the prompt length.
+
+    Prompts are grouped into buckets of `bucket_size` tokens and processed
+    from the shortest to the longest. The batch size of a bucket doubles after
+    every batch that stays within the latency and memory targets (and only
+    grows by one once a larger size has failed), and is halved when a batch
+    exceeds them. A batch that runs out of memory is retried with half the
+    batch size, so no work is lost. With `max_rss_gb`, the memory of a batch
+    is its peak RSS over the RSS at its start, so memory held between batches
+    (the weights and caches) only counts as the room it leaves: a batch
+    exceeds the target when its peak goes above `max_rss_gb`. The batch sizes
+    that ran within the targets are saved to `state_file` so later runs start
+    at the right size.
+    """
+
+    def __init__(self, tokenizer,
+                 initial_batch_size: int = 4,
+                 max_batch_size: int = 64,
+                 bucket_size: int = 128,
+                 latency_target: Optional[float] = None,
+                 memory_target: float = 0.9,
+                 max_rss_gb: Optional[float] = None,
+                 state_file: Optional[Union[str, Path]] = None,
+                 state_key: str = "default"):
+        self.tokenizer = tokenizer
+        self.initial_batch_size = initial_batch_size
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        self.latency_target = latency_target
+        self.memory_target = memory_target
+        self.max_rss = max_rss_gb * 1024 ** 3 if max_rss_gb else None
+        self.state_file = Path(state_file) if state_file else None
+        self.state_key = state_key
+
+        # Length bucket -> current batch size / smallest batch size that failed
+        self.batch_sizes: Dict[int, int] = {}
+        self.ceilings: Dict[int, int] = {}
+        # Length bucket -> largest batch size that ran within the targets
+        self.verified_sizes: Dict[int, int] = {}
+        self.rss_warned = False
+        self.load_state()
+
+    @classmethod
+    def from_config(cls, config: dict, tokenizer) -> "AdaptiveBatcher":
+        state_key = "|".join([
+            config["llm_path"],
+            f"quantization={config.get('use_quantization', True)}",
+            f"max_new_tokens={config.get('max_new_tokens', 64)}",
+            torch.cuda.get_device_name() if torch.cuda.is_available()
+            else "cpu",
+        ])
+        return cls(
+            tokenizer=tokenizer,
+            initial_batch_size=config.get("batch_size", 4),
+            max_batch_size=config.get("max_batch_size", 64),
+            bucket_size=config.get("batch_bucket_size", 128),
+            latency_target=config.get("batch_latency_target"),
+            memory_target=config.get("batch_memory_target", 0.9),
+            max_rss_gb=config.get("max_rss_gb"),
+            state_file=config.get("batch_tuner_file", DEFAULT_STATE_FILE),
+            state_key=state_key,
+        )
+
+    def load_state(self):
+        if not self.state_file or not self.state_file.exists():
+            return
+        with open(self.state_file) as f:
+            state = json.load(f).get(self.state_key, {})
+        self.batch_sizes = {int(k): v for k, v in
+                            state.get("batch_sizes", {}).items()}
+        self.verified_sizes = dict(self.batch_sizes)
+        self.ceilings = {int(k): v for k, v in
+                         state.get("ceilings", {}).items()}
+        if self.batch_sizes:
+            logger.info(f"Loaded the batch sizes of {len(self.batch_sizes)} "
+                        f"length buckets from `{self.state_file}`.")
+
+    def save_state(self):
+        if not self.state_file:
+            return
+        states = {}
+        if self.state_file.exists():
+            with open(self.state_file) as f:
+                states = json.load(f)
+        states[self.state_key] = {
+            "bucket_size": self.bucket_size,
+            "batch_sizes": self.verified_sizes,
+            "ceilings": self.ceilings,
+        }
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        # Replace the file atomically, as several processes may share it
+        tmp_file = self.state_file.with_name(
+            f"{self.state_file.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(states, f, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+    def batch_size(self, bucket: int) -> int:
+        return self.batch_sizes.get(bucket, self.initial_batch_size)
+
+    def shrink(self, bucket: int, batch_size: int):
+        self.ceilings[bucket] = min(self.ceilings.get(bucket, batch_size),
+                                    batch_size)
+        self.batch_sizes[bucket] = max(1, batch_size // 2)
+        if self.verified_sizes.get(bucket, 0) >= batch_size:
+            self.verified_sizes[bucket] = self.batch_sizes[bucket]
+
+    def grow(self, bucket: int, batch_size: int):
+        # Double until a batch size fails, then creep up towards that size
+        if bucket in self.ceilings:
+            new_size = min(batch_size + 1, self.ceilings[bucket] - 1)
+        else:
+            new_size = batch_size * 2
+        self.batch_sizes[bucket] = max(1, min(new_size, self.max_batch_size))
+
+    def within_targets(self, elapsed: float, rss_before: int = 0,
+                       rss_peak: int = 0) -> bool:
+        if self.latency_target and elapsed > self.latency_target:
+            return False
+        if self.max_rss and rss_before < self.max_rss < rss_peak:
+            return False
+        if torch.cuda.is_available():
+            peak = torch.cuda.max_memory_allocated()
+            total = torch.cuda.get_device_properties(0).total_memory
+            if peak > self.memory_target * total:
+                return False
+        return True
+
+    def run(self, prompts: List[str], generate_fn: Callable[[List[str]], List],
+            desc: str = "Generating") -> List:
+        """Call `generate_fn` on adaptively sized batches of the prompts.
+
+        Returns the outputs in the order of the prompts.
+        """
+        lengths = [len(ids) for ids in
+                   self.tokenizer(prompts, add_special_tokens=False)[
+                       "input_ids"]] if prompts else []
+        order = sorted(range(len(prompts)), key=lambda i: lengths[i])
+
+        outputs = [None] * len(prompts)
+        progress = tqdm(total=len(prompts), desc=desc)
+        pos = 0
+        while pos < len(order):
+            bucket = lengths[order[pos]] // self.bucket_size
+            batch_size = self.batch_size(bucket)
+            batch = []
+            for i in order[pos:pos + batch_size]:
+                if lengths[i] // self.bucket_size != bucket:
+                    break
+                batch.append(i)
+
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            rss_before, peak_reset = 0, False
+            if self.max_rss:
+                rss_before = current_rss()
+                peak_reset = reset_peak_rss()
+            start = time.perf_counter()
+            try:
+                batch_outputs = generate_fn([prompts[i] for i in batch])
+            except Exception as e:
+                if not is_out_of_memory(e) or len(batch) == 1:
+                    raise
+                logger.warning(f"Out of memory with a batch of {len(batch)} "
+                               f"prompts of {bucket * self.bucket_size}-"
+                               f"{(bucket + 1) * self.bucket_size} tokens; "
+                               f"retrying with half the batch size.")
+                self.shrink(bucket, len(batch))
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                continue
+            elapsed = time.perf_counter() - start
+            rss_peak = 0
+            if self.max_rss:
+                # without a reset, the peak would include the earlier batches
+                rss_peak = max(peak_rss() if peak_reset else 0, current_rss())
+
+            for i, output in zip(batch, batch_outputs):
+                outputs[i] = output
+            pos += len(batch)
+            progress.update(len(batch))
+
+            if self.max_rss and rss_before >= self.max_rss and not self.rss_warned:
+                self.rss_warned = True
+                logger.warning(f"RSS is {rss_before / 1024 ** 3:.1f} GB "
+                               f"between batches, above the "
+                               f"{self.max_rss / 1024 ** 3:.1f} GB ceiling; "
+                               f"smaller batches cannot lower it.")
+            if not self.within_targets(elapsed, rss_before, rss_peak):
+                logger.debug(f"A batch of {len(batch)} prompts exceeded the "
+                             f"targets; halving the batch size.")
+                self.shrink(bucket, len(batch))
+            elif len(batch) == batch_size:
+                self.verified_sizes[bucket] = batch_size
+                self.grow(bucket, batch_size)
+
+        progress.close()
+        self.save_state()
+        return outputs
+
+    def summary(self) -> Dict[int, int]:
+        """Batch size per length bucket, keyed by the lower token bound of the bucket."""
+        return {bucket * self.bucket_size: size
+                for bucket, size in sorted(self.batch_sizes.items())}
@@ -0,0 +1,86 @@
+from typing import List, Optional
+
+import torch
+from transformers import GenerationConfig
+
+
+def completion_output(tokenizer, new_token_ids: List[int],
+                      prompt_tokens: int) -> List[dict]:
+    """One generation in the format of the text-generation pipeline with `return_full_text=False`.
+
+    Only the new tokens are decoded. The output also has their IDs (without
+    the trailing padding) and the prompt and completion token counts.
+    """
+    new_token_ids = list(new_token_ids)
+    while new_token_ids and new_token_ids[-1] == tokenizer.pad_token_id:
+        new_token_ids.pop()
+    return [{
+        "generated_text": tokenizer.decode(new_token_ids,
+                                           skip_special_tokens=True,
+                                           clean_up_tokenization_spaces=True),
+        "completion_token_ids": new_token_ids,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(new_token_ids),
+    }]
+
+
+def adds_special_tokens(tokenizer, prompt: str) -> bool:
+    """Whether a prompt is tokenized with the special tokens: only if it does not start with the BOS token already (as the chat templates do)."""
+    return not (tokenizer.bos_token and prompt.startswith(tokenizer.bos_token))
+
+
+def tokenize_prompts(tokenizer, prompts: List[str]):
+    """Tokenize and pad a batch of prompts like the text-generation pipeline, with `adds_special_tokens`."""
+    flags = [adds_special_tokens(tokenizer, prompt) for prompt in prompts]
+    if len(set(flags)) <= 1:
+        return tokenizer(prompts, return_tensors="pt", padding=True,
+                         add_special_tokens=flags[0] if flags else True)
+    ids = [tokenizer(prompt, add_special_tokens=flag)["input_ids"]
+           for prompt, flag in zip(prompts, flags)]
+    return tokenizer.pad({"input_ids": ids}, padding=True, return_tensors="pt")
+
+
+def start_generation(generate_kwargs: dict, prompt_length: int):
+    """Tell the stopping criteria with a `start` method the (padded) prompt length of the next generation."""
+    for criterion in generate_kwargs.get("stopping_criteria") or []:
+        if hasattr(criterion, "start"):
+            criterion.start(prompt_length)
+
+
+def generate_completions(model, tokenizer, prompts: List[str],
+                         generation_config: Optional[GenerationConfig] = None,
+                         **generate_kwargs) -> List[List[dict]]:
+    """Generate a batch of prompts, returning only their completions.
+
+    The prompts are tokenized and left-padded like the text-generation
+    pipeline does (`tokenize_prompts`). Returns one output per prompt, in the
+    format of `completion_output`.
+    """
+    inputs = tokenize_prompts(tokenizer, prompts).to(model.device)
+    start_generation(generate_kwargs, inputs["input_ids"].shape[1])
+    with torch.no_grad():
+        sequences = model.generate(
+            **inputs,
+            generation_config=generation_config,
+            pad_token_id=tokenizer.pad_token_id,
+            **generate_kwargs,
+        )
+    new_tokens = sequences[:, inputs["input_ids"].shape[1]:].tolist()
+    prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+    return [completion_output(tokenizer, ids, num_tokens)
+            for ids, num_tokens in zip(new_tokens, prompt_tokens)]
+
+
+def next_token_probabilities(model, tokenizer, prompts: List[str]) -> torch.FloatTensor:
+    """Probabilities of the next token after every prompt, from one forward pass over the batch.
+
+    The prompts are tokenized like in `generate_completions`; the positions
+    of the left-padded prompts start at 0. Returns a (prompts, vocabulary)
+    tensor on the CPU.
+    """
+    inputs = tokenize_prompts(tokenizer, prompts).to(model.device)
+    position_ids = (inputs["attention_mask"].cumsum(dim=1) - 1).clamp(min=0)
+    with torch.no_grad():
+        logits = model(**inputs, position_ids=position_ids,
+                       logits_to_keep=1).logits[:, -1]
+    return logits.float().softmax(dim=-1).cpu()
@@ -1,37 +1,73 @@
-import json
-import random
-import regex
-import ast
+import time
 import string
 import pandas as pd
+from collections import Counter, OrderedDict
+from functools import lru_cache
 
 from loguru import logger
 from tqdm import tqdm
+import torch
+from transformers import LogitsProcessorList, StoppingCriteriaList
 
-import spacy
 
-nlp = spacy.load('en_core_web_sm')
+# Memo of text -> text without titles, shared by all runs of the process
+TITLE_MEMO_SIZE = 100_000
+cleaned_names = OrderedDict()
 
-def remove_titles_with_spacy(text):
-    doc = nlp(text)
-    # Extract entities identified as PERSON and join them
-    person_names = ' '.join([ent.text for ent in doc.ents if ent.label_ == 'PERSON'])
-    
-    # Return the original text as a fallback if no PERSON entity is found
-    return person_names if person_names else text
+
+@lru_cache(maxsize=None)
+def get_nlp():
+    # spaCy and its model are only loaded once they are first needed
+    import spacy
+    nlp = spacy.load('en_core_web_sm')
+    # only NER (and the tok2vec layers it listens to, if any) is needed
+    needed = {'ner'} | {name for name, pipe in nlp.pipeline if 'ner' in getattr(pipe, 'listening_components', [])}
+    nlp.select_pipes(enable=[name for name in nlp.pipe_names if name in needed])
+    return nlp
 
 
-from models.baseline_llama_3_chat_model import Llama3ChatModel
+def remove_titles_with_spacy(text):
+    return remove_titles_batch([text])[0]
+
+
+def remove_titles_batch(texts, batch_size=256):
+    # runs NER over the texts that are not memoized yet in one nlp.pipe call
+    pending = list(dict.fromkeys(text for text in texts if text not in cleaned_names))
+    for text, doc in zip(pending, get_nlp().pipe(pending, batch_size=batch_size)):
+        # Extract entities identified as PERSON and join them
+        person_names = ' '.join([ent.text for ent in doc.ents if ent.label_ == 'PERSON'])
+        # Return the original text as a fallback if no PERSON entity is found
+        cleaned_names[text] = person_names if person_names else text
+
+    results = []
+    for text in texts:
+        cleaned_names.move_to_end(text)
+        results.append(cleaned_names[text])
+    while len(cleaned_names) > TITLE_MEMO_SIZE:
+        cleaned_names.popitem(last=False)
+    return results
+
+
+from models.baseline_llama_3_chat_model import Llama3ChatModel, PLACEHOLDER
+from models.completion import next_token_probabilities
+from models.metrics import Metrics
+from models.prefix_cache import PrefixCache
+from models.final_answer import FINAL_ANSWER_UNDERSCORE, FINAL_ANSWER_SPACE, ANSWER_COLON, \
+    FinalAnswerStoppingCriteria, closing_bracket_token_ids, AnswerVocabulary, FinalAnswerLogitsProcessor, \
+    YES_NO, INTEGERS, NAMES, ANSWER_PREFIX, yes_no_token_ids, has_final_answer
 
 class Llama3DualPrompt(Llama3ChatModel):
     def __init__(self, config):
-        assert config["llm_path"] in [
+        # Other checkpoints with the Llama 3 chat template and special tokens
+        # (e.g. fine-tunes or local test models) can opt in explicitly
+        assert config.get("llama_3_compatible", False) or config["llm_path"] in [
             "meta-llama/Meta-Llama-3-8B-Instruct",
             "meta-llama/Meta-Llama-3-70B-Instruct"
         ], (
             "The Llama3ChatModel class only supports the "
             "Meta-Llama-3-8B-Instruct "
-            "and Meta-Llama-3-70B-Instruct models."
+            "and Meta-Llama-3-70B-Instruct models "
+            "(set `llama_3_compatible: true` for compatible checkpoints)."
         )
 
         super().__init__(config=config)
@@ -54,6 +90,60 @@ class Llama3DualPrompt(Llama3ChatModel):
         add_info_file = config["add_info_file"]
         self.add_info_df = pd.read_csv(add_info_file).set_index('Relation')
 
+        # optional cap on the yearly sub-queries per award ('recent' or 'uniform' years)
+        self.award_max_years = config.get("award_max_years")
+        self.award_year_sampling = config.get("award_year_sampling", "recent")
+
+        # optionally stop every generation once a complete final answer list has been generated
+        self.stop_at_final_answer = config.get("stop_at_final_answer", False)
+        self.final_answer_stats = Counter()
+        if self.stop_at_final_answer:
+            self.closing_token_ids = closing_bracket_token_ids(self.tokenizer)
+
+        # optionally constrain every generation to end with an answer list of the shape of its stage
+        self.constrained_answers = config.get("constrained_answers", False)
+        self.constrained_answer_tokens = config.get("constrained_answer_tokens", 32)
+        self.answer_shape = NAMES
+        self.current_relation = None
+        if self.constrained_answers:
+            self.answer_vocabulary = AnswerVocabulary(self.tokenizer, self.terminators)
+        # optionally answer stage 0 from the probabilities of the yes and no tokens instead of generating
+        self.yes_no_scoring = config.get("yes_no_scoring", False)
+        self.yes_no_threshold = config.get("yes_no_threshold", 0.5)
+        self.yes_no_thresholds = config.get("yes_no_thresholds") or {}
+        self.yes_no_stats = Counter()
+        if self.yes_no_scoring:
+            self.yes_ids, self.no_ids = yes_no_token_ids(self.tokenizer)
+        # optionally re-ask as a follow-up turn of the conversation, continuing from its KV cache
+        self.reask_followup = config.get("reask_followup", False)
+        self.conversation_cache = None
+        if self.reask_followup:
+            self.followup_message = (
+                "This answer is not formatted properly. Provide just the direct answer as a list (e.g. [Yes] or [2023]). "
+                "If the question can be answered with a number - write out only the number e.g. [35]. "
+                "If there are multiple answers, separate them with a comma. "
+                "If you believe that the answer is incorrect, also use your expertiese to correct it. "
+                "Your final/direct answer should be on the last line and should be formatted like a list. Your final answer should look like this: final_answer = [YOUR FINAL ANSWER HERE]. ")
+            self.followup_turn = self.render_followup_turn()
+            # with prefix caching, the conversations are kept next to the prefixes
+            self.conversation_cache = self.prefix_cache or PrefixCache(self.llm, self.tokenizer)
+            # cap on the kept conversations, whose KV caches stay on the device
+            self.reask_cache_size = config.get("reask_cache_size", 16)
+            # only generations without an answer list are likely to be re-asked
+            self.conversation_cache.keep_conversation = lambda completion: not has_final_answer(completion)
+        # the constrained answers follow the tokens of one sequence, and the follow-ups are generated in batches
+        if self.speculative is not None and (self.constrained_answers or self.reask_followup):
+            logger.warning("The draft model is not used with constrained_answers or reask_followup.")
+            self.speculative = None
+        # generations and re-asks, to report the re-ask rate of a run
+        self.reask_stats = Counter()
+
+        # optional counters and histograms per relation, strategy and stage
+        self.metrics = Metrics.from_config(config)
+        self.metric_labels = {"relation": "", "strategy": ""}
+        if self.metrics is not None:
+            self.declare_metrics()
+
 
 
 
@@ -90,6 +180,16 @@ class Llama3DualPrompt(Llama3ChatModel):
             add_generation_prompt=True
         )
 
+        if self.prefix_cache is not None:
+            # the system message and everything before the question are shared by all stages
+            system_prefix = self.pipe.tokenizer.apply_chat_template(
+                messages[:1],
+                tokenize=False,
+                add_generation_prompt=False
+            )
+            question_start = prompt.rfind(question.strip())
+            self.prefix_cache.register(prompt, [system_prefix, prompt[:question_start] if question_start > 0 else ""])
+
         return prompt
 
     def add_external_info(self, entity_entry, info_strategy):
@@ -108,17 +208,139 @@ class Llama3DualPrompt(Llama3ChatModel):
       return system_prompt
 
 
+    def render_followup_turn(self):
+        # the end of an assistant turn followed by the follow-up user turn and the next assistant header
+        conversation = self.render_chat([
+            {"role": "user", "content": "Question"},
+            {"role": "assistant", "content": PLACEHOLDER},
+            {"role": "user", "content": self.followup_message},
+        ], add_generation_prompt=True)
+        return conversation[conversation.index(PLACEHOLDER) + len(PLACEHOLDER):]
+
+    def followup_prompt(self, prompt, output):
+      # the conversation of a prompt and its completion, continued with the follow-up turn
+      completion_ids = list(output[0]["completion_token_ids"])
+      while completion_ids and completion_ids[-1] in self.terminators:
+        completion_ids.pop()
+      ids = (self.conversation_cache.encode(prompt) + completion_ids
+             + self.tokenizer.encode(self.followup_turn, add_special_tokens=False))
+      text = prompt + self.tokenizer.decode(completion_ids) + self.followup_turn
+      self.conversation_cache.register_ids(text, ids)
+      return text
+
+    def declare_metrics(self):
+        # stage is the prompt template used (0: yes/no, 1: answer, 2: further info, 3: direct), call is ask or reask
+        self.metrics.counter("inputs_total", "Inputs per relation and strategy")
+        self.metrics.counter("llm_calls_total", "Generations per relation, strategy, stage and call")
+        self.metrics.counter("prompt_tokens_total", "Prompt tokens per relation, strategy, stage and call")
+        self.metrics.counter("completion_tokens_total", "Completion tokens per relation, strategy, stage and call")
+        self.metrics.counter("clean_output_failures_total", "Outputs without a parsable answer, which are re-asked")
+        self.metrics.counter("reask_failures_total", "Re-asked outputs that still have no parsable answer")
+        self.metrics.histogram("completion_tokens", "Completion tokens per generation",
+                               buckets=(8, 16, 32, 64, 128, 256, 512, 1024, 2048))
+        self.metrics.histogram("yes_probability", "P(yes) of the scored yes/no questions",
+                               buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9))
+        self.metrics.histogram("stage_seconds", "Time to generate a stage for a chunk of inputs")
+        self.metrics.histogram("title_stripping_seconds", "Time to strip the titles of the answers of a run")
+        self.metrics.histogram("disambiguation_seconds", "Time to disambiguate the answers of a run")
+
+    def stage_answer_shape(self, stage):
+      # shape of the answer list of a stage with constrained decoding
+      if stage == 0:
+        return YES_NO
+      if stage == 2 or self.current_relation == 'seriesHasNumberOfEpisodes':
+        return INTEGERS
+      return NAMES
+
+    def generate_stage(self, prompts, stage, desc, call="ask"):
+      # generates the prompts of one stage, recording the calls, tokens and time
+      self.answer_shape = self.stage_answer_shape(stage)
+      self.reask_stats[call] += len(prompts)
+      if self.conversation_cache is not None and call == "ask":
+        # the failures of a stage are re-asked right after it; beyond the cap, the evicted ones are prefilled again (misses)
+        self.conversation_cache.conversations.clear()
+        self.conversation_cache.max_conversations = min(len(prompts), self.reask_cache_size)
+      if self.metrics is None or not prompts:
+        return self.generate_batch(prompts, desc=desc)
+
+      start = time.perf_counter()
+      outputs = self.generate_batch(prompts, desc=desc)
+      labels = dict(self.metric_labels, stage=str(stage), call=call)
+      self.metrics.observe("stage_seconds", time.perf_counter() - start, **labels)
+
+      self.metrics.inc("llm_calls_total", len(prompts), **labels)
+      self.metrics.inc("prompt_tokens_total", sum(output[0]["prompt_tokens"] for output in outputs), **labels)
+      self.metrics.inc("completion_tokens_total", sum(output[0]["completion_tokens"] for output in outputs), **labels)
+      for output in outputs:
+        self.metrics.observe("completion_tokens", output[0]["completion_tokens"], **labels)
+      self.metrics.maybe_log()
+      return outputs
+
+    def score_yes_no(self, prompts, desc="Scoring"):
+      # P(yes) of yes/no questions from one forward pass per batch, with the answer list already opened
+      prompts = [prompt + ANSWER_PREFIX.lstrip() for prompt in prompts]
+      probabilities = []
+      start = time.perf_counter()
+      for i in tqdm(range(0, len(prompts), self.batch_size),
+                    total=(len(prompts) + self.batch_size - 1) // self.batch_size,
+                    desc=desc):
+        next_tokens = next_token_probabilities(self.llm, self.tokenizer, prompts[i:i + self.batch_size])
+        yes = next_tokens[:, self.yes_ids].sum(dim=1)
+        no = next_tokens[:, self.no_ids].sum(dim=1)
+        probabilities.extend((yes / (yes + no).clamp(min=torch.finfo(yes.dtype).tiny)).tolist())
+
+      if self.metrics is not None and prompts:
+        labels = dict(self.metric_labels, stage="0", call="score")
+        self.metrics.observe("stage_seconds", time.perf_counter() - start, **labels)
+        self.metrics.inc("llm_calls_total", len(prompts), **labels)
+        self.metrics.inc("prompt_tokens_total", sum(len(ids) for ids in self.tokenizer(
+          prompts, add_special_tokens=False)["input_ids"]), **labels)
+        for probability in probabilities:
+          self.metrics.observe("yes_probability", probability, **self.metric_labels)
+        self.metrics.maybe_log()
+      return probabilities
+
+    def score_stage_0(self, inps, prompts):
+      # answers the yes/no questions of stage 0 by comparing P(yes) with the threshold of the relation
+      probabilities = self.score_yes_no(prompts, desc="Stage 0 (scoring)")
+      answers = []
+      for inp, probability in zip(inps, probabilities):
+        threshold = self.yes_no_thresholds.get(inp["Relation"], self.yes_no_threshold)
+        logger.debug(f"P(yes) of `{inp['SubjectEntity']}` for `{inp['Relation']}`: {probability:.3f}")
+        answers.append(['Yes'] if probability >= threshold else ['No'])
+        self.yes_no_stats["scored"] += 1
+        self.yes_no_stats["yes"] += probability >= threshold
+        self.yes_no_stats["probability_sum"] += probability
+      return answers
+
+    def pipe_batch(self, prompt_batch):
+        # keeps the KV caches of the conversations that may be re-asked, and continues them in the follow-ups
+        if self.conversation_cache is None:
+            return super().pipe_batch(prompt_batch)
+        return self.conversation_cache.generate_batch(
+            prompt_batch, generation_config=self.pipe.generation_config, **self.generation_kwargs())
+
+    def generation_kwargs(self) -> dict:
+        kwargs = super().generation_kwargs()
+        if self.stop_at_final_answer:
+            kwargs["stopping_criteria"] = StoppingCriteriaList([FinalAnswerStoppingCriteria(
+                self.tokenizer, self.closing_token_ids, self.max_new_tokens, self.final_answer_stats)])
+        if self.constrained_answers:
+            kwargs["logits_processor"] = LogitsProcessorList([FinalAnswerLogitsProcessor(
+                self.answer_vocabulary, self.answer_shape, self.max_new_tokens, self.constrained_answer_tokens)])
+        return kwargs
+
     def combine_lists(self, list1, list2):
       return list1 or list2 or list1 + list2
         
-    def clean_output(self, output, prompt):
-      # returns a list of the answers generated by the prompt
-      clean_output = output[0]["generated_text"][len(prompt):].strip()
-      matches_underscore = regex.findall(r'final_answer\s?=\s?\[([^\]]*)\]', clean_output)
-      matches_space = regex.findall(r'Final answer\s?[=?:?]\s?\[([^\]]*)\]', clean_output)
+    def clean_output(self, output):
+      # returns a list of the answers in the completion of a prompt
+      clean_output = output[0]["generated_text"].strip()
+      matches_underscore = FINAL_ANSWER_UNDERSCORE.findall(clean_output)
+      matches_space = FINAL_ANSWER_SPACE.findall(clean_output)
       
       matches_combined = self.combine_lists(matches_underscore, matches_space)
-      matches_none = regex.findall(r'[Aa]nswer\s?[\w*\s?]*:\s?\[([^\]]*)\]', clean_output)                 
+      matches_none = ANSWER_COLON.findall(clean_output)                 
       
       final_combined = self.combine_lists(matches_combined, matches_none)
       # edge case: sometimes LLM will answer Yes/No questions with Yes/No followed by the answer itself
@@ -129,88 +351,136 @@ class Llama3DualPrompt(Llama3ChatModel):
 
 
     def use_looping_prompts(self, inp, info_strategy):
+      return self.use_looping_prompts_batch([inp], info_strategy)[0]
+
+    def use_looping_prompts_batch(self, inps, info_strategy):
       # strategy used in experiments for seriesHasNumberOfEpisodes
       # strategy used for awardWonBy
-      prompt_further_info = self.create_prompt(
+      # the first prompt asks for the founding year / number of seasons of every input,
+      # then the sub-queries for all years / seasons of all inputs are batched together
+      answers = [[] for _ in inps]
+      prompts_further_info = [self.create_prompt(
                 subject_entity=inp["SubjectEntity"],
                 relation=inp["Relation"],
                 entity_entry=inp,
                 info_strategy=info_strategy,
                 stage=2
-            )
+            ) for inp in inps]
 
-      output = self.pipe(
-                prompt_further_info,
-                max_new_tokens=self.max_new_tokens,
-                eos_token_id=self.terminators,
-            )
-      further_info = self.clean_output(output, prompt_further_info)
-      if not further_info:
-        response_only = output[0]["generated_text"][len(prompt_further_info):].strip()
-        new_response = self.re_ask_model(prev_answer=response_only,
-                                        relation=inp["Relation"], 
-                                        entity_entry=inp, 
-                                        info_strategy=info_strategy, 
-                                        stage=2, 
-                                        subject_entity=inp["SubjectEntity"])
-        if not new_response:
-          return []
+      outputs = self.generate_stage(prompts_further_info, stage=2, desc="Stage 2")
+      further_infos = [self.clean_output(output) for output in outputs]
+
+      failed = [i for i, further_info in enumerate(further_infos) if not further_info]
+      new_responses = self.re_ask_model_batch([dict(
+                prev_answer=outputs[i][0]["generated_text"].strip(),
+                output=outputs[i],
+                relation=inps[i]["Relation"],
+                entity_entry=inps[i],
+                info_strategy=info_strategy,
+                stage=2,
+                subject_entity=inps[i]["SubjectEntity"]) for i in failed])
+      for i, new_response in zip(failed, new_responses):
+        further_infos[i] = new_response
+
+      # (input index, loop counter, extra info) of every sub-query
+      sub_queries = []
+      running_sums = {}
+      for i, (inp, further_info) in enumerate(zip(inps, further_infos)):
+        if not further_info:
+          continue
+        try:
+          answer = further_info[0]
+
+          start_count = int(answer) if inp["Relation"]=='awardWonBy' else 1
+          end_count = int(answer) if inp["Relation"]=='seriesHasNumberOfEpisodes' else 2024
+        except:
+          logger.debug(f"Could not convert `{further_info[0]}` of `{inp['SubjectEntity']}` to a year or number of seasons")
+          continue
+
+        if inp["Relation"]=='awardWonBy':
+          counts = self.award_years(start_count, end_count)
         else:
-          further_info = new_response
-
-      try:
-        answer = further_info[0]
-
-        start_count = int(answer) if inp["Relation"]=='awardWonBy' else 1
-        end_count = int(answer) if inp["Relation"]=='seriesHasNumberOfEpisodes' else 2024
-
-        final_answer = []
-        running_sum = 0
-        for i in range(start_count, end_count):
-          extra_info = str(i) + ' ' if inp["Relation"]=='awardWonBy' else str(i) + ' of '
-          if inp["Relation"]=='seriesHasNumberOfEpisodes':
-            
-            prompt = self.create_prompt(
-                subject_entity= extra_info + inp["SubjectEntity"],
-                relation=inp["Relation"],
-                entity_entry=inp,
+          counts = range(start_count, end_count)
+          running_sums[i] = 0
+        for count in counts:
+          extra_info = str(count) + ' ' if inp["Relation"]=='awardWonBy' else str(count) + ' of '
+          sub_queries.append((i, count, extra_info))
+
+      award_queries = [q for q in sub_queries if inps[q[0]]["Relation"]=='awardWonBy']
+      season_queries = [q for q in sub_queries if inps[q[0]]["Relation"]=='seriesHasNumberOfEpisodes']
+
+      # awards: dual prompting for all years at once, winners are listed in year order
+      year_answers = self.use_dual_prompting_batch([inps[i] for i, _, _ in award_queries],
+                                                   info_strategy=info_strategy,
+                                                   extra_infos=[extra_info for _, _, extra_info in award_queries])
+      for (i, _, _), ith_answer in zip(award_queries, year_answers):
+        answers[i].extend(ith_answer)
+
+      # series: number of episodes of every season, summed up per series
+      prompts = [self.create_prompt(
+                subject_entity=extra_info + inps[i]["SubjectEntity"],
+                relation=inps[i]["Relation"],
+                entity_entry=inps[i],
                 info_strategy=info_strategy,
                 stage=1
-            )
-            output = self.pipe(
-                        prompt,
-                        max_new_tokens=self.max_new_tokens,
-                        eos_token_id=self.terminators,
-                    )
-            ith_answer = self.clean_output(output, prompt)
-            # print('Loop ' + str(i) + ': ' + output[0]["generated_text"][len(prompt):].strip())
-
-            int_answers = [num for num in ith_answer if num.isdigit()] 
-            if not int_answers:
-              response_only = output[0]["generated_text"][len(prompt):].strip()
-              ith_answer = self.re_ask_model(prev_answer=response_only,
-                                        relation=inp["Relation"], 
-                                        entity_entry=inp, 
-                                        info_strategy=info_strategy, 
-                                        stage=1, 
-                                        subject_entity=extra_info + inp["SubjectEntity"])
-            try:
-              if ith_answer:
-                num_ep_per_season = int(ith_answer[0])
-                running_sum += num_ep_per_season
-            except:
-              logger.error(f"Error getting number of episodes for season {i} of " + inp["SubjectEntity"])
-          else:
-            ith_answer = self.use_dual_prompting(inp, info_strategy=info_strategy, extra_info=extra_info)
-            final_answer.append(ith_answer)
-
-        return [str(running_sum)] if inp["Relation"]=='seriesHasNumberOfEpisodes' else [x for xs in final_answer for x in xs]
-      except:
-        print('could not convert')
-        return []
-
-
-    def re_ask_model(self, prev_answer, relation, entity_entry, info_strategy, stage, subject_entity):
+            ) for i, _, extra_info in season_queries]
+      outputs = self.generate_stage(prompts, stage=1, desc="Seasons")
+      season_answers = [self.clean_output(output) for output in outputs]
+      # print('Loop ' + str(i) + ': ' + output[0]["generated_text"].strip())
+
+      failed = [k for k, ith_answer in enumerate(season_answers)
+                if not [num for num in ith_answer if num.isdigit()]]
+      new_responses = self.re_ask_model_batch([dict(
+                prev_answer=outputs[k][0]["generated_text"].strip(),
+                output=outputs[k],
+                relation=inps[season_queries[k][0]]["Relation"],
+                entity_entry=inps[season_queries[k][0]],
+                info_strategy=info_strategy,
+                stage=1,
+                subject_entity=season_queries[k][2] + inps[season_queries[k][0]]["SubjectEntity"]) for k in failed])
+      for k, new_response in zip(failed, new_responses):
+        season_answers[k] = new_response
+
+      for (i, count, _), ith_answer in zip(season_queries, season_answers):
+        try:
+          if ith_answer:
+            num_ep_per_season = int(ith_answer[0])
+            running_sums[i] += num_ep_per_season
+        except:
+          logger.error(f"Error getting number of episodes for season {count} of " + inps[i]["SubjectEntity"])
+
+      for i, running_sum in running_sums.items():
+        answers[i] = [str(running_sum)]
+
+      return answers
+
+    def award_years(self, start_year, end_year):
+      # years to ask about for an award, capped at award_max_years sub-queries
+      years = list(range(start_year, end_year))
+      if self.award_max_years and len(years) > self.award_max_years:
+        if self.award_year_sampling == 'uniform':
+          # evenly spaced years, always including the most recent one
+          step = (len(years) - 1) / max(self.award_max_years - 1, 1)
+          years = sorted({years[-1 - round(k * step)] for k in range(self.award_max_years)})
+        else:
+          # most recent years
+          years = years[-self.award_max_years:]
+      return years
+
+
+    def re_ask_model(self, prev_answer, relation, entity_entry, info_strategy, stage, subject_entity, output=None):
+      return self.re_ask_model_batch([dict(prev_answer=prev_answer,
+                                           output=output,
+                                           relation=relation,
+                                           entity_entry=entity_entry,
+                                           info_strategy=info_strategy,
+                                           stage=stage,
+                                           subject_entity=subject_entity)])[0]
+
+    def re_ask_model_batch(self, reasks):
+      # reasks: list of dicts with the keyword arguments of re_ask_model
+      # (output is the pipeline output of the prompt being re-asked)
+      # all prompts are sent to the model together
       repeat_prompt =  """
       Answer: {answer}. 
       This answer is not formatted properly. Provide just the direct answer as a list (e.g. [Yes] or [2023]).
@@ -219,173 +489,282 @@ class Llama3DualPrompt(Llama3ChatModel):
       If you believe that the answer is incorrect, also use your expertiese to correct it.
       Your final/direct answer should be on the last line and should be formatted like a list. Your final answer should look like this: final_answer = [YOUR FINAL ANSWER HERE]. """
 
-      prompt = self.create_prompt(
-                subject_entity=subject_entity,
-                relation=relation,
-                entity_entry=entity_entry,
-                info_strategy=info_strategy,
-                stage=stage,
-                reask=repeat_prompt.format(answer = prev_answer)
-                )
-
-      output = self.pipe(
-                prompt,
-                max_new_tokens=self.max_new_tokens,
-                eos_token_id=self.terminators,
-            )
-      new_answer = self.clean_output(output, prompt)
-      # print('Asking again: ' + output[0]["generated_text"][len(prompt):].strip())
+      if not reasks:
+        return []
 
-      return new_answer
+      prompts = [self.create_prompt(
+                subject_entity=r["subject_entity"],
+                relation=r["relation"],
+                entity_entry=r["entity_entry"],
+                info_strategy=r["info_strategy"],
+                stage=r["stage"],
+                reask=repeat_prompt.format(answer = r["prev_answer"])
+                ) for r in reasks]
+      if self.reask_followup:
+        # continue the conversations of the generations instead, when their outputs are given
+        prompts = [self.followup_prompt(prompt, r["output"]) if r.get("output") else prompt
+                   for prompt, r in zip(prompts, reasks)]
+
+      if self.metrics is not None:
+        for r in reasks:
+          self.metrics.inc("clean_output_failures_total", stage=str(r["stage"]), **self.metric_labels)
+      outputs = self.generate_stage(prompts, stage=reasks[0]["stage"], desc="Re-asking", call="reask")
+      new_answers = [self.clean_output(output) for output in outputs]
+      if self.metrics is not None:
+        for r, new_answer in zip(reasks, new_answers):
+          if not new_answer:
+            self.metrics.inc("reask_failures_total", stage=str(r["stage"]), **self.metric_labels)
+      # print('Asking again: ' + output[0]["generated_text"].strip())
+
+      return new_answers
 
     def use_dual_prompting(self, inp, info_strategy, extra_info=''):
+      return self.use_dual_prompting_batch([inp], info_strategy, extra_infos=[extra_info])[0]
+
+    def use_dual_prompting_batch(self, inps, info_strategy, extra_infos=None):
       # this strategy is split into two steps: the first asks the LLM a yes/no question
       # that helps us narrow down the answer / handle nulls
+      # each step (and its re-asks) runs for all inputs at once
+      extra_infos = extra_infos or [''] * len(inps)
+      subject_entities = [extra_info + inp["SubjectEntity"] for inp, extra_info in zip(inps, extra_infos)]
+      answers = [[] for _ in inps]
 
       # first prompt is a yes/no question
-      first_prompt = self.create_prompt(
-                subject_entity= extra_info + inp["SubjectEntity"],
+      first_prompts = [self.create_prompt(
+                subject_entity=subject_entity,
                 relation=inp["Relation"],
                 entity_entry=inp,
                 info_strategy=info_strategy,
                 stage=0
-            )
+            ) for inp, subject_entity in zip(inps, subject_entities)]
 
-      output = self.pipe(
-                first_prompt,
-                max_new_tokens=self.max_new_tokens,
-                eos_token_id=self.terminators,
-            )
-      second_phase = self.clean_output(output, first_prompt)
+      if self.yes_no_scoring:
+        second_phases = self.score_stage_0(inps, first_prompts)
+        failed = []
+      else:
+        outputs = self.generate_stage(first_prompts, stage=0, desc="Stage 0")
+        second_phases = [self.clean_output(output) for output in outputs]
 
-      # print('Output 1: ' + output[0]["generated_text"][len(first_prompt):].strip())
-      
-      if not second_phase:
-        response_only = output[0]["generated_text"][len(first_prompt):].strip()
-        new_response = self.re_ask_model(prev_answer=response_only,
-                                        relation=inp["Relation"], 
-                                        entity_entry=inp, 
-                                        info_strategy=info_strategy, 
-                                        stage=0, 
-                                        subject_entity=extra_info + inp["SubjectEntity"])
-        if not new_response:
-          return []
-        else:
-          second_phase = new_response
-      
-      if second_phase[0].lower() == 'yes':
-        second_prompt = self.create_prompt(
-                subject_entity=extra_info + inp["SubjectEntity"],
-                relation=inp["Relation"],
-                entity_entry=inp,
+        # print('Output 1: ' + output[0]["generated_text"].strip())
+
+        failed = [i for i, second_phase in enumerate(second_phases) if not second_phase]
+      new_responses = self.re_ask_model_batch([dict(
+                prev_answer=outputs[i][0]["generated_text"].strip(),
+                output=outputs[i],
+                relation=inps[i]["Relation"],
+                entity_entry=inps[i],
+                info_strategy=info_strategy,
+                stage=0,
+                subject_entity=subject_entities[i]) for i in failed])
+      for i, new_response in zip(failed, new_responses):
+        second_phases[i] = new_response
+
+      yes = [i for i, second_phase in enumerate(second_phases)
+             if second_phase and second_phase[0].lower() == 'yes']
+      if not yes:
+        return answers
+
+      second_prompts = [self.create_prompt(
+                subject_entity=subject_entities[i],
+                relation=inps[i]["Relation"],
+                entity_entry=inps[i],
                 info_strategy=info_strategy,
                 stage=1
-                )
-        output = self.pipe(
-                second_prompt,
-                max_new_tokens=self.max_new_tokens,
-                eos_token_id=self.terminators,
-            )
-        
-        # print('Output 2: ' + output[0]["generated_text"][len(second_prompt):].strip())
-
-        final_result = self.clean_output(output, second_prompt)
-
-        if not final_result:
-          response_only = output[0]["generated_text"][len(second_prompt):].strip()
-          return self.re_ask_model(prev_answer=response_only,
-                                        relation=inp["Relation"], 
-                                        entity_entry=inp, 
-                                        info_strategy=info_strategy, 
-                                        stage=1, 
-                                        subject_entity=extra_info + inp["SubjectEntity"])
+                ) for i in yes]
+      outputs = self.generate_stage(second_prompts, stage=1, desc="Stage 1")
+
+      # print('Output 2: ' + output[0]["generated_text"].strip())
+
+      failed = []
+      for i, output, second_prompt in zip(yes, outputs, second_prompts):
+        final_result = self.clean_output(output)
+        if final_result:
+          answers[i] = final_result
         else:
-          return final_result
-      else:
-        return []
+          failed.append((i, output))
+
+      new_responses = self.re_ask_model_batch([dict(
+                prev_answer=output[0]["generated_text"].strip(),
+                output=output,
+                relation=inps[i]["Relation"],
+                entity_entry=inps[i],
+                info_strategy=info_strategy,
+                stage=1,
+                subject_entity=subject_entities[i]) for i, output in failed])
+      for (i, _), new_response in zip(failed, new_responses):
+        answers[i] = new_response
+
+      return answers
 
     def direct_strategy(self, inp, info_strategy):
-      prompt = self.create_prompt(
+      return self.direct_strategy_batch([inp], info_strategy)[0]
+
+    def direct_strategy_batch(self, inps, info_strategy):
+      prompts = [self.create_prompt(
                 subject_entity=inp["SubjectEntity"],
                 relation=inp["Relation"],
                 entity_entry=inp,
                 info_strategy=info_strategy,
                 stage=3
-            )
-
-      output = self.pipe(
-                prompt,
-                max_new_tokens=self.max_new_tokens,
-                eos_token_id=self.terminators,
-            )
-      further_info = self.clean_output(output, prompt)
-      if inp["Relation"] == 'seriesHasNumberOfEpisodes':
-        further_info = [a.split(',') for a in further_info]
-        further_info = [x for xs in further_info for x in xs]
-        further_info = [int(x) for x in further_info if x.isdigit()] 
-
-      if not further_info:
-        response_only = output[0]["generated_text"][len(prompt):].strip()
-        new_response = self.re_ask_model(prev_answer=response_only,
-                                        relation=inp["Relation"], 
-                                        entity_entry=inp, 
-                                        info_strategy=info_strategy, 
-                                        stage=3, 
-                                        subject_entity=inp["SubjectEntity"])
-        print('new response: ')
-        print(new_response)
+            ) for inp in inps]
+
+      outputs = self.generate_stage(prompts, stage=3, desc="Direct")
+      answers = []
+      for inp, output, prompt in zip(inps, outputs, prompts):
+        further_info = self.clean_output(output)
+        if inp["Relation"] == 'seriesHasNumberOfEpisodes':
+          further_info = [a.split(',') for a in further_info]
+          further_info = [x for xs in further_info for x in xs]
+          further_info = [int(x) for x in further_info if x.isdigit()]
+        answers.append(further_info)
+
+      failed = [i for i, further_info in enumerate(answers) if not further_info]
+      answers = [[sum(further_info)] if inp["Relation"] == 'seriesHasNumberOfEpisodes' else further_info
+                 for inp, further_info in zip(inps, answers)]
+
+      new_responses = self.re_ask_model_batch([dict(
+                prev_answer=outputs[i][0]["generated_text"].strip(),
+                output=outputs[i],
+                relation=inps[i]["Relation"],
+                entity_entry=inps[i],
+                info_strategy=info_strategy,
+                stage=3,
+                subject_entity=inps[i]["SubjectEntity"]) for i in failed])
+      for i, new_response in zip(failed, new_responses):
+        logger.debug(f"Re-asked `{inps[i]['SubjectEntity']}`: {new_response}")
         if not new_response:
-          return []
+          answers[i] = []
+        elif inps[i]["Relation"] == 'seriesHasNumberOfEpisodes':
+          further_info = [a.split(',') for a in new_response]
+          further_info = [x for xs in further_info for x in xs]
+          further_info = [int(x) for x in further_info if x.isdigit()]
+          answers[i] = [sum(further_info)]
         else:
-          if inp["Relation"] == 'seriesHasNumberOfEpisodes':
-            further_info = [a.split(',') for a in new_response]
-            further_info = [x for xs in further_info for x in xs]
-            further_info = [int(x) for x in further_info if x.isdigit()]
-          else:
-            further_info = new_response  
+          answers[i] = new_response
 
-      
-      return [sum(further_info)] if inp["Relation"] == 'seriesHasNumberOfEpisodes' else further_info
+      return answers
 
     def generate_predictions(self, inputs):
         # which type of additional info to use; leave empty if none
         info_strategy = ['additionalData', 'wikipediaExtract']
         logger.info("Generating predictions...")
         # which prompting strategy to use with each relation
-        exec_strategy = {'awardWonBy': self.use_looping_prompts,
-        'seriesHasNumberOfEpisodes': self.direct_strategy,
-        'countryLandBordersCountry': self.use_dual_prompting,
-        'companyTradesAtStockExchange': self.use_dual_prompting,
-        'personHasCityOfDeath': self.use_dual_prompting,}
-
+        # every strategy runs stage by stage over all inputs of its relation
+        exec_strategy = {'awardWonBy': self.use_looping_prompts_batch,
+        'seriesHasNumberOfEpisodes': self.direct_strategy_batch,
+        'countryLandBordersCountry': self.use_dual_prompting_batch,
+        'companyTradesAtStockExchange': self.use_dual_prompting_batch,
+        'personHasCityOfDeath': self.use_dual_prompting_batch,}
+
+        inputs_per_relation = {}
+        for i, inp in enumerate(inputs):
+            inputs_per_relation.setdefault(inp["Relation"], []).append(i)
+
+        # with prefix caching, a relation is processed in chunks whose prefixes fit in the cache
+        chunk_size = max(1, self.prefix_cache.max_entries // 2) if self.prefix_cache is not None else len(inputs)
+
+        qa_answers = [[] for _ in inputs]
+        reask_stats_before = self.reask_stats.copy()
+        for relation, indices in inputs_per_relation.items():
+            logger.info(f"Generating predictions for `{relation}` ({len(indices):,} inputs)...")
+            stats_before = self.final_answer_stats.copy()
+            yes_no_before = self.yes_no_stats.copy()
+            self.current_relation = relation
+            self.metric_labels = {"relation": relation,
+                                  "strategy": exec_strategy[relation].__name__.replace("_batch", "")}
+            if self.metrics is not None:
+                self.metrics.inc("inputs_total", len(indices), **self.metric_labels)
+            for start in range(0, len(indices), chunk_size):
+                chunk = indices[start:start + chunk_size]
+                answers = exec_strategy[relation]([inputs[i] for i in chunk], info_strategy=info_strategy)
+                for i, qa_answer in zip(chunk, answers):
+                    qa_answers[i] = qa_answer
+            if self.stop_at_final_answer:
+                self.log_final_answer_stats(self.final_answer_stats - stats_before, relation)
+            if self.yes_no_stats["scored"] > yes_no_before["scored"]:
+                self.log_yes_no_stats(self.yes_no_stats - yes_no_before, relation)
+        if self.stop_at_final_answer:
+            self.log_final_answer_stats(self.final_answer_stats, "all relations")
+        if self.prefix_cache is not None:
+            self.prefix_cache.log_stats()
+        elif self.conversation_cache is not None:
+            self.conversation_cache.log_stats("Conversation cache")
+        reask_stats = self.reask_stats - reask_stats_before
+        num_generations = reask_stats["ask"] + reask_stats["reask"]
+        logger.info(f"Re-asked {reask_stats['reask']:,} of {num_generations:,} generations "
+                    f"(re-ask rate {reask_stats['reask'] / num_generations if num_generations else 0:.1%}).")
+
+        # Resolve all entities of the run at once
+        start = time.perf_counter()
+        split_answers = self.split_entities_batch(qa_answers)
+        num_entities = sum(len(split) for split in split_answers)
+        elapsed = time.perf_counter() - start
+        if self.metrics is not None:
+          self.metrics.observe("title_stripping_seconds", elapsed)
+        if num_entities:
+          logger.info(f"Stripped titles from {num_entities:,} entities in {elapsed:.2f}s "
+                      f"({1000 * elapsed / num_entities:.3f}s per 1k entities).")
+        start = time.perf_counter()
+        self.resolution_stage([[part for _, parts in split for part in parts]
+                               for split in split_answers])
+
+        logger.info("Disambiguating entities...")
         results = []
-        for inp in tqdm(inputs, desc="Generating predictions"):
+        for inp, split in zip(inputs, split_answers):
+            wikidata_ids = self.disambiguate_split_entities(split)
 
-            qa_answer = exec_strategy[inp["Relation"]](inp, info_strategy=info_strategy) 
-            wikidata_ids = self.disambiguate_entities(qa_answer)
-            
             results.append({
                 "SubjectEntityID": inp["SubjectEntityID"],
                 "SubjectEntity": inp["SubjectEntity"],
                 "Relation": inp["Relation"],
                 "ObjectEntitiesID": wikidata_ids,
             })
+        if self.metrics is not None:
+            self.metrics.observe("disambiguation_seconds", time.perf_counter() - start)
+        self.log_generation_cache_stats()
+        self.log_speculative_stats()
+        self.log_disambiguation_stats()
+        if self.metrics is not None:
+            self.metrics.log_summary()
+            self.metrics.write()
 
         return results
 
+    def log_yes_no_stats(self, stats, relation):
+        threshold = self.yes_no_thresholds.get(relation, self.yes_no_threshold)
+        logger.info(f"Scored stage 0 of {stats['scored']:,} inputs of `{relation}`: "
+                    f"{stats['yes']:,} yes at threshold {threshold} "
+                    f"(mean P(yes) {stats['probability_sum'] / stats['scored']:.3f}).")
+
+    def log_final_answer_stats(self, stats, name):
+      logger.info(f"Stopped {stats['stopped']:,} of {stats['sequences']:,} generations for {name} "
+                  f"at the final answer, saving up to {stats['tokens_saved']:,} tokens.")
+
     def is_valid_wikidata_id(self, wiki_id):
       return wiki_id.startswith("Q")
 
 
-    def disambiguate_entities(self, qa_answer: str):
-        wikidata_ids = []
+    def split_entities(self, qa_answer):
+        # returns (entity, strings to look up) pairs for the entities of an answer
+        return self.split_entities_batch([qa_answer])[0]
+
+    def split_entities_batch(self, qa_answers):
+        # splits all answers first, then strips the titles of all their strings in one NER batch
+        raw_answers = [self.split_raw_entities(qa_answer) for qa_answer in qa_answers]
+        texts = [part for raw in raw_answers for entity, parts, clean in raw if clean for part in parts]
+        cleaned = iter(remove_titles_batch(texts))
+        return [[(entity, [next(cleaned) for _ in parts] if clean else parts) for entity, parts, clean in raw]
+                for raw in raw_answers]
+
+    def split_raw_entities(self, qa_answer):
+        # returns (entity, strings to look up, whether to strip titles) triples
         if any(isinstance(x, int) for x in qa_answer):
-          wikidata_id = self.disambiguation_baseline(qa_answer[0])
-          return [wikidata_id]
+          return [(qa_answer[0], [qa_answer[0]], False)]
 
         qa_entities = [a.split(',') for a in qa_answer]
         flat_entities = [x for xs in qa_entities for x in xs]
 
+        split_answer = []
         for entity in flat_entities:
             # further clean up string
             entity = entity.strip()
@@ -396,8 +775,18 @@ class Llama3DualPrompt(Llama3ChatModel):
             # handle edge case for stock exchanges
             split_entity = entity.split('(')
             if len(split_entity) > 1:
-              wikidata_id_part1 = self.disambiguation_baseline(remove_titles_with_spacy(split_entity[0]))
-              wikidata_id_part2 = self.disambiguation_baseline(remove_titles_with_spacy(split_entity[1]))
+              split_answer.append((entity, [split_entity[0], split_entity[1]], True))
+            else:
+              if entity.startswith("and "):
+                  entity = entity[4:].strip()
+              split_answer.append((entity, [entity], True))
+        return split_answer
+
+    def disambiguate_split_entities(self, split_answer):
+        wikidata_ids = []
+        for entity, parts in split_answer:
+            if len(parts) > 1:
+              wikidata_id_part1, wikidata_id_part2 = self.disambiguation_batch(parts)
               if wikidata_id_part1 == wikidata_id_part2 or self.is_valid_wikidata_id(wikidata_id_part1):
                 wikidata_ids.append(wikidata_id_part1)
               elif self.is_valid_wikidata_id(wikidata_id_part2):
@@ -405,9 +794,13 @@ class Llama3DualPrompt(Llama3ChatModel):
               else:
                 wikidata_ids.append(entity)
             else:
-              if entity.startswith("and "):
-                  entity = entity[4:].strip()
-              wikidata_id = self.disambiguation_baseline(remove_titles_with_spacy(entity))
+              wikidata_id = self.disambiguation_baseline(parts[0])
               if wikidata_id:
                   wikidata_ids.append(wikidata_id)
         return wikidata_ids
+
+    def disambiguate_entities(self, qa_answer: str):
+        split_answer = self.split_entities(qa_answer)
+        # resolve all strings of the answer concurrently first
+        self.resolve_wikidata_ids([str(part).strip() for _, parts in split_answer for part in parts])
+        return self.disambiguate_split_entities(split_answer)
@@ -0,0 +1,258 @@
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import regex
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+# The answer formats accepted by `Llama3DualPrompt.clean_output`
+FINAL_ANSWER_UNDERSCORE = regex.compile(r'final_answer\s?=\s?\[([^\]]*)\]')
+FINAL_ANSWER_SPACE = regex.compile(r'Final answer\s?[=?:?]\s?\[([^\]]*)\]')
+ANSWER_COLON = regex.compile(r'[Aa]nswer\s?[\w*\s?]*:\s?\[([^\]]*)\]')
+
+FINAL_ANSWER_PATTERNS = (FINAL_ANSWER_UNDERSCORE, FINAL_ANSWER_SPACE,
+                         ANSWER_COLON)
+
+# An answer list in any accepted format that is opened but not closed yet
+OPEN_ANSWER = regex.compile(
+    r'(?:final_answer\s?=\s?|Final answer\s?[=?:?]\s?|[Aa]nswer\s?[\w*\s?]*:\s?)'
+    r'\[([^\]\[]*)$')
+
+# Shapes of the answer lists of constrained decoding
+YES_NO = "yes_no"
+INTEGERS = "integers"
+NAMES = "names"
+
+# Text forced when a sequence has to answer, and the yes/no answers with their closing bracket
+ANSWER_PREFIX = "\nfinal_answer = ["
+YES_NO_ANSWERS = ("Yes]", "No]", "yes]", "no]")
+
+
+def has_final_answer(text: str) -> bool:
+    """Whether the text contains a complete answer list in any accepted format."""
+    return any(pattern.search(text) for pattern in FINAL_ANSWER_PATTERNS)
+
+
+def closing_bracket_token_ids(tokenizer) -> Set[int]:
+    """IDs of the vocabulary tokens that contain a closing bracket."""
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    return {i for i, token in enumerate(tokens) if token and "]" in token}
+
+
+def yes_no_token_ids(tokenizer) -> Tuple[List[int], List[int]]:
+    """IDs of the first tokens of the yes and of the no answers after `final_answer = [`."""
+    prefix_ids = tokenizer.encode(ANSWER_PREFIX, add_special_tokens=False)
+    token_ids = {"yes": set(), "no": set()}
+    for answer in YES_NO_ANSWERS:
+        ids = tokenizer.encode(ANSWER_PREFIX + answer, add_special_tokens=False)
+        if ids[:len(prefix_ids)] != prefix_ids:
+            # the answer merges with the bracket, so it is scored on its own
+            ids = prefix_ids + tokenizer.encode(answer, add_special_tokens=False)
+        token_ids[answer[:-1].lower()].add(ids[len(prefix_ids)])
+    return sorted(token_ids["yes"]), sorted(token_ids["no"])
+
+
+class FinalAnswerStoppingCriteria(StoppingCriteria):
+    """Stops every sequence of a batch once it has generated a complete answer list.
+
+    The generated text of a sequence is only decoded and matched against the
+    answer patterns when one of its new tokens contains a closing bracket.
+    The number of sequences, stopped sequences and tokens left of the
+    `max_new_tokens` budget are added to `stats`. Call `start` with the
+    (padded) prompt length before every call to `generate`: assisted
+    generation adds several tokens per step, so it cannot be inferred.
+    """
+
+    def __init__(self, tokenizer, closing_token_ids: Set[int],
+                 max_new_tokens: int, stats: Counter):
+        self.tokenizer = tokenizer
+        self.closing_token_ids = closing_token_ids
+        self.max_new_tokens = max_new_tokens
+        self.stats = stats
+
+        self.prompt_length = None
+        self.checked_length = None
+        self.stopped: List[bool] = []
+
+    def describe(self) -> dict:
+        """The settings of the criterion, for the generation cache key."""
+        return {"max_new_tokens": self.max_new_tokens}
+
+    def start(self, prompt_length: int):
+        """Reset the criterion for a generation whose prompts have `prompt_length` tokens."""
+        self.prompt_length = self.checked_length = prompt_length
+        self.stopped = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor,
+                 **kwargs) -> torch.BoolTensor:
+        batch_size, length = input_ids.shape
+        if self.prompt_length is None:
+            raise ValueError("Call `start` with the prompt length before generating.")
+        if not self.stopped:
+            self.stopped = [False] * batch_size
+            self.stats["sequences"] += batch_size
+
+        new_tokens = input_ids[:, self.checked_length:].tolist()
+        self.checked_length = length
+
+        for i, tokens in enumerate(new_tokens):
+            if self.stopped[i] or self.closing_token_ids.isdisjoint(tokens):
+                continue
+            text = self.tokenizer.decode(input_ids[i, self.prompt_length:],
+                                         skip_special_tokens=True)
+            if has_final_answer(text):
+                self.stopped[i] = True
+                self.stats["stopped"] += 1
+                self.stats["tokens_saved"] += max(
+                    0, self.max_new_tokens - (length - self.prompt_length))
+
+        return torch.tensor(self.stopped, dtype=torch.bool,
+                            device=input_ids.device)
+
+
+class AnswerVocabulary:
+    """The vocabulary tokens that may appear in each shape of answer list, computed once per tokenizer."""
+
+    def __init__(self, tokenizer, terminator_ids: Sequence[int]):
+        self.texts = tokenizer.batch_decode(
+            [[i] for i in range(len(tokenizer))],
+            clean_up_tokenization_spaces=False)
+        # Special and added tokens are never part of an answer
+        for i in set(tokenizer.added_tokens_decoder) | set(tokenizer.all_special_ids):
+            self.texts[i] = ""
+
+        self.prefix_ids = tokenizer.encode(ANSWER_PREFIX, add_special_tokens=False)
+        self.yes_no_ids = [i for i, text in enumerate(self.texts)
+                           if text and any(text in answer for answer in YES_NO_ANSWERS)]
+        close_ids = [i for i, text in enumerate(self.texts) if text.strip() == "]"]
+        integer_ids = [i for i, text in enumerate(self.texts)
+                       if text.strip() and set(text) <= set("0123456789, ")]
+        name_ids = [i for i, text in enumerate(self.texts)
+                    if text and not set(text) & set("\n[]")]
+
+        # Token sets that are allowed as a whole, by name
+        self.token_sets = {
+            "terminators": [i for i in terminator_ids if i is not None],
+            "close": close_ids,
+            INTEGERS: integer_ids,
+            INTEGERS + "_close": integer_ids + close_ids,
+            NAMES: name_ids,
+            NAMES + "_close": name_ids + close_ids,
+        }
+        # (token set name or IDs, vocabulary size, device) -> mask of the allowed tokens
+        self.masks: Dict[tuple, torch.BoolTensor] = {}
+
+    def mask(self, tokens: Union[str, List[int]], size: int,
+             device) -> torch.BoolTensor:
+        """Mask of a named token set or of a few token IDs."""
+        key = (tokens if isinstance(tokens, str) else tuple(tokens), size, device)
+        if key not in self.masks:
+            ids = self.token_sets[tokens] if isinstance(tokens, str) else tokens
+            mask = torch.zeros(size, dtype=torch.bool, device=device)
+            mask[[i for i in ids if i < size]] = True
+            self.masks[key] = mask
+        return self.masks[key]
+
+
+class FinalAnswerLogitsProcessor(LogitsProcessor):
+    """Makes every sequence of a batch end with a complete `final_answer = [...]` list of the given shape.
+
+    A sequence generates freely, but cannot end before it has closed an
+    answer list. Once it opens a list in any accepted format, or when only
+    `answer_tokens` tokens of the `max_new_tokens` budget are left (the
+    prefix `final_answer = [` is then forced), the tokens of the list are
+    restricted to the shape: yes or no, at least one integer, or names (a
+    list of names may be empty). The list is closed at the latest on the
+    last token, and the sequence then ends. Use a
+    new instance for every call to `generate`.
+    """
+
+    def __init__(self, vocabulary: AnswerVocabulary, shape: str,
+                 max_new_tokens: int, answer_tokens: int = 32):
+        self.vocabulary = vocabulary
+        self.shape = shape
+        self.max_new_tokens = max_new_tokens
+        self.answer_tokens = answer_tokens
+
+        self.prompt_length = None
+        self.states: List[dict] = []
+
+    def describe(self) -> dict:
+        """The settings of the processor, for the generation cache key."""
+        return {"shape": self.shape, "max_new_tokens": self.max_new_tokens,
+                "answer_tokens": self.answer_tokens}
+
+    def advance(self, state: dict, token: int):
+        """Update the state of a sequence with its last token."""
+        texts = self.vocabulary.texts
+        text = texts[token] if token < len(texts) else ""
+        if state["phase"] == "free":
+            state["text"] += text
+            if "[" in text:
+                match = OPEN_ANSWER.search(state["text"][-200:])
+                if match:
+                    state["phase"], state["answer"] = "answer", match.group(1)
+        elif state["phase"] == "forced":
+            state["forced"].pop(0)
+            if not state["forced"]:
+                state["phase"], state["answer"] = "answer", ""
+        elif state["phase"] == "answer":
+            if "]" in text:
+                state["phase"] = "done"
+            else:
+                state["answer"] += text
+
+    def allowed_tokens(self, state: dict, remaining: int) \
+            -> Optional[Union[str, List[int]]]:
+        """The tokens a sequence may generate next (a token set name or IDs), or None if only the terminators are excluded."""
+        vocabulary = self.vocabulary
+        if state["phase"] == "free":
+            if remaining > len(vocabulary.prefix_ids) + self.answer_tokens:
+                return None
+            state["phase"], state["forced"] = "forced", list(vocabulary.prefix_ids)
+        if state["phase"] == "forced":
+            return state["forced"][:1]
+        if state["phase"] == "done":
+            return "terminators"
+
+        answer = state["answer"]
+        if remaining <= 1:
+            return "close"
+        if self.shape == YES_NO:
+            rests = [a[len(answer):] for a in YES_NO_ANSWERS if a.startswith(answer)]
+            ids = [i for i in vocabulary.yes_no_ids
+                   if any(rest.startswith(vocabulary.texts[i]) for rest in rests)]
+            return ids or "close"
+        if self.shape == INTEGERS:
+            # an empty list would fail the digit checks and be re-asked
+            complete = any(c.isdigit() for c in answer)
+        else:
+            # a list of names may be empty
+            complete = not answer or bool(answer.strip())
+        return self.shape + "_close" if complete else self.shape
+
+    def __call__(self, input_ids: torch.LongTensor,
+                 scores: torch.FloatTensor) -> torch.FloatTensor:
+        batch_size, length = input_ids.shape
+        if self.prompt_length is None:
+            # Called before the first new token
+            self.prompt_length = length
+            self.states = [{"phase": "free", "text": "", "answer": "", "forced": []}
+                           for _ in range(batch_size)]
+        else:
+            for state, token in zip(self.states, input_ids[:, -1].tolist()):
+                self.advance(state, token)
+
+        remaining = self.max_new_tokens - (length - self.prompt_length)
+        size = scores.shape[-1]
+        for i, state in enumerate(self.states):
+            tokens = self.allowed_tokens(state, remaining)
+            if tokens is None:
+                scores[i] = scores[i].masked_fill(
+                    self.vocabulary.mask("terminators", size, scores.device),
+                    -float("inf"))
+            else:
+                scores[i] = scores[i].masked_fill(
+                    ~self.vocabulary.mask(tokens, size, scores.device),
+                    -float("inf"))
+        return scores
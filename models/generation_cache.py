@@ -0,0 +1,175 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from loguru import logger
+
+DEFAULT_CACHE_FILE = (Path(__file__).resolve().parent.parent / "cache" /
+                      "generations.sqlite")
+
+
+def describe_argument(o) -> dict:
+    """The JSON description of a generation argument (e.g. a stopping criterion) with a `describe` method."""
+    if not hasattr(o, "describe"):
+        raise TypeError(
+            f"The generation argument `{type(o).__name__}` has no `describe` "
+            f"method, so it cannot be part of a generation cache key.")
+    return {type(o).__name__: o.describe()}
+
+
+def generation_key(model_key: str, prompt: str, generation_kwargs: dict,
+                   occurrence: int = 0) -> str:
+    """A content hash of the model, the rendered prompt and the generation arguments.
+
+    `occurrence` counts the earlier requests of the same generation in a run,
+    so that a repeated prompt (e.g. a re-ask) gets a new sample instead of the
+    cached one. Arguments that are not JSON serializable (e.g. stopping
+    criteria and logits processors) are represented by their `describe`
+    method, which returns the settings that change the output.
+    """
+    payload = json.dumps(
+        [model_key, prompt, generation_kwargs, occurrence],
+        sort_keys=True,
+        default=describe_argument,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    """A persistent SQLite cache of LLM generations.
+
+    Entries are keyed by `generation_key` and store the pipeline output of a
+    prompt as JSON. The least recently used entries are evicted once the
+    outputs exceed `max_size_mb` megabytes.
+    """
+
+    def __init__(self, db_path: Union[str, Path] = DEFAULT_CACHE_FILE,
+                 max_size_mb: float = 1024, busy_timeout: float = 60.0):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 ** 2)
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        # Shards of a run share the file; wait for the write lock of the others
+        self.conn = sqlite3.connect(str(self.db_path),
+                                    timeout=busy_timeout,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            "key TEXT PRIMARY KEY, "
+            "output TEXT NOT NULL, "
+            "created_at REAL NOT NULL, "
+            "accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS generations_accessed_at "
+            "ON generations (accessed_at)"
+        )
+        self.conn.commit()
+        self.count, self.size = self._totals()
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["GenerationCache"]:
+        """Create the cache from the model configuration, or None if disabled."""
+        if not config.get("generation_cache", True):
+            return None
+
+        cache = cls(
+            db_path=config.get("generation_cache_file", DEFAULT_CACHE_FILE),
+            max_size_mb=config.get("generation_cache_max_size_mb", 1024),
+            busy_timeout=config.get("cache_busy_timeout", 60.0),
+        )
+        logger.info(
+            f"Using the generation cache `{cache.db_path}` "
+            f"({cache.count:,} entries, {cache.size / 1024 ** 2:.1f} MB)..."
+        )
+        return cache
+
+    def _totals(self):
+        count, size = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(output)), 0) "
+            "FROM generations").fetchone()
+        return count, size
+
+    def get_many(self, keys: List[str], chunk_size: int = 500) \
+            -> Dict[str, list]:
+        """Return the cached outputs of several keys; keys that miss are left out."""
+        unique_keys = list(dict.fromkeys(keys))
+        found = {}
+        with self.lock:
+            for i in range(0, len(unique_keys), chunk_size):
+                chunk = unique_keys[i:i + chunk_size]
+                rows = self.conn.execute(
+                    f"SELECT key, output FROM generations "
+                    f"WHERE key IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for key, output in rows:
+                    found[key] = json.loads(output)
+
+            self.conn.executemany(
+                "UPDATE generations SET accessed_at = ? WHERE key = ?",
+                [(time.time(), key) for key in found]
+            )
+            self.conn.commit()
+
+            self.hits += sum(key in found for key in keys)
+            self.misses += sum(key not in found for key in keys)
+
+        return found
+
+    def put_many(self, entries: Dict[str, list]):
+        """Store several key -> output pairs in a single transaction."""
+        now = time.time()
+        rows = [(key, json.dumps(output), now, now)
+                for key, output in entries.items()]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO generations "
+                "(key, output, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self.conn.commit()
+            self.count, self.size = self._totals()
+            self._evict()
+
+    def _evict(self):
+        if self.size <= self.max_size:
+            return
+        # Delete the least recently used entries until the outputs fit
+        overflow = self.size - self.max_size
+        rows = self.conn.execute(
+            "SELECT key, LENGTH(output) FROM generations ORDER BY accessed_at"
+        )
+        keys, freed = [], 0
+        for key, length in rows:
+            if freed >= overflow:
+                break
+            keys.append(key)
+            freed += length
+        self.conn.executemany("DELETE FROM generations WHERE key = ?",
+                              [(key,) for key in keys])
+        self.conn.commit()
+        self.count, self.size = self._totals()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": self.count,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
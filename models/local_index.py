@@ -0,0 +1,157 @@
+import bz2
+import gzip
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from loguru import logger
+
+from models.wikidata_cache import normalize_label
+
+KEYS_FILE = "keys.npy"
+QIDS_FILE = "qids.npy"
+META_FILE = "meta.json"
+
+
+def label_hash(label: str) -> int:
+    """A stable 64-bit hash of the normalized label."""
+    digest = hashlib.blake2b(normalize_label(label).encode("utf-8"),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def open_dump(file_path: Union[str, Path]):
+    file_path = str(file_path)
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rt", encoding="utf-8")
+    if file_path.endswith(".bz2"):
+        return bz2.open(file_path, "rt", encoding="utf-8")
+    return open(file_path, encoding="utf-8")
+
+
+def read_wikidata_json(file_path: Union[str, Path], language: str = "en") \
+        -> Iterator[Tuple[str, str, bool, float]]:
+    """Yield (label, QID, is_alias, score) tuples from a Wikidata JSON dump.
+
+    The dump can be either the official one-entity-per-line array format or
+    plain JSONL. Entities are scored by their number of sitelinks.
+    """
+    with open_dump(file_path) as f:
+        for line in f:
+            line = line.strip().rstrip(",")
+            if not line or line in ("[", "]"):
+                continue
+            entity = json.loads(line)
+            qid = entity.get("id", "")
+            if not qid.startswith("Q"):
+                continue
+
+            score = float(len(entity.get("sitelinks", {})))
+            label = entity.get("labels", {}).get(language)
+            if label:
+                yield label["value"], qid, False, score
+            for alias in entity.get("aliases", {}).get(language, []):
+                yield alias["value"], qid, True, score
+
+
+def read_tsv(file_path: Union[str, Path]) \
+        -> Iterator[Tuple[str, str, bool, float]]:
+    """Yield (label, QID, is_alias, score) tuples from `label<TAB>QID[<TAB>score]` lines.
+
+    Without a score column, earlier lines take precedence over later ones.
+    """
+    with open_dump(file_path) as f:
+        for line_number, line in enumerate(f):
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) < 2 or not parts[0] or not parts[1].startswith("Q"):
+                continue
+            score = float(parts[2]) if len(parts) > 2 else -line_number
+            yield parts[0], parts[1], False, score
+
+
+def build_index(input_files: List[Union[str, Path]],
+                output_dir: Union[str, Path],
+                language: str = "en") -> int:
+    """Build a label/alias -> QID index and write it to `output_dir`.
+
+    For labels shared by several entities, labels win over aliases and then
+    the entity with the highest score wins. Returns the number of unique keys.
+    """
+    hashes, qids, is_alias, scores = [], [], [], []
+    for input_file in input_files:
+        logger.info(f"Reading `{input_file}`...")
+        if ".tsv" in Path(input_file).suffixes:
+            records = read_tsv(input_file)
+        else:
+            records = read_wikidata_json(input_file, language=language)
+
+        for label, qid, alias, score in records:
+            hashes.append(label_hash(label))
+            qids.append(int(qid[1:]))
+            is_alias.append(alias)
+            scores.append(score)
+
+    logger.info(f"Indexing {len(hashes):,} labels and aliases...")
+    hashes = np.array(hashes, dtype=np.uint64)
+    qids = np.array(qids, dtype=np.uint64)
+    order = np.lexsort((qids, -np.array(scores, dtype=np.float64),
+                        np.array(is_alias, dtype=bool), hashes))
+    hashes, qids = hashes[order], qids[order]
+
+    # Keep the best-ranked entity for every key
+    first = np.ones(len(hashes), dtype=bool)
+    first[1:] = hashes[1:] != hashes[:-1]
+    hashes, qids = hashes[first], qids[first]
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    np.save(output_dir / KEYS_FILE, hashes)
+    np.save(output_dir / QIDS_FILE, qids)
+    with open(output_dir / META_FILE, "w") as f:
+        json.dump({
+            "language": language,
+            "num_keys": int(len(hashes)),
+            "sources": [str(p) for p in input_files],
+        }, f, indent=2)
+
+    logger.info(f"Wrote {len(hashes):,} keys to `{output_dir}`.")
+    return len(hashes)
+
+
+class LocalIndex:
+    """A memory-mapped label/alias -> QID index built by `build_index`."""
+
+    def __init__(self, index_dir: Union[str, Path]):
+        index_dir = Path(index_dir)
+        logger.info(f"Loading the local Wikidata index `{index_dir}`...")
+        self.keys = np.load(index_dir / KEYS_FILE, mmap_mode="r")
+        self.qids = np.load(index_dir / QIDS_FILE, mmap_mode="r")
+        with open(index_dir / META_FILE) as f:
+            self.meta = json.load(f)
+        self.language = self.meta["language"]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, label: str) -> Optional[str]:
+        """Return the QID of a label, or None if the label is not indexed."""
+        key = np.uint64(label_hash(label))
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return f"Q{int(self.qids[i])}"
+        return None
+
+    def lookup_many(self, labels: List[str]) -> Dict[str, str]:
+        """Look up several labels with one vectorized search; labels that are not indexed are left out."""
+        if not labels or not len(self.keys):
+            return {}
+        keys = np.array([label_hash(label) for label in labels],
+                        dtype=np.uint64)
+        positions = np.minimum(np.searchsorted(self.keys, keys),
+                               len(self.keys) - 1)
+        matches = np.asarray(self.keys[positions]) == keys
+        qids = np.asarray(self.qids[positions])
+        return {label: f"Q{int(qid)}"
+                for label, qid, match in zip(labels, qids, matches) if match}
@@ -0,0 +1,170 @@
+import json
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+from loguru import logger
+
+# Default buckets of the histograms, in seconds
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Metrics:
+    """Labelled counters and histograms of a run, exported as JSON and in the Prometheus text format.
+
+    Recording a value is a dict update (and a bisect for histograms), so the
+    metrics can stay on for full runs. `maybe_log` logs a summary at most
+    every `log_interval` seconds.
+    """
+
+    def __init__(self, namespace: str = "lmkbc",
+                 json_file: Optional[str] = None,
+                 prometheus_file: Optional[str] = None,
+                 log_interval: float = 60.0):
+        self.namespace = namespace
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+        self.log_interval = log_interval
+
+        # name -> (type, help, buckets)
+        self.definitions = {}
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [count per bucket (the last one is +Inf), sum, count]
+        self.histograms = {}
+
+        self.start_time = time.monotonic()
+        self.last_log = self.start_time
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["Metrics"]:
+        if not config.get("metrics", False):
+            return None
+        return cls(
+            json_file=config.get("metrics_file", "output/metrics.json"),
+            prometheus_file=config.get("metrics_prometheus_file",
+                                       "output/metrics.prom"),
+            log_interval=config.get("metrics_log_interval", 60.0),
+        )
+
+    def counter(self, name: str, help: str):
+        self.definitions[name] = ("counter", help, None)
+
+    def histogram(self, name: str, help: str,
+                  buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.definitions[name] = ("histogram", help, tuple(sorted(buckets)))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.definitions[name][2]
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+        histogram[0][bisect_left(buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def totals(self) -> Dict[str, Tuple[float, float]]:
+        """(total, count) of every metric over all its labels; count is 0 for counters."""
+        totals = {}
+        for (name, _), value in self.counters.items():
+            total, count = totals.get(name, (0, 0))
+            totals[name] = (total + value, count)
+        for (name, _), (_, total_sum, total_count) in self.histograms.items():
+            total, count = totals.get(name, (0, 0))
+            totals[name] = (total + total_sum, count + total_count)
+        return totals
+
+    def maybe_log(self):
+        if time.monotonic() - self.last_log >= self.log_interval:
+            self.log_summary()
+
+    def log_summary(self):
+        self.last_log = time.monotonic()
+        parts = []
+        for name, (total, count) in self.totals().items():
+            if self.definitions[name][0] == "counter":
+                parts.append(f"{name} {total:,.0f}")
+            else:
+                parts.append(f"{name} {count:,} (mean {total / count:.3g})")
+        logger.info(f"Metrics after {self.last_log - self.start_time:.0f}s: "
+                    + ", ".join(parts))
+
+    def as_dict(self) -> dict:
+        def buckets_dict(buckets, counts):
+            cumulative, result = 0, {}
+            for le, count in zip([*map(str, buckets), "+Inf"], counts):
+                cumulative += count
+                result[le] = cumulative
+            return result
+
+        return {
+            "elapsed_seconds": time.monotonic() - self.start_time,
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            "histograms": [
+                {"name": name, "labels": dict(labels),
+                 "buckets": buckets_dict(self.definitions[name][2], counts),
+                 "sum": total, "count": count}
+                for (name, labels), (counts, total, count)
+                in sorted(self.histograms.items())
+            ],
+        }
+
+    def to_prometheus(self) -> str:
+        def escape(value):
+            return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+                    .replace("\n", "\\n"))
+
+        def label_text(labels, extra=()):
+            labels = [*labels, *extra]
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+        lines = []
+        for name, (kind, help, buckets) in self.definitions.items():
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if kind == "counter":
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{full_name}{label_text(labels)} {value}")
+                continue
+            for (n, labels), (counts, total, count) in sorted(
+                    self.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for le, bucket_count in zip([*map(str, buckets), "+Inf"],
+                                            counts):
+                    cumulative += bucket_count
+                    lines.append(f"{full_name}_bucket"
+                                 f"{label_text(labels, [('le', le)])} "
+                                 f"{cumulative}")
+                lines.append(f"{full_name}_sum{label_text(labels)} {total}")
+                lines.append(f"{full_name}_count{label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Write the metrics to the JSON and Prometheus files."""
+        if self.json_file:
+            Path(self.json_file).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.json_file, "w") as f:
+                json.dump(self.as_dict(), f, indent=2)
+        if self.prometheus_file:
+            Path(self.prometheus_file).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.prometheus_file, "w") as f:
+                f.write(self.to_prometheus())
+        files = [f"`{file}`" for file in (self.json_file, self.prometheus_file)
+                 if file]
+        if files:
+            logger.info(f"Saved the metrics to {' and '.join(files)}.")
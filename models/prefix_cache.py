@@ -0,0 +1,285 @@
+import copy
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+import torch
+from loguru import logger
+from transformers import DynamicCache
+
+from models.completion import adds_special_tokens, completion_output, \
+    start_generation
+
+
+def slice_cache(cache: DynamicCache, row: int, start: int,
+                end: int) -> DynamicCache:
+    """A copy of the positions `start:end` of one row of a batched KV cache."""
+    sliced = DynamicCache()
+    for layer_idx, layer in enumerate(cache.layers):
+        sliced.update(layer.keys[row:row + 1, :, start:end].clone(),
+                      layer.values[row:row + 1, :, start:end].clone(),
+                      layer_idx)
+    return sliced
+
+
+class PrefixCache:
+    """Reuses the KV cache (`past_key_values`) of shared prompt prefixes.
+
+    Prompts are registered with the prefixes they start with (shortest
+    first, e.g. the system message and then everything before the final
+    question). The KV cache of every prefix is computed once, by extending the
+    longest cached prefix it starts with, and kept in an LRU of `max_entries`
+    prefixes. Generation then only prefills the tokens after the longest cached
+    prefix of the prompt. Prefixes whose tokens turn out not to be a prefix of
+    the prompt tokens are simply not reused.
+
+    With `keep_conversation` (a predicate on the completion text), the KV
+    cache of every generation it accepts is kept as well, in an LRU of
+    `max_conversations` entries keyed by the tokens of the prompt and
+    completion, so that a follow-up turn of the conversation only prefills its
+    new tokens. Follow-up prompts are registered with their
+    exact token IDs (`register_ids`), since the generated tokens are not
+    necessarily how their text is tokenized; they count as conversation hits
+    or misses depending on whether their conversation is still kept.
+    """
+
+    def __init__(self, model, tokenizer, max_entries: int = 16,
+                 max_registered_prompts: int = 4096,
+                 max_conversations: int = 16):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.max_registered_prompts = max_registered_prompts
+        self.max_conversations = max_conversations
+
+        # Prefix text -> (prefix token ids, KV cache of the prefix)
+        self.entries: "OrderedDict[str, Tuple[List[int], DynamicCache]]" = \
+            OrderedDict()
+        # Prompt -> registered prefixes, shortest first
+        self.prompt_prefixes: "OrderedDict[str, List[str]]" = OrderedDict()
+        # Token IDs -> (token IDs, KV cache) of the kept conversations
+        self.conversations: "OrderedDict[tuple, Tuple[List[int], DynamicCache]]" = \
+            OrderedDict()
+        # Prompt -> registered token IDs
+        self.prompt_ids: "OrderedDict[str, List[int]]" = OrderedDict()
+        # Whether to keep the KV cache of a generation, from its completion
+        self.keep_conversation: Optional[Callable[[str], bool]] = None
+
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        self.conversation_hits = 0
+        self.conversation_misses = 0
+
+    def register(self, prompt: str, prefixes: List[str]):
+        """Record the prefixes a prompt starts with, shortest first."""
+        prefixes = [prefix for prefix in prefixes
+                    if prefix and prompt.startswith(prefix) and prefix != prompt]
+        if not prefixes:
+            return
+        self.prompt_prefixes[prompt] = prefixes
+        self.prompt_prefixes.move_to_end(prompt)
+        while len(self.prompt_prefixes) > self.max_registered_prompts:
+            self.prompt_prefixes.popitem(last=False)
+
+    def register_ids(self, prompt: str, ids: List[int]):
+        """Record the token IDs of a prompt, used instead of tokenizing it."""
+        self.prompt_ids[prompt] = ids
+        self.prompt_ids.move_to_end(prompt)
+        while len(self.prompt_ids) > self.max_registered_prompts:
+            self.prompt_ids.popitem(last=False)
+
+    def encode(self, text: str) -> List[int]:
+        if text in self.prompt_ids:
+            return self.prompt_ids[text]
+        return self.tokenizer(text, add_special_tokens=adds_special_tokens(
+            self.tokenizer, text))["input_ids"]
+
+    def store(self, ids: List[int], cache: DynamicCache):
+        """Keep the KV cache of a conversation."""
+        self.conversations[tuple(ids)] = (ids, cache)
+        self.conversations.move_to_end(tuple(ids))
+        while len(self.conversations) > self.max_conversations:
+            self.conversations.popitem(last=False)
+
+    def keep(self, ids: List[int], completion: dict, cache: DynamicCache,
+             row: int = 0, start: int = 0):
+        """Keep the KV cache of a prompt and its completion if `keep_conversation` accepts the completion.
+
+        The prompt tokens `ids` start at position `start` of the row of the
+        cache.
+        """
+        if self.keep_conversation is None or \
+                not self.keep_conversation(completion["generated_text"]):
+            return
+        new_ids = completion["completion_token_ids"]
+        # the cache has no entry for the last generated token
+        covered = min(len(new_ids), cache.get_seq_length() - start - len(ids))
+        self.store(ids + new_ids[:covered],
+                   slice_cache(cache, row, start, start + len(ids) + covered))
+
+    def count_conversation(self, prompt: str,
+                           cached: Optional[Tuple[List[int], DynamicCache]]):
+        """Count a follow-up prompt as a conversation hit or miss."""
+        if prompt not in self.prompt_ids:
+            return
+        if cached is not None and tuple(cached[0]) in self.conversations:
+            self.conversation_hits += 1
+        else:
+            self.conversation_misses += 1
+
+    def longest_cached_prefix(self, ids: List[int]) \
+            -> Optional[Tuple[List[int], DynamicCache]]:
+        """The cached prefix or conversation with the most tokens that is a strict prefix of `ids`."""
+        best = None
+        for entries in (self.entries, self.conversations):
+            for key, (prefix_ids, cache) in entries.items():
+                if len(prefix_ids) < len(ids) and ids[:len(prefix_ids)] == prefix_ids:
+                    if best is None or len(prefix_ids) > len(best[2][0]):
+                        best = (entries, key, (prefix_ids, cache))
+        if best is None:
+            return None
+        best[0].move_to_end(best[1])
+        return best[2]
+
+    @torch.no_grad()
+    def build(self, prefix: str):
+        """Compute the KV cache of a prefix, extending the longest cached prefix it starts with."""
+        if prefix in self.entries:
+            self.entries.move_to_end(prefix)
+            return
+
+        ids = self.encode(prefix)
+        base = self.longest_cached_prefix(ids)
+        if base is None:
+            base_length, cache = 0, DynamicCache()
+        else:
+            base_length, cache = len(base[0]), copy.deepcopy(base[1])
+
+        output = self.model(
+            input_ids=torch.tensor([ids[base_length:]],
+                                   device=self.model.device),
+            past_key_values=cache,
+            use_cache=True,
+        )
+        self.entries[prefix] = (ids, output.past_key_values)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @torch.no_grad()
+    def generate(self, prompt: str, **generate_kwargs) -> List[dict]:
+        """Generate a completion of the prompt, reusing the cached prefixes.
+
+        Returns the output in the format of `completion_output`.
+        """
+        for prefix in self.prompt_prefixes.get(prompt, []):
+            self.build(prefix)
+
+        ids = self.encode(prompt)
+        cached = self.longest_cached_prefix(ids)
+        self.count_conversation(prompt, cached)
+        past_key_values = copy.deepcopy(cached[1]) if cached else None
+
+        self.prompt_tokens += len(ids)
+        self.reused_tokens += len(cached[0]) if cached else 0
+
+        input_ids = torch.tensor([ids], device=self.model.device)
+        start_generation(generate_kwargs, len(ids))
+        output = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            pad_token_id=self.tokenizer.pad_token_id,
+            return_dict_in_generate=True,
+            **generate_kwargs,
+        )
+        completion = completion_output(
+            self.tokenizer, output.sequences[0, len(ids):].tolist(), len(ids))
+        if prompt not in self.prompt_ids:
+            # follow-up turns are not followed up again
+            self.keep(ids, completion[0], output.past_key_values)
+        return completion
+
+    def padded_cache(self, cached: List[Optional[Tuple[List[int], DynamicCache]]],
+                     offsets: List[int], length: int) -> DynamicCache:
+        """A batched KV cache of the first `length` positions of left-padded rows.
+
+        The cache of every row starts at its padding offset, with the
+        positions of its cached entry; the padding positions are masked.
+        """
+        reference = next(entry[1] for entry in cached if entry)
+        cache = DynamicCache()
+        for layer_idx, layer in enumerate(reference.layers):
+            batch_shape = (len(cached), layer.keys.shape[1], length)
+            keys = layer.keys.new_zeros((*batch_shape, layer.keys.shape[-1]))
+            values = layer.values.new_zeros((*batch_shape, layer.values.shape[-1]))
+            for row, (entry, offset) in enumerate(zip(cached, offsets)):
+                if offset < length:
+                    row_layer = entry[1].layers[layer_idx]
+                    keys[row, :, offset:] = row_layer.keys[0, :, :length - offset]
+                    values[row, :, offset:] = row_layer.values[0, :, :length - offset]
+            cache.update(keys, values, layer_idx)
+        return cache
+
+    @torch.no_grad()
+    def generate_batch(self, prompts: List[str], generation_config=None,
+                       **generate_kwargs) -> List[List[dict]]:
+        """Generate a batch of prompts like `generate_completions`, reusing the cached prefixes and conversations.
+
+        The prompts are left-padded, so the cached entries of the rows are only
+        reused up to the first position that some row has not cached. The
+        conversations accepted by `keep_conversation` are kept.
+        """
+        ids = [self.encode(prompt) for prompt in prompts]
+        cached = [self.longest_cached_prefix(prompt_ids) for prompt_ids in ids]
+        for prompt, entry in zip(prompts, cached):
+            self.count_conversation(prompt, entry)
+        length = max(map(len, ids))
+        offsets = [length - len(prompt_ids) for prompt_ids in ids]
+        reused = min(offset + (len(entry[0]) if entry else 0)
+                     for offset, entry in zip(offsets, cached))
+
+        self.prompt_tokens += sum(map(len, ids))
+        self.reused_tokens += sum(max(0, reused - offset) for offset in offsets)
+
+        input_ids = torch.tensor(
+            [[self.tokenizer.pad_token_id] * offset + prompt_ids
+             for offset, prompt_ids in zip(offsets, ids)], device=self.model.device)
+        attention_mask = torch.tensor(
+            [[0] * offset + [1] * len(prompt_ids)
+             for offset, prompt_ids in zip(offsets, ids)], device=self.model.device)
+        past_key_values = None
+        if reused:
+            past_key_values = self.padded_cache(cached, offsets, reused)
+        start_generation(generate_kwargs, length)
+        output = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            generation_config=generation_config,
+            pad_token_id=self.tokenizer.pad_token_id,
+            return_dict_in_generate=True,
+            **generate_kwargs,
+        )
+        outputs = []
+        for row, (prompt, prompt_ids, offset) in enumerate(zip(prompts, ids, offsets)):
+            completion = completion_output(
+                self.tokenizer, output.sequences[row, length:].tolist(),
+                len(prompt_ids))
+            if prompt not in self.prompt_ids:
+                self.keep(prompt_ids, completion[0], output.past_key_values,
+                          row=row, start=offset)
+            outputs.append(completion)
+        return outputs
+
+    def log_stats(self, name: str = "Prefix cache"):
+        share = (self.reused_tokens / self.prompt_tokens
+                 if self.prompt_tokens else 0.0)
+        logger.info(
+            f"{name}: reused {self.reused_tokens:,} of "
+            f"{self.prompt_tokens:,} prompt tokens ({share:.1%})."
+        )
+        if self.conversation_hits or self.conversation_misses:
+            logger.info(
+                f"{name}: continued {self.conversation_hits:,} conversations, "
+                f"{self.conversation_misses:,} follow-ups missed their "
+                f"conversation."
+            )
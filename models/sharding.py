@@ -0,0 +1,89 @@
+import json
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+from loguru import logger
+
+# Rough number of generations per input of each relation with the dual
+# prompting strategies; other relations count as 1
+RELATION_COSTS = {
+    "awardWonBy": 20.0,
+    "seriesHasNumberOfEpisodes": 2.0,
+    "countryLandBordersCountry": 3.0,
+    "companyTradesAtStockExchange": 3.0,
+    "personHasCityOfDeath": 3.0,
+}
+
+
+def iter_jsonl(file_path: Union[str, Path]) -> Iterator[dict]:
+    """Lazily read the rows of a JSONL file, skipping blank lines."""
+    with open(file_path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def shard_assignments(relations: List[str], num_shards: int,
+                      relation_costs: Optional[Dict[str, float]] = None) \
+        -> List[int]:
+    """Assign every input row, given by its relation, to a shard.
+
+    The rows of every relation are dealt in input order over the shards,
+    starting from the shard with the lowest estimated cost so far, so that
+    every shard gets the same number of rows of a relation (give or take one)
+    and about the same total cost. The assignment only depends on the inputs.
+    """
+    costs = {**RELATION_COSTS, **(relation_costs or {})}
+    rows_per_relation = {}
+    for i, relation in enumerate(relations):
+        rows_per_relation.setdefault(relation, []).append(i)
+
+    assignments = [0] * len(relations)
+    loads = [0.0] * num_shards
+    for relation, rows in rows_per_relation.items():
+        order = sorted(range(num_shards), key=lambda s: (loads[s], s))
+        for j, i in enumerate(rows):
+            shard = order[j % num_shards]
+            assignments[i] = shard
+            loads[shard] += costs.get(relation, 1.0)
+
+    return assignments
+
+
+def shard_file(output_file: Union[str, Path], shard_id: int,
+               num_shards: int) -> Path:
+    """The output file of one shard, next to the merged output file."""
+    output_file = Path(output_file)
+    return output_file.with_name(
+        f"{output_file.stem}.shard-{shard_id}-of-{num_shards}"
+        f"{output_file.suffix}")
+
+
+def merge_shards(input_file: Union[str, Path],
+                 shard_files: List[Union[str, Path]],
+                 output_file: Union[str, Path]) -> int:
+    """Merge the shard outputs into one file, in the order of the input rows.
+
+    Returns the number of merged results. Input rows without a result are
+    reported and left out.
+    """
+    results = {}
+    for file in shard_files:
+        for result in iter_jsonl(file):
+            key = (result["SubjectEntityID"], result["Relation"])
+            results.setdefault(key, deque()).append(result)
+
+    num_results, num_missing = 0, 0
+    with open(output_file, "w") as f:
+        for row in iter_jsonl(input_file):
+            key = (row["SubjectEntityID"], row["Relation"])
+            if not results.get(key):
+                num_missing += 1
+                continue
+            f.write(json.dumps(results[key].popleft()) + "\n")
+            num_results += 1
+
+    if num_missing:
+        logger.warning(f"{num_missing:,} input rows have no result.")
+    return num_results
@@ -0,0 +1,132 @@
+from collections import Counter
+from typing import List, Optional
+
+import torch
+from loguru import logger
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+
+from models.completion import completion_output, start_generation, \
+    tokenize_prompts
+
+
+class SpeculativeDecoding:
+    """Assisted (speculative) generation with a small draft model that shares the tokenizer of the target model.
+
+    The draft model proposes tokens that the target model verifies in a
+    single forward pass, so greedy outputs are the same as without the draft
+    model. Assisted generation only supports one prompt at a time. The
+    acceptance rate is counted per assisted step from the forward passes of
+    the target model: the tokens it verifies besides the known ones are the
+    drafted tokens, and the known tokens of the next step (or the final
+    sequence) tell how many of them were accepted.
+    """
+
+    def __init__(self, model, tokenizer, draft_model_path: str,
+                 num_draft_tokens: Optional[int] = None):
+        self.model = model
+        self.tokenizer = tokenizer
+
+        draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_path)
+        if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            raise ValueError(
+                f"The draft model `{draft_model_path}` does not share the "
+                f"tokenizer of the model.")
+
+        logger.info(f"Loading the draft model `{draft_model_path}`...")
+        self.draft_model = AutoModelForCausalLM.from_pretrained(
+            draft_model_path,
+            torch_dtype=model.dtype,
+        ).to(model.device)
+        self.draft_model.eval()
+        if num_draft_tokens is not None:
+            # the number of tokens drafted at every step (adapted by the heuristic schedule)
+            self.draft_model.generation_config.num_assistant_tokens = num_draft_tokens
+
+        self.stats = Counter()
+        # (cached tokens, input tokens) of every forward pass of the model in the current generation
+        self.steps = None
+        model.register_forward_pre_hook(self.record_step, with_kwargs=True)
+
+    @classmethod
+    def from_config(cls, config: dict, model, tokenizer) \
+            -> Optional["SpeculativeDecoding"]:
+        draft_model_path = config.get("draft_model_path")
+        if not draft_model_path:
+            return None
+        return cls(model, tokenizer, draft_model_path,
+                   num_draft_tokens=config.get("draft_num_tokens"))
+
+    def record_step(self, module, args, kwargs):
+        if self.steps is not None:
+            cache = kwargs.get("past_key_values")
+            self.steps.append((cache.get_seq_length() if cache is not None else 0,
+                               kwargs["input_ids"].shape[1]))
+
+    def count_steps(self, num_prompt_tokens: int, length: int):
+        """Add the drafted and accepted tokens of the recorded steps of a generation of `length` tokens."""
+        known = num_prompt_tokens
+        for j, (cached, num_inputs) in enumerate(self.steps):
+            # the next step starts with the accepted tokens in the cache and the token added by this one
+            next_known = self.steps[j + 1][0] + 1 if j + 1 < len(self.steps) else length
+            drafted = max(0, cached + num_inputs - known)
+            self.stats["target_forwards"] += 1
+            self.stats["drafted_tokens"] += drafted
+            self.stats["accepted_tokens"] += min(drafted, max(0, next_known - known - 1))
+            known = next_known
+
+    @torch.no_grad()
+    def generate(self, prompts: List[str],
+                 generation_config: Optional[GenerationConfig] = None,
+                 **generate_kwargs) -> List[List[dict]]:
+        """Generate the prompts one at a time with the draft model, in the format of `completion_output`."""
+        outputs = []
+        for prompt in prompts:
+            inputs = tokenize_prompts(self.tokenizer, [prompt]).to(self.model.device)
+            num_prompt_tokens = inputs["input_ids"].shape[1]
+            start_generation(generate_kwargs, num_prompt_tokens)
+            self.steps = []
+            try:
+                sequences = self.model.generate(
+                    **inputs,
+                    generation_config=generation_config,
+                    assistant_model=self.draft_model,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    **generate_kwargs,
+                )
+                self.count_steps(num_prompt_tokens, sequences.shape[1])
+            finally:
+                self.steps = None
+            output = completion_output(
+                self.tokenizer, sequences[0, num_prompt_tokens:].tolist(),
+                num_prompt_tokens)
+            self.stats["prompts"] += 1
+            self.stats["generated_tokens"] += output[0]["completion_tokens"]
+            outputs.append(output)
+        return outputs
+
+    def summary(self) -> dict:
+        stats = self.stats
+        return {
+            "prompts": stats["prompts"],
+            "generated_tokens": stats["generated_tokens"],
+            "target_forwards": stats["target_forwards"],
+            "drafted_tokens": stats["drafted_tokens"],
+            "accepted_tokens": stats["accepted_tokens"],
+            "acceptance_rate": (stats["accepted_tokens"] / stats["drafted_tokens"]
+                                if stats["drafted_tokens"] else None),
+            "tokens_per_target_forward": (
+                stats["generated_tokens"] / stats["target_forwards"]
+                if stats["target_forwards"] else None),
+        }
+
+    def log_stats(self):
+        summary = self.summary()
+        if not summary["prompts"]:
+            return
+        logger.info(
+            f"Speculative decoding: accepted {summary['accepted_tokens']:,} "
+            f"of {summary['drafted_tokens']:,} drafted tokens "
+            f"(acceptance rate {summary['acceptance_rate'] or 0:.1%}), "
+            f"{summary['tokens_per_target_forward']:.2f} tokens per forward "
+            f"pass of the model over {summary['prompts']:,} prompts."
+        )
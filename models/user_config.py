@@ -1,9 +1,9 @@
+import importlib
 from enum import Enum
+from importlib.metadata import entry_points
 
-from models.baseline_fill_mask_model import FillMaskModel
-from models.baseline_generation_model import GenerationModel
-from models.baseline_llama_3_chat_model import Llama3ChatModel
-from models.dual_llama_3_model import Llama3DualPrompt
+# Entry point group through which installed packages can register more models
+ENTRY_POINT_GROUP = "lmkbc.models"
 
 
 class Models(Enum):
@@ -12,18 +12,30 @@ class Models(Enum):
     BASELINE_LLAMA_3_CHAT = "baseline_llama_3_chat"
     DUAL_LLAMA_3 = "dual_llama_3_chat"
 
-    # Add more models here
+    # Add more models here (and to MODEL_CLASSES)
 
     @staticmethod
     def get_model(model_name: str):
-        model = Models(model_name)
-        if model == Models.BASELINE_FILL_MASK:
-            return FillMaskModel
-        elif model == Models.BASELINE_GENERATION:
-            return GenerationModel
-        elif model == Models.BASELINE_LLAMA_3_CHAT:
-            return Llama3ChatModel
-        elif model == Models.DUAL_LLAMA_3:
-            return Llama3DualPrompt
-        else:
-            raise ValueError(f"Model `{model_name}` not found.")
+        """Import and return the model class, loading only the module that defines it."""
+        if model_name in Models._value2member_map_:
+            module_name, class_name = MODEL_CLASSES[Models(model_name)]
+            return getattr(importlib.import_module(module_name), class_name)
+
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+            if entry_point.name == model_name:
+                return entry_point.load()
+
+        raise ValueError(f"Model `{model_name}` not found.")
+
+
+# Model -> (module, class), imported on first use
+MODEL_CLASSES = {
+    Models.BASELINE_FILL_MASK:
+        ("models.baseline_fill_mask_model", "FillMaskModel"),
+    Models.BASELINE_GENERATION:
+        ("models.baseline_generation_model", "GenerationModel"),
+    Models.BASELINE_LLAMA_3_CHAT:
+        ("models.baseline_llama_3_chat_model", "Llama3ChatModel"),
+    Models.DUAL_LLAMA_3:
+        ("models.dual_llama_3_model", "Llama3DualPrompt"),
+}
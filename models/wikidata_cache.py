@@ -0,0 +1,216 @@
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from loguru import logger
+
+DEFAULT_CACHE_FILE = (Path(__file__).resolve().parent.parent / "cache" /
+                      "wikidata_labels.sqlite")
+
+
+def normalize_label(label: str) -> str:
+    """Normalize a surface string so that trivial variants share a cache entry."""
+    label = unicodedata.normalize("NFKC", str(label))
+    return " ".join(label.split()).casefold()
+
+
+class WikidataCache:
+    """A persistent SQLite cache of label -> Wikidata ID lookups.
+
+    Entries are keyed by the normalized label and the search language. An empty
+    ID records a lookup that returned no results. The least recently used
+    entries are evicted once `max_entries` is exceeded and entries older than
+    `ttl` seconds are treated as misses.
+    """
+
+    def __init__(self, db_path: Union[str, Path] = DEFAULT_CACHE_FILE,
+                 max_entries: int = 1_000_000,
+                 ttl: Optional[float] = 30 * 24 * 3600,
+                 busy_timeout: float = 60.0):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        # Shards of a run share the file; wait for the write lock of the others
+        self.conn = sqlite3.connect(str(self.db_path),
+                                    timeout=busy_timeout,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS labels ("
+            "label TEXT NOT NULL, "
+            "language TEXT NOT NULL, "
+            "qid TEXT NOT NULL, "
+            "created_at REAL NOT NULL, "
+            "accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (label, language))"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS labels_accessed_at "
+            "ON labels (accessed_at)"
+        )
+        self.conn.commit()
+        self.size = self.conn.execute(
+            "SELECT COUNT(*) FROM labels").fetchone()[0]
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["WikidataCache"]:
+        """Create the cache from the model configuration, or None if disabled."""
+        if not config.get("disambiguation_cache", True):
+            return None
+
+        ttl_days = config.get("disambiguation_cache_ttl_days", 30)
+        cache = cls(
+            db_path=config.get("disambiguation_cache_file",
+                               DEFAULT_CACHE_FILE),
+            max_entries=config.get("disambiguation_cache_max_entries",
+                                   1_000_000),
+            ttl=ttl_days * 24 * 3600 if ttl_days else None,
+            busy_timeout=config.get("cache_busy_timeout", 60.0),
+        )
+        logger.info(
+            f"Using the disambiguation cache `{cache.db_path}` "
+            f"({cache.size:,} entries)..."
+        )
+
+        warm_file = config.get("disambiguation_cache_warm_file")
+        if warm_file:
+            cache.warm_from_file(warm_file,
+                                 language=config.get("wikidata_language", "en"))
+
+        return cache
+
+    def get(self, label: str, language: str = "en") -> Optional[str]:
+        """Return the cached ID for a label ("" if known to have no match), or None on a miss."""
+        return self.get_many([label], language=language).get(label)
+
+    def get_many(self, labels: List[str], language: str = "en",
+                 chunk_size: int = 500) -> Dict[str, str]:
+        """Return the cached IDs of several labels; labels that miss are left out."""
+        keys = {}
+        for label in labels:
+            keys.setdefault(normalize_label(label), []).append(label)
+
+        now = time.time()
+        found = {}
+        with self.lock:
+            unique_keys = list(keys)
+            for i in range(0, len(unique_keys), chunk_size):
+                chunk = unique_keys[i:i + chunk_size]
+                rows = self.conn.execute(
+                    f"SELECT label, qid, created_at FROM labels "
+                    f"WHERE language = ? "
+                    f"AND label IN ({', '.join('?' * len(chunk))})",
+                    (language, *chunk)
+                ).fetchall()
+                for key, qid, created_at in rows:
+                    if not self.ttl or now - created_at <= self.ttl:
+                        found[key] = qid
+
+            # Drop the expired entries among the misses
+            missed = [key for key in unique_keys if key not in found]
+            self.conn.executemany(
+                "DELETE FROM labels WHERE label = ? AND language = ?",
+                [(key, language) for key in missed]
+            )
+            self.conn.executemany(
+                "UPDATE labels SET accessed_at = ? "
+                "WHERE label = ? AND language = ?",
+                [(now, key, language) for key in found]
+            )
+            self.conn.commit()
+            self.size = self.conn.execute(
+                "SELECT COUNT(*) FROM labels").fetchone()[0]
+
+            self.hits += sum(len(keys[key]) for key in found)
+            self.misses += sum(len(keys[key]) for key in missed)
+
+        return {label: qid for key, qid in found.items()
+                for label in keys[key]}
+
+    def put(self, label: str, qid: str, language: str = "en"):
+        """Store the ID of a label, evicting the least recently used entries if needed."""
+        self.put_many({label: qid}, language=language)
+
+    def put_many(self, entries: dict, language: str = "en"):
+        """Store several label -> ID pairs in a single transaction."""
+        now = time.time()
+        rows = [(normalize_label(label), language, str(qid), now, now)
+                for label, qid in entries.items()]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO labels "
+                "(label, language, qid, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self.conn.commit()
+            self.size = self.conn.execute(
+                "SELECT COUNT(*) FROM labels").fetchone()[0]
+            self._evict()
+
+    def _evict(self):
+        overflow = self.size - self.max_entries
+        if overflow <= 0:
+            return
+        self.conn.execute(
+            "DELETE FROM labels WHERE rowid IN ("
+            "SELECT rowid FROM labels ORDER BY accessed_at LIMIT ?)",
+            (overflow,)
+        )
+        self.conn.commit()
+        self.size -= overflow
+
+    def warm_from_file(self, file_path: Union[str, Path],
+                       language: str = "en") -> int:
+        """Pre-populate the cache from a file.
+
+        Supported formats are a TSV file with `label<TAB>id` lines and a JSONL
+        file with either `{"label": ..., "id": ...}` rows or LM-KBC rows
+        (`ObjectEntities` aligned with `ObjectEntitiesID`).
+        """
+        logger.info(f"Warming the disambiguation cache from `{file_path}`...")
+        entries = {}
+        with open(file_path) as f:
+            if str(file_path).endswith(".tsv"):
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) >= 2 and parts[0]:
+                        entries[parts[0]] = parts[1]
+            else:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    if "label" in row:
+                        entries[row["label"]] = row["id"]
+                    else:
+                        entries.update(zip(row.get("ObjectEntities", []),
+                                           row.get("ObjectEntitiesID", [])))
+
+        self.put_many(entries, language=language)
+        logger.info(f"Added {len(entries):,} entries to the cache.")
+        return len(entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": self.size,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,151 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+WIKIDATA_API_URL = "https://www.wikidata.org/w/api.php"
+USER_AGENT = "lm-kbc-baseline/1.0 (https://github.com/lm-kbc/dataset2024)"
+
+
+class RetryableHTTPError(Exception):
+    """An HTTP response (429 or 5xx) that is worth retrying."""
+
+    def __init__(self, response: requests.Response):
+        super().__init__(f"HTTP {response.status_code} from `{response.url}`")
+        self.response = response
+
+
+class TokenBucket:
+    """A thread-safe token bucket allowing `rate` requests per second on average."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (
+                        now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class WikidataResolver:
+    """Resolves labels with the `wbsearchentities` API over a pooled keep-alive session.
+
+    Lookups run on a thread pool of `max_workers` threads, are rate limited by
+    a token bucket and retried with exponential backoff on connection errors,
+    timeouts, 429 and 5xx responses.
+    """
+
+    def __init__(self, api_url: str = WIKIDATA_API_URL,
+                 language: str = "en",
+                 max_workers: int = 8,
+                 requests_per_second: float = 10.0,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 timeout: float = 10.0):
+        self.api_url = api_url
+        self.language = language
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @classmethod
+    def from_config(cls, config: dict) -> "WikidataResolver":
+        return cls(
+            api_url=config.get("wikidata_api_url", WIKIDATA_API_URL),
+            language=config.get("wikidata_language", "en"),
+            max_workers=config.get("disambiguation_workers", 8),
+            requests_per_second=config.get("disambiguation_rate_limit", 10.0),
+            max_retries=config.get("disambiguation_max_retries", 3),
+            backoff_factor=config.get("disambiguation_backoff", 0.5),
+            timeout=config.get("disambiguation_timeout", 10.0),
+        )
+
+    def search(self, item: str) -> str:
+        """Return the first search result for an item, or "" if there is none."""
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(
+                    self.api_url,
+                    params={
+                        "action": "wbsearchentities",
+                        "search": item,
+                        "language": self.language,
+                        "format": "json",
+                    },
+                    timeout=self.timeout,
+                )
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise RetryableHTTPError(response)
+                response.raise_for_status()
+                data = response.json()
+                # Return the first id (Could upgrade this in the future)
+                if not data["search"]:
+                    return ""
+                return str(data["search"][0]["id"])
+            except (requests.ConnectionError, requests.Timeout,
+                    RetryableHTTPError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_factor * 2 ** attempt
+                if isinstance(e, RetryableHTTPError):
+                    retry_after = e.response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = max(delay, float(retry_after))
+                time.sleep(delay * (1 + random.random() / 2))
+
+    def search_many(self, items: List[str]) \
+            -> Tuple[Dict[str, str], Dict[str, Exception]]:
+        """Search several items concurrently.
+
+        Returns the item -> ID mapping of the successful lookups and the
+        item -> exception mapping of the failed ones.
+        """
+        found, errors = {}, {}
+        if len(items) == 1:
+            try:
+                found[items[0]] = self.search(items[0])
+            except Exception as e:
+                errors[items[0]] = e
+            return found, errors
+
+        futures = {item: self.executor.submit(self.search, item)
+                   for item in items}
+        for item, future in futures.items():
+            try:
+                found[item] = future.result()
+            except Exception as e:
+                errors[item] = e
+        return found, errors
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,58 @@
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+# The tests import the repository modules (e.g. `models`, `wikidata_stub`) from the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from models.final_answer import AnswerVocabulary  # noqa: E402
+
+
+class WordTokenizer:
+    """A tokenizer over a small fixed vocabulary; text is encoded by longest match."""
+
+    def __init__(self, tokens):
+        self.tokens = ["</s>"] + list(tokens)
+        self.eos_token_id = 0
+        self.all_special_ids = [0]
+        self.added_tokens_decoder = {}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.tokens[i] for i in ids]
+
+    def encode(self, text, add_special_tokens=False):
+        ids = []
+        while text:
+            i = max((i for i, token in enumerate(self.tokens)
+                     if i and text.startswith(token)),
+                    key=lambda i: len(self.tokens[i]))
+            ids.append(i)
+            text = text[len(self.tokens[i]):]
+        return ids
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        return "".join(self.tokens[i] for i in ids
+                       if not (skip_special_tokens and i in self.all_special_ids))
+
+    def batch_decode(self, sequences, **kwargs):
+        return [self.decode(ids) for ids in sequences]
+
+
+@pytest.fixture(scope="session")
+def word_tokenizer():
+    """A tokenizer with the tokens of short answers and of the `final_answer = [...]` lists."""
+    return WordTokenizer(
+        ["\n", "final", "_answer", " = ", "[", "]", "Yes", "No", "yes", "no",
+         "Paris", " Berlin", ",", " ", "1", "2", "0", "The", " answer", "."])
+
+
+@pytest.fixture(scope="session")
+def answer_vocabulary(word_tokenizer):
+    return AnswerVocabulary(word_tokenizer, [word_tokenizer.eos_token_id])
@@ -0,0 +1,37 @@
+from models.baseline_model import BaselineModel
+
+
+class EchoModel(BaselineModel):
+    """Predicts the Wikidata ID of the subject of every input."""
+
+    def generate_predictions(self, inputs):
+        ids = self.disambiguation_batch([inp["SubjectEntity"] for inp in inputs])
+        return [dict(inp, ObjectEntitiesID=[wikidata_id])
+                for inp, wikidata_id in zip(inputs, ids)]
+
+
+def test_stream_yields_every_chunk_before_reading_the_next(monkeypatch):
+    model = EchoModel({"disambiguation_cache": False, "max_resolved_ids": 2})
+    searched = []
+
+    def search_many(items):
+        searched.extend(items)
+        return {item: f"Q{item}x" for item in items}, {}
+
+    monkeypatch.setattr(model.wikidata_resolver, "search_many", search_many)
+    read = []
+
+    def inputs():
+        for name in ["a", "b", "c", "a", "d"]:
+            read.append(name)
+            yield {"SubjectEntity": name}
+
+    results = model.generate_predictions_stream(inputs(), chunk_size=2)
+    assert next(results)["ObjectEntitiesID"] == ["Qax"]
+    assert read == ["a", "b"]
+    assert [result["ObjectEntitiesID"] for result in results] == \
+        [["Qbx"], ["Qcx"], ["Qax"], ["Qdx"]]
+
+    # "a" is still resolved in the second chunk; the resolved IDs stay bounded
+    assert searched == ["a", "b", "c", "d"]
+    assert len(model.resolved_ids) <= 2
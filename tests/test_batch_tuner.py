@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from models import batch_tuner
+from models.batch_tuner import AdaptiveBatcher
+
+GB = 1024 ** 3
+
+
+def tokenizer(prompts, add_special_tokens=False):
+    return {"input_ids": [prompt.split() for prompt in prompts]}
+
+
+@pytest.fixture
+def rss(monkeypatch):
+    """Simulated RSS: `base` between batches, plus `per_prompt` for every prompt of the running batch."""
+    memory = {"base": 1 * GB, "per_prompt": 0.4 * GB, "peak": 0}
+    monkeypatch.setattr(batch_tuner, "current_rss", lambda: memory["base"])
+    monkeypatch.setattr(batch_tuner, "reset_peak_rss", lambda: True)
+    monkeypatch.setattr(batch_tuner, "peak_rss", lambda: memory["peak"])
+    return memory
+
+
+def run(batcher, rss, num_prompts):
+    sizes = []
+
+    def generate(prompts):
+        sizes.append(len(prompts))
+        rss["peak"] = rss["base"] + rss["per_prompt"] * len(prompts)
+        return prompts
+
+    prompts = [f"prompt {i}" for i in range(num_prompts)]
+    assert batcher.run(prompts, generate) == prompts
+    return sizes
+
+
+def test_batch_size_recovers_after_exceeding_the_rss_ceiling(rss, tmp_path):
+    state_file = tmp_path / "batch_sizes.json"
+    batcher = AdaptiveBatcher(tokenizer, initial_batch_size=4, max_rss_gb=2,
+                              state_file=state_file)
+    sizes = run(batcher, rss, 20)
+
+    # 4 prompts peak at 2.6 GB; smaller batches fit and grow back below the failed size
+    assert sizes[:2] == [4, 2]
+    assert sizes[2] == 3
+    saved = json.loads(state_file.read_text())["default"]["batch_sizes"]
+    assert all(1 * GB + 0.4 * GB * size <= 2 * GB for size in saved.values())
+
+
+def test_memory_held_between_batches_does_not_shrink_them(rss):
+    rss.update(base=3 * GB, per_prompt=0.01 * GB)
+    batcher = AdaptiveBatcher(tokenizer, initial_batch_size=2, max_batch_size=8,
+                              max_rss_gb=2)
+    assert run(batcher, rss, 30) == [2, 4, 8, 8, 8]
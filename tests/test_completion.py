@@ -0,0 +1,47 @@
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, processors
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from models.completion import generate_completions, tokenize_prompts
+
+VOCAB = {"<pad>": 0, "<s>": 1, "</s>": 2, "<unk>": 3, "the": 4, "answer": 5, "is": 6}
+
+
+@pytest.fixture(scope="module")
+def base_tokenizer():
+    """A word-level tokenizer that adds `<s>`, like the tokenizers of the base models."""
+    tokenizer = Tokenizer(models.WordLevel(VOCAB, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", VOCAB["<s>"])])
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>",
+        pad_token="<pad>", unk_token="<unk>", padding_side="left")
+
+
+def test_base_model_prompt_keeps_its_bos(base_tokenizer):
+    inputs = tokenize_prompts(base_tokenizer, ["the answer is"])
+    assert inputs["input_ids"].tolist() == [[1, 4, 5, 6]]
+
+
+def test_prompt_starting_with_bos_gets_no_second_bos(base_tokenizer):
+    inputs = tokenize_prompts(base_tokenizer, ["<s>the answer", "the answer is"])
+    assert inputs["input_ids"].tolist() == [[0, 1, 4, 5], [1, 4, 5, 6]]
+    assert inputs["attention_mask"].tolist() == [[0, 1, 1, 1], [1, 1, 1, 1]]
+
+
+def test_generation_sees_the_bos_of_a_base_model_prompt(base_tokenizer):
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(LlamaConfig(
+        vocab_size=len(VOCAB), hidden_size=16, intermediate_size=32,
+        num_hidden_layers=1, num_attention_heads=2, num_key_value_heads=2))
+    seen = []
+    model.register_forward_pre_hook(
+        lambda module, args, kwargs: seen.append(kwargs["input_ids"][0].tolist()),
+        with_kwargs=True)
+
+    output = generate_completions(model, base_tokenizer, ["the answer is"],
+                                  max_new_tokens=2, do_sample=False)
+    assert seen[0] == [1, 4, 5, 6]
+    assert output[0][0]["prompt_tokens"] == 4
@@ -0,0 +1,75 @@
+from collections import Counter
+
+import pytest
+import regex
+import torch
+
+from models.final_answer import FINAL_ANSWER_UNDERSCORE, \
+    FinalAnswerLogitsProcessor, FinalAnswerStoppingCriteria, INTEGERS, NAMES, YES_NO, \
+    closing_bracket_token_ids
+
+
+def test_stopping_criteria_with_several_new_tokens_per_step(word_tokenizer):
+    stats = Counter()
+    criteria = FinalAnswerStoppingCriteria(
+        word_tokenizer, closing_bracket_token_ids(word_tokenizer), max_new_tokens=10,
+        stats=stats)
+    prompt = word_tokenizer.encode("The answer")
+    criteria.start(len(prompt))
+
+    # assisted generation verifies several drafted tokens at once
+    ids = prompt + word_tokenizer.encode("\nfinal_answer = [Paris")
+    assert not criteria(torch.tensor([ids]), None).item()
+    ids += word_tokenizer.encode("].")
+    assert criteria(torch.tensor([ids]), None).item()
+    assert stats == Counter(sequences=1, stopped=1, tokens_saved=2)
+
+    # a new generation starts over
+    criteria.start(len(prompt))
+    assert not criteria(torch.tensor([prompt + word_tokenizer.encode("[Paris")]), None).item()
+    assert stats["sequences"] == 2
+
+
+def generate(tokenizer, processor, prompt, preferred, max_new_tokens):
+    """Greedy generation from fixed scores that rank the `preferred` texts first, in order."""
+    ids = tokenizer.encode(prompt)
+    scores = torch.zeros(len(tokenizer))
+    for rank, text in enumerate(preferred):
+        scores[tokenizer.encode(text)[0]] = len(preferred) - rank
+    for _ in range(max_new_tokens):
+        token = processor(torch.tensor([ids]), scores.clone()[None]).argmax().item()
+        ids.append(token)
+        if token == tokenizer.eos_token_id:
+            break
+    return tokenizer.decode(ids[len(tokenizer.encode(prompt)):],
+                            skip_special_tokens=True)
+
+
+def test_list_of_names_can_be_empty(word_tokenizer, answer_vocabulary):
+    processor = FinalAnswerLogitsProcessor(answer_vocabulary, NAMES, max_new_tokens=12,
+                                           answer_tokens=4)
+    completion = generate(word_tokenizer, processor, "The answer", ["]", "1", "Paris"], 12)
+    assert completion.endswith("\nfinal_answer = []")
+    assert FINAL_ANSWER_UNDERSCORE.search(completion).group(1) == ""
+
+
+def test_list_of_integers_has_a_digit(word_tokenizer, answer_vocabulary):
+    processor = FinalAnswerLogitsProcessor(answer_vocabulary, INTEGERS, max_new_tokens=12,
+                                           answer_tokens=4)
+    completion = generate(word_tokenizer, processor, "The answer", ["]", "1", "Paris"], 12)
+    assert completion.endswith("\nfinal_answer = [1]")
+
+
+@pytest.mark.parametrize("shape, preferred, answer", [
+    (YES_NO, ["The", "Paris", "No", "1"], r"No"),
+    (INTEGERS, ["Paris", "1", ",", "]"], r"1+"),
+    (NAMES, ["[", "\n", "Paris", " Berlin"], r"(Paris)+"),
+])
+def test_answer_list_has_the_shape(shape, preferred, answer, word_tokenizer,
+                                   answer_vocabulary):
+    processor = FinalAnswerLogitsProcessor(answer_vocabulary, shape, max_new_tokens=14,
+                                           answer_tokens=4)
+    completion = generate(word_tokenizer, processor, "The answer", preferred, 14)
+    assert "\nfinal_answer = [" in completion
+    last_line = completion.split("\n")[-1]
+    assert regex.fullmatch(r"final_answer = \[" + answer + r"\]", last_line)
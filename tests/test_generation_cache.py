@@ -0,0 +1,36 @@
+from collections import Counter
+
+import pytest
+from transformers import LogitsProcessorList, StoppingCriteriaList
+
+from models.final_answer import FinalAnswerLogitsProcessor, \
+    FinalAnswerStoppingCriteria, INTEGERS, NAMES
+from models.generation_cache import generation_key
+
+
+def key(**kwargs):
+    return generation_key("model", "prompt", dict(max_new_tokens=32, **kwargs))
+
+
+def processor(vocabulary, shape=NAMES, answer_tokens=8):
+    return LogitsProcessorList([FinalAnswerLogitsProcessor(
+        vocabulary, shape, 32, answer_tokens)])
+
+
+def test_key_depends_on_the_answer_constraints(answer_vocabulary):
+    names = key(logits_processor=processor(answer_vocabulary))
+    assert names == key(logits_processor=processor(answer_vocabulary))
+    assert names != key()
+    assert names != key(logits_processor=processor(answer_vocabulary, shape=INTEGERS))
+    assert names != key(logits_processor=processor(answer_vocabulary, answer_tokens=16))
+
+
+def test_key_depends_on_stopping_at_the_final_answer(word_tokenizer):
+    criteria = StoppingCriteriaList([FinalAnswerStoppingCriteria(
+        word_tokenizer, set(), 32, Counter())])
+    assert key(stopping_criteria=criteria) != key()
+
+
+def test_key_rejects_arguments_without_a_description():
+    with pytest.raises(TypeError):
+        key(streamer=object())
@@ -0,0 +1,54 @@
+import json
+
+from baseline import read_done_pairs, read_inputs
+
+
+def write_rows(path, rows, tail=""):
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows) + tail)
+
+
+def row(subject_id, relation="CompanyHasParentOrganisation"):
+    return {"SubjectEntityID": subject_id, "Relation": relation}
+
+
+def test_missing_output_file_has_no_done_pairs(tmp_path):
+    assert read_done_pairs(tmp_path / "output.jsonl") == set()
+
+
+def test_partial_trailing_line_is_truncated(tmp_path):
+    output_file = tmp_path / "output.jsonl"
+    write_rows(output_file, [row("Q1"), row("Q2")], tail='{"SubjectEntityID": "Q3", "Rel')
+
+    assert read_done_pairs(output_file) == {
+        ("Q1", "CompanyHasParentOrganisation"), ("Q2", "CompanyHasParentOrganisation")}
+    assert output_file.read_text().splitlines() == [json.dumps(row("Q1")), json.dumps(row("Q2"))]
+
+
+def test_trailing_line_without_newline_is_truncated(tmp_path):
+    output_file = tmp_path / "output.jsonl"
+    write_rows(output_file, [row("Q1")], tail=json.dumps(row("Q2")))
+
+    assert read_done_pairs(output_file) == {("Q1", "CompanyHasParentOrganisation")}
+    # the resumed run appends whole lines
+    with open(output_file, "a") as f:
+        f.write(json.dumps(row("Q2")) + "\n")
+    assert read_done_pairs(output_file) == {
+        ("Q1", "CompanyHasParentOrganisation"), ("Q2", "CompanyHasParentOrganisation")}
+
+
+def test_complete_file_is_left_unchanged(tmp_path):
+    output_file = tmp_path / "output.jsonl"
+    write_rows(output_file, [row("Q1"), row("Q2")])
+    content = output_file.read_text()
+
+    assert len(read_done_pairs(output_file)) == 2
+    assert output_file.read_text() == content
+
+
+def test_read_inputs_skips_done_pairs_and_other_shards(tmp_path):
+    input_file = tmp_path / "input.jsonl"
+    write_rows(input_file, [row("Q1"), row("Q2"), row("Q1", "awardWonBy"), row("Q3")])
+
+    skip = {("Q1", "CompanyHasParentOrganisation")}
+    assert list(read_inputs(input_file, skip)) == [row("Q2"), row("Q1", "awardWonBy"), row("Q3")]
+    assert list(read_inputs(input_file, skip, rows={0, 2, 3})) == [row("Q1", "awardWonBy"), row("Q3")]
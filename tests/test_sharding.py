@@ -0,0 +1,52 @@
+import json
+
+from models.sharding import merge_shards, shard_assignments, shard_file
+
+
+def write_rows(path, rows):
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+
+
+def read_rows(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_shard_assignments_balance_every_relation():
+    relations = ["awardWonBy"] * 4 + ["personHasCityOfDeath"] * 5
+    assignments = shard_assignments(relations, 2)
+    assert sorted(assignments[:4]) == [0, 0, 1, 1]
+    assert sorted(assignments[4:]) in ([0, 0, 0, 1, 1], [0, 0, 1, 1, 1])
+    assert shard_assignments(relations, 2) == assignments
+
+
+def test_merge_follows_the_input_order(tmp_path):
+    inputs = [{"SubjectEntityID": f"Q{i}", "Relation": relation}
+              for i, relation in enumerate(["awardWonBy", "personHasCityOfDeath"] * 3)]
+    input_file = tmp_path / "input.jsonl"
+    write_rows(input_file, inputs)
+
+    output_file = tmp_path / "output.jsonl"
+    assignments = shard_assignments([row["Relation"] for row in inputs], 2)
+    shard_files = []
+    for shard_id in range(2):
+        # the shards write their results in their own (here reversed) order
+        rows = [dict(row, ObjectEntitiesID=[row["SubjectEntityID"]])
+                for row, shard in zip(inputs, assignments) if shard == shard_id]
+        shard_files.append(shard_file(output_file, shard_id, 2))
+        write_rows(shard_files[-1], rows[::-1])
+
+    assert merge_shards(input_file, shard_files, output_file) == len(inputs)
+    assert [(row["SubjectEntityID"], row["Relation"]) for row in read_rows(output_file)] == \
+        [(row["SubjectEntityID"], row["Relation"]) for row in inputs]
+
+
+def test_merge_leaves_out_rows_without_a_result(tmp_path):
+    inputs = [{"SubjectEntityID": f"Q{i}", "Relation": "awardWonBy"} for i in range(3)]
+    input_file = tmp_path / "input.jsonl"
+    write_rows(input_file, inputs)
+    shard = tmp_path / "output.shard-0-of-1.jsonl"
+    write_rows(shard, [inputs[2], inputs[0]])
+
+    output_file = tmp_path / "output.jsonl"
+    assert merge_shards(input_file, [shard], output_file) == 2
+    assert read_rows(output_file) == [inputs[0], inputs[2]]
@@ -0,0 +1,35 @@
+import sqlite3
+import threading
+
+import pytest
+
+from models.wikidata_cache import WikidataCache
+
+
+def hold_write_lock(db_path, seconds):
+    """Hold the write lock of the database, like another shard writing, and release it after `seconds`."""
+    conn = sqlite3.connect(str(db_path), check_same_thread=False)
+    conn.execute("BEGIN IMMEDIATE")
+    timer = threading.Timer(seconds, conn.rollback)
+    timer.start()
+    return timer
+
+
+def test_shared_cache_waits_for_the_write_lock(tmp_path):
+    db_path = tmp_path / "wikidata.sqlite"
+    cache = WikidataCache(db_path, busy_timeout=10)
+    other = WikidataCache(db_path, busy_timeout=10)
+
+    hold_write_lock(db_path, 0.3)
+    cache.put_many({"Paris": "Q90"})
+    assert other.get_many(["Paris"]) == {"Paris": "Q90"}
+
+
+def test_shared_cache_fails_once_the_busy_timeout_runs_out(tmp_path):
+    db_path = tmp_path / "wikidata.sqlite"
+    cache = WikidataCache(db_path, busy_timeout=0.05)
+
+    timer = hold_write_lock(db_path, 1.0)
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        cache.put_many({"Paris": "Q90"})
+    timer.join()
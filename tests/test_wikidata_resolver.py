@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from models.wikidata_resolver import RetryableHTTPError, TokenBucket, \
+    WikidataResolver
+from wikidata_stub import make_server
+
+LABELS = {"paris": "Q90", "berlin": "Q64"}
+
+
+@pytest.fixture
+def stub():
+    """Start a local Wikidata stub; the keyword arguments are passed to `make_server`."""
+    servers = []
+
+    def start(**kwargs):
+        server = make_server(LABELS, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        host, port = server.server_address
+        return server, f"http://{host}:{port}/w/api.php"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_token_bucket_limits_the_rate():
+    bucket = TokenBucket(rate=20, capacity=1)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    # the first token is available at once, the other four every 1/20 s
+    assert time.monotonic() - start >= 4 / 20 * 0.9
+
+
+def test_token_bucket_allows_bursts_up_to_its_capacity():
+    bucket = TokenBucket(rate=1, capacity=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.5
+
+
+def test_token_bucket_without_rate_never_waits():
+    bucket = TokenBucket(rate=0)
+    start = time.monotonic()
+    for _ in range(100):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.5
+
+
+def test_search_returns_the_first_result(stub):
+    _, api_url = stub()
+    resolver = WikidataResolver(api_url=api_url, requests_per_second=0)
+    assert resolver.search("Paris") == "Q90"
+    assert resolver.search("Atlantis") == ""
+    resolver.close()
+
+
+def test_search_many_resolves_concurrently(stub):
+    server, api_url = stub()
+    resolver = WikidataResolver(api_url=api_url, requests_per_second=0,
+                                max_workers=4)
+    found, errors = resolver.search_many(["Paris", "Berlin", "Atlantis"])
+    assert found == {"Paris": "Q90", "Berlin": "Q64", "Atlantis": ""}
+    assert errors == {}
+    assert server.num_requests == 3
+    resolver.close()
+
+
+def test_search_retries_429_after_the_retry_after_delay(stub):
+    server, api_url = stub(fail_first=1, retry_after=1)
+    resolver = WikidataResolver(api_url=api_url, requests_per_second=0,
+                                backoff_factor=0.01, max_retries=2)
+    start = time.monotonic()
+    assert resolver.search("Berlin") == "Q64"
+    # the backoff of 0.01 s is raised to the Retry-After of 1 s
+    assert time.monotonic() - start >= 1
+    assert server.num_requests == 2
+    resolver.close()
+
+
+def test_search_backs_off_exponentially(stub):
+    server, api_url = stub(fail_first=2)
+    resolver = WikidataResolver(api_url=api_url, requests_per_second=0,
+                                backoff_factor=0.1, max_retries=2)
+    start = time.monotonic()
+    assert resolver.search("Paris") == "Q90"
+    # 0.1 s and 0.2 s of backoff (plus jitter)
+    assert time.monotonic() - start >= 0.3
+    assert server.num_requests == 3
+    resolver.close()
+
+
+def test_search_gives_up_after_max_retries(stub):
+    server, api_url = stub(fail_first=10)
+    resolver = WikidataResolver(api_url=api_url, requests_per_second=0,
+                                backoff_factor=0.01, max_retries=1)
+    with pytest.raises(RetryableHTTPError):
+        resolver.search("Paris")
+    assert server.num_requests == 2
+
+    found, errors = resolver.search_many(["Paris", "Berlin"])
+    assert found == {}
+    assert set(errors) == {"Paris", "Berlin"}
+    resolver.close()
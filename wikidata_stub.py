@@ -0,0 +1,132 @@
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qs, urlparse
+
+from loguru import logger
+
+from models.wikidata_cache import normalize_label
+
+
+def read_labels(file_path) -> Dict[str, str]:
+    """Read label -> ID pairs from a TSV (`label<TAB>id`) or LM-KBC JSONL file."""
+    labels = {}
+    with open(file_path) as f:
+        if str(file_path).endswith(".tsv"):
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) >= 2:
+                    labels.setdefault(normalize_label(parts[0]), parts[1])
+        else:
+            for line in f:
+                row = json.loads(line)
+                labels.setdefault(normalize_label(row["SubjectEntity"]),
+                                  row["SubjectEntityID"])
+                for label, qid in zip(row.get("ObjectEntities", []),
+                                      row.get("ObjectEntitiesID", [])):
+                    labels.setdefault(normalize_label(label), qid)
+    return labels
+
+
+def make_server(labels: Dict[str, str], host: str = "127.0.0.1",
+                port: int = 0, latency: float = 0.0,
+                error_rate: float = 0.0, fail_first: int = 0,
+                retry_after: int = 0) -> ThreadingHTTPServer:
+    """Create a local HTTP server that mimics the `wbsearchentities` API.
+
+    Exact (normalized) label matches are returned as the only search result.
+    Every request is delayed by `latency` seconds and answered with a 429
+    with probability `error_rate`; the first `fail_first` requests always are.
+    The 429 responses ask to retry after `retry_after` seconds. Use port 0 to
+    pick a free port.
+    """
+
+    class WbSearchEntitiesHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.num_requests += 1
+            params = parse_qs(urlparse(self.path).query)
+            if params.get("action", [""])[0] != "wbsearchentities":
+                self.send_error(400, "Only action=wbsearchentities is supported")
+                return
+
+            if latency:
+                time.sleep(latency)
+            if self.server.num_requests <= fail_first or \
+                    (error_rate and random.random() < error_rate):
+                self.send_response(429)
+                self.send_header("Retry-After", str(retry_after))
+                self.end_headers()
+                return
+
+            search = params.get("search", [""])[0]
+            qid = labels.get(normalize_label(search))
+            body = json.dumps({
+                "searchinfo": {"search": search},
+                "search": [{"id": qid, "label": search}] if qid else [],
+                "success": 1,
+            }).encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), WbSearchEntitiesHandler)
+    server.num_requests = 0
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a local stand-in for the Wikidata search API")
+
+    parser.add_argument(
+        "-i", "--input_file",
+        type=str,
+        required=True,
+        help="TSV (`label<TAB>id`) or LM-KBC JSONL file with the labels to serve"
+    )
+    parser.add_argument(
+        "-p", "--port",
+        type=int,
+        default=8765,
+        help="Port to listen on (default: 8765)"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Artificial latency per request in seconds"
+    )
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with HTTP 429"
+    )
+
+    args = parser.parse_args()
+
+    labels = read_labels(args.input_file)
+    server = make_server(labels, port=args.port, latency=args.latency,
+                         error_rate=args.error_rate)
+    host, port = server.server_address
+    logger.info(f"Serving {len(labels):,} labels at "
+                f"http://{host}:{port}/w/api.php ...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()